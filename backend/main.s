@@ -1113,6 +1113,38 @@ class XYAcquireManager: object
         return self
     }
 
+    // 判断区域序号是否在区间编码(例如"0-2,5,7-8")中，区间编码为空表示拍摄全部区域
+    number containsTile(object self, string ranges, number tile)
+    {
+        if (ranges.len() == 0)
+            return 1
+
+        while (ranges.len() > 0)
+        {
+            string item = ranges
+            number comma_pos = ranges.find(",")
+            if (comma_pos < 0)
+                ranges = ""
+            else
+            {
+                item = ranges.left(comma_pos)
+                ranges = ranges.right(ranges.len() - comma_pos - 1)
+            }
+
+            number begin = item.val()
+            number end = begin
+            number dash_pos = item.find("-")
+            if (dash_pos > 0)
+            {
+                begin = item.left(dash_pos).val()
+                end = item.right(item.len() - dash_pos - 1).val()
+            }
+            if (tile >= begin && tile <= end)
+                return 1
+        }
+        return 0
+    }
+
     // 执行XY横移连拍
     number execute(object self, object request, object response)
     {
@@ -1143,12 +1175,21 @@ class XYAcquireManager: object
         number x_step = math_utils.floor(x_size / x_split)
         number y_step = math_utils.floor(y_size / y_split)
 
+        number tile = 0  // 区域序号，行优先编号，随每个区域的响应返回前端
+        string tiles = request.get("tiles")  // 续拍时仅拍摄的区域，为空表示全部区域
+
         // 行循环
         for (number line_num = 0; line_num < x_split; line_num ++) 
         {
             // 列循环
             for (number col_num = 0; col_num < y_split; col_num ++)
             {
+                if (!self.containsTile(tiles, tile))  // 跳过已经完成的区域
+                {
+                    tile ++
+                    continue
+                }
+
                 number areaT = line_num * y_step
                 number areaL = col_num * x_step
                 number areaB = (line_num + 1) * y_step
@@ -1189,7 +1230,10 @@ class XYAcquireManager: object
                 // TODO: processing的获取
                 // number processing = CameraGetGainNormalizedEnum( ) 
                 number processing = 1
-                acquire_task = acquire_task.Init(request, response, camID, exposure, x_bin, y_bin, processing, areaT, areaL, areaB, areaR)
+                object tile_response = message_adapter.allocWithHead(response)  // 每个区域单独响应
+                tile_response.set("tile", "" + tile)
+                tile ++
+                acquire_task = acquire_task.Init(request, tile_response, camID, exposure, x_bin, y_bin, processing, areaT, areaL, areaB, areaR)
                 acquire_task_mq.PostMessage(acquire_task)  // 提交拍摄任务
             }
         }
@@ -0,0 +1,587 @@
+"""
+Created on 2024.5.28
+@author: Pineclone
+后端模拟器，以Python复现DM脚本(backend/main.s)的线程结构以及响应语义，用于在没有DigitalMicrograph的机器上对中间件和前端进行端到端压测：
+输入线程 -> 请求队列 -> 任务线程 -> 拍摄管理器 -> 拍摄任务队列 -> 拍摄线程池 -> 响应队列 -> 输出线程
+"""
+import cmd
+import math
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+from loguru import logger
+
+from . import config
+from .comm import Message, Properties, TILE_KEY, decodeRanges
+from .transport import createChannels
+
+
+def val(string) -> float:
+    """ 与DM脚本中的String.val()一致，无法转换时返回0 """
+    try:
+        return float(string)
+    except (TypeError, ValueError):
+        return 0
+
+
+def allocWithHead(origin: Message) -> Message:
+    """ 通过已有的一个消息实例创建新的实例，保留原实例头部 """
+    novel = Message()
+    novel.head = origin.head
+    return novel
+
+
+class AcquireTask:
+    """ 拍摄任务 """
+
+    def __init__(self, request: Message, response: Message, cam_id, exposure, x_bin, y_bin, processing,
+                 area_t, area_l, area_b, area_r, latency: float):
+        self.request = request
+        self.response = response  # 触发回调使用
+        self.cam_id = cam_id
+        self.exposure = exposure
+        self.x_bin = x_bin
+        self.y_bin = y_bin
+        self.processing = processing
+        self.area = (area_t, area_l, area_b, area_r)  # 拍摄区域，上、左、下、右
+        self.latency = latency
+
+    def doCameraAcquire(self) -> None:
+        time.sleep(self.latency)  # 模拟耗时任务
+
+
+class AddressValidator:
+    """ IP地址验证器，用于禁用某个ip地址的请求 """
+    name = 'AddressValidator'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.filter = set()  # 地址过滤
+
+    def validate(self, request: Message, response: Message) -> bool:
+        with self.lock:
+            return request.getHeader('address') not in self.filter
+
+    def rejectAddress(self, address: str) -> None:
+        with self.lock:
+            self.filter.add(address)
+
+    def permitAddress(self, address: str) -> None:
+        with self.lock:
+            self.filter.discard(address)
+
+
+class BackendSimulator:
+    """
+    后端模拟器门户，launch和terminate分别对应DM脚本GUI中的Initiate和Terminate按钮，每次启动都会重新创建通道和线程
+    """
+    XY_CONTINUOUS_ACQUIRE = 0
+    SP_CONTINUOUS_ACQUIRE = 1
+    XY_CANCEL_ACQUIRE = 2
+    SP_CANCEL_ACQUIRE = 3
+    CONNECTION_CLOSE = 4
+
+    def __init__(self, **kwargs):
+        self.config = kwargs
+        self.timeout = kwargs.get('timeout', 2)  # 与main.s中WaitOnMessage的等待时间一致
+        self.encoding = kwargs['encoding']
+        self.read_interval = kwargs.get('read_interval', 0.1)  # 输入管道读取间隔，0表示阻塞等待
+        self.thread_num = kwargs.get('thread_num', 5)  # 拍摄线程数
+        self.pos_optimize_interval = kwargs.get('pos_optimize_interval', 1)  # 坐标自动修正间隔
+        self.acquire_latency = kwargs.get('acquire_latency', 0.5)  # 单次拍摄耗时
+        self.dispatch_interval = kwargs.get('dispatch_interval', 1)  # 单点连拍子任务派发间隔
+
+        self.request_mq = queue.Queue()  # 请求消息队列
+        self.response_mq = queue.Queue()  # 响应消息队列
+        self.acquire_task_mq = queue.Queue()  # 拍摄任务队列
+        self.address_validator = AddressValidator()
+        self.sp_acquire_manager = self.SPAcquireManager(self)
+        self.xy_acquire_manager = self.XYAcquireManager(self)
+        self.response_counter = Counter()  # 各个响应码的写出次数
+        self.threads = []
+
+    def launch(self) -> None:
+        if self.threads:
+            logger.warning('Cannot launch backend simulator as it has already launched')
+            return
+        for key in ('input_pip_path', 'output_pip_path'):  # 管道所在目录不存在时创建
+            os.makedirs(os.path.dirname(os.path.abspath(self.config[key])), exist_ok=True)
+        input_channel, output_channel = createChannels(self.config, 'backend')
+
+        self.acquire_manager = self.AcquireManager(self)
+        self.threads = [self.InputThread(self, input_channel), self.TaskThread(self),
+                        self.OutputThread(self, output_channel), self.acquire_manager]
+        for thread in self.threads:
+            thread.start()
+        logger.info(f'Backend simulator launched by {input_channel.name} transport, '
+                    f'{self.thread_num} acquire threads, acquire latency {self.acquire_latency}s')
+
+    def terminate(self, synchronized: bool = False) -> None:
+        if not self.threads:
+            return
+        threads, self.threads = self.threads + self.acquire_manager.acquire_threads, []
+        for thread in threads:
+            thread.terminate()
+        self.sp_acquire_manager.shutdownAll()
+        if synchronized:
+            for thread in threads:
+                thread.join()
+
+    def getStatistics(self) -> Dict:
+        return {
+            'request_mq': self.request_mq.qsize(),
+            'acquire_task_mq': self.acquire_task_mq.qsize(),
+            'response_mq': self.response_mq.qsize(),
+            'sp_tasks': len(self.sp_acquire_manager.task_dispatcher_list),
+            'responses': dict(self.response_counter),
+        }
+
+    class InputThread(threading.Thread):
+        """
+        输入线程，按照input_pip_read_interval间隔检查输入通道，将读取到的请求提交到请求队列
+        """
+
+        def __init__(self, app_context, channel):
+            super().__init__(name='InputThread')
+            self.is_terminated = False
+            self.app_context = app_context
+            self.channel = channel
+
+        def terminate(self):
+            self.is_terminated = True
+
+        def run(self) -> None:
+            while not self.is_terminated:
+                if self.app_context.read_interval > 0:  # 降低读取管道的频率，与main.s一致
+                    time.sleep(self.app_context.read_interval)
+                    lines = self.channel.read(0)
+                else:
+                    lines = self.channel.read(self.app_context.timeout)
+                for line in lines:
+                    request = Message.loads(line)
+                    if request is None:
+                        continue
+                    logger.debug(f'InputThread: Accepted message : [{line}]')
+                    self.app_context.request_mq.put(request)
+            self.channel.close()  # 删除管道文件和锁文件
+            logger.debug('InputThread: InputThread terminated')
+
+    class TaskThread(threading.Thread):
+        """
+        任务线程，根据请求中的name将请求派发到具体的操作上，未知的操作引导至NotFoundException
+        """
+
+        def __init__(self, app_context):
+            super().__init__(name='TaskThread')
+            self.is_terminated = False
+            self.app_context = app_context
+            self.operations = {
+                'NotFoundException': self.notFoundException,
+                'InvalidMessageException': self.invalidMessageException,
+                'ContinuousAcquire': self.continuousAcquire,
+                'ConnectionClosing': self.connectionClosing,
+            }
+
+        def terminate(self):
+            self.is_terminated = True
+
+        def run(self) -> None:
+            while not self.is_terminated:
+                try:
+                    request = self.app_context.request_mq.get(timeout=self.app_context.timeout)
+                except queue.Empty:
+                    continue
+                response = allocWithHead(request)
+                name = request.get('name') or 'InvalidMessageException'
+                self.operations.get(name, self.notFoundException)(request, response)
+            logger.debug('TaskThread: TaskThread terminated')
+
+        def notFoundException(self, request: Message, response: Message):
+            response.set('code', '404')
+            response.set('message', 'Unable accessing target resources')
+            self.app_context.response_mq.put(response)
+
+        def invalidMessageException(self, request: Message, response: Message):
+            response.set('code', '400')
+            response.set('message', 'Unable parsing message, check if message is in correctly writting')
+            self.app_context.response_mq.put(response)
+
+        def continuousAcquire(self, request: Message, response: Message):
+            self.app_context.acquire_manager.submit(request, response)
+
+        def connectionClosing(self, request: Message, response: Message):
+            logger.debug(f'connection close: {request.getHeader("address")}')
+            request.set('option', BackendSimulator.CONNECTION_CLOSE)  # 停止前端进程对应的拍摄进程
+            self.app_context.acquire_manager.submit(request, response)
+
+    class OutputThread(threading.Thread):
+        """
+        输出线程，每取得一条响应（或等待超时）检查一次输出通道，通道可写时将缓存的响应全部写出
+        """
+
+        def __init__(self, app_context, channel):
+            super().__init__(name='OutputThread')
+            self.is_terminated = False
+            self.app_context = app_context
+            self.channel = channel
+            self.response_cache: List[str] = []  # 写出消息缓存
+            self.code_cache: List[str] = []
+
+        def terminate(self):
+            self.is_terminated = True
+
+        def run(self) -> None:
+            while not self.is_terminated:
+                try:
+                    response = self.app_context.response_mq.get(timeout=self.app_context.timeout)
+                    self.response_cache.append(Message.dumps(response))  # 将消息加载到缓存
+                    self.code_cache.append(response.get('code'))
+                except queue.Empty:
+                    pass
+
+                if self.response_cache:
+                    written = self.channel.write(self.response_cache)
+                    self.app_context.response_counter.update(self.code_cache[:written])
+                    del self.response_cache[:written]
+                    del self.code_cache[:written]
+            self.channel.close()
+            logger.debug('OutputThread: OutputThread terminated')
+
+    class AcquireThread(threading.Thread):
+        """
+        拍摄线程，以池的方式运行，依次通过验证器链之后执行拍摄，每次拍摄完成进行响应
+        """
+
+        def __init__(self, app_context, index: int):
+            super().__init__(name=f'AcquireThread-{index}')
+            self.is_terminated = False
+            self.app_context = app_context
+            self.validators = [app_context.address_validator]  # 验证器链
+
+        def terminate(self):
+            self.is_terminated = True
+
+        def run(self) -> None:
+            while not self.is_terminated:
+                try:
+                    acquire_task: AcquireTask = self.app_context.acquire_task_mq.get(timeout=self.app_context.timeout)
+                except queue.Empty:
+                    continue
+                response = acquire_task.response
+                forbidden = next((validator for validator in self.validators
+                                  if not validator.validate(acquire_task.request, response)), None)
+                if forbidden is not None:
+                    response.set('code', '403')  # 拍摄请求被禁止
+                    response.set('message', 'Server do received the message, but reject handling it, validator: '
+                                 + forbidden.name)
+                    self.app_context.response_mq.put(response)
+                    continue  # 继续获取下一个拍摄请求
+
+                acquire_task.doCameraAcquire()  # 执行拍摄
+                response.set('code', '200')  # 每次拍摄完成进行响应
+                response.set('message', 'Done')
+                self.app_context.response_mq.put(response)
+
+    class AcquireManager(threading.Thread):
+        """
+        拍摄管理器，启动拍摄线程池，并根据option执行横移连拍、单点连拍以及停止操作
+        """
+
+        def __init__(self, app_context):
+            super().__init__(name='AcquireManager')
+            self.is_terminated = False
+            self.app_context = app_context
+            self.acquire_manager_mq = queue.Queue()
+            self.acquire_threads = [BackendSimulator.AcquireThread(app_context, index)
+                                    for index in range(app_context.thread_num)]
+
+        def submit(self, request: Message, response: Message):
+            self.acquire_manager_mq.put((request, response))
+
+        def terminate(self):
+            for acquire_thread in self.acquire_threads:
+                acquire_thread.terminate()
+            self.is_terminated = True
+
+        def respond(self, response: Message, code: str, message: str):
+            response.set('code', code)
+            response.set('message', message)
+            self.app_context.response_mq.put(response)
+
+        def run(self) -> None:
+            for acquire_thread in self.acquire_threads:
+                acquire_thread.start()
+
+            app_context = self.app_context
+            while not self.is_terminated:
+                try:
+                    request, response = self.acquire_manager_mq.get(timeout=app_context.timeout)
+                except queue.Empty:
+                    continue
+
+                option_str = request.get('option')
+                if option_str is None:
+                    self.respond(response, '400',
+                                 'option cannot be found in request, no acqure operation will be executed')
+                    continue
+                option = val(option_str)
+                address = request.getHeader('address')
+
+                if option == BackendSimulator.XY_CONTINUOUS_ACQUIRE:
+                    app_context.address_validator.permitAddress(address)  # 放行ip
+                    app_context.xy_acquire_manager.execute(request, response)
+                    self.respond(response, '201', 'Successfully create xy acquire task')
+
+                elif option == BackendSimulator.XY_CANCEL_ACQUIRE:
+                    app_context.address_validator.rejectAddress(address)  # 禁用ip
+                    app_context.xy_acquire_manager.stop(request, response)
+                    self.respond(response, '202', 'Successfully stop xy acqure tasks')
+
+                elif option == BackendSimulator.SP_CONTINUOUS_ACQUIRE:
+                    app_context.address_validator.permitAddress(address)  # 放行ip
+                    if app_context.sp_acquire_manager.execute(request, response):
+                        self.respond(response, '201', 'Successfully create sp acquire task')
+                    else:
+                        self.respond(response, '400', 'Cannot execute sp continuous acquire task')
+                        # 与main.s一致，单点连拍提交失败之后拍摄管理器线程退出，不再处理后续操作
+                        logger.warning('AcquireManager exits after a rejected sp acquire task, as main.s does')
+                        return
+
+                elif option == BackendSimulator.SP_CANCEL_ACQUIRE:
+                    app_context.address_validator.rejectAddress(address)  # 拒绝ip
+                    if app_context.sp_acquire_manager.stop(request, response):
+                        self.respond(response, '202', 'Successfully stop sp acqure tasks')
+                    else:
+                        self.respond(response, '401', 'No such sp acquire task can be stopped')
+
+                elif option == BackendSimulator.CONNECTION_CLOSE:
+                    app_context.address_validator.rejectAddress(address)  # 拒绝ip
+                    app_context.xy_acquire_manager.stop(request, response)
+                    if app_context.sp_acquire_manager.stop(request, response):
+                        logger.debug('Stop sp acquire task cause by connection close')
+
+                else:
+                    self.respond(response, '400', 'Given option code cannot apply to any exist operation')
+
+    class SPAcquireTaskDispatcher(threading.Thread):
+        """
+        单点连拍任务派发，每隔dispatch_interval派发等同于帧率数量的拍摄任务，共派发duration次，duration小于等于0时持续派发
+        """
+
+        def __init__(self, app_context, request: Message, response: Message):
+            super().__init__(name=f'SPAcquireTaskDispatcher-{request.getHeader("address")}', daemon=True)
+            self.app_context = app_context
+            self.request = request
+            self.response = response
+            self.area = [val(request.get(key)) for key in ('pos_top', 'pos_left', 'pos_bottom', 'pos_right')]
+            self.framerate = val(request.get('framerate'))
+            self.duration = val(request.get('duration'))
+            self.enable_optimize = val(request.get('enable_optimize'))
+            self.address = request.getHeader('address')
+            self.is_terminated = False
+            self.current_count = 0  # 当前循环轮数
+            self.stopping = threading.Event()
+            self.lock = threading.Lock()
+
+        def dispatchSubTask(self) -> None:
+            with self.lock:
+                if self.is_terminated:
+                    return
+                request = self.request
+                acquire_task = AcquireTask(request, self.response, val(request.get('cam_id')),
+                                           val(request.get('exposure')), val(request.get('x_bin')),
+                                           val(request.get('y_bin')), 1, *self.area, self.app_context.acquire_latency)
+                for _ in range(math.ceil(self.framerate)):
+                    self.app_context.acquire_task_mq.put(acquire_task)  # 派发等同于帧率数量的任务
+
+                # 判断是否需要更新坐标
+                if self.enable_optimize and not self.current_count % (self.app_context.pos_optimize_interval + 1):
+                    response = allocWithHead(self.response)
+                    response.set('code', '300')
+                    response.set('message', 'Optimizing request')
+                    self.app_context.response_mq.put(response)
+
+                if self.duration > 0:
+                    self.current_count += 1
+                    if self.current_count >= self.duration:  # 定时任务执行完成
+                        self.is_terminated = True
+                        self.app_context.sp_acquire_manager.unregisterTaskDispatcher(self)
+
+        def run(self) -> None:
+            while not self.stopping.wait(self.app_context.dispatch_interval) and not self.is_terminated:
+                self.dispatchSubTask()
+
+        def shutdown(self) -> bool:
+            with self.lock:
+                if self.is_terminated:
+                    return False
+                if self.current_count < self.duration or self.duration < 0:  # 为中途终止任务
+                    self.is_terminated = True
+                    self.stopping.set()
+                    self.app_context.sp_acquire_manager.unregisterTaskDispatcher(self)
+                    return True
+                return False
+
+    class SPAcquireManager:
+        """ 单点连拍管理器，每个前端地址同一时间只允许存在一个连拍任务 """
+
+        def __init__(self, app_context):
+            self.app_context = app_context
+            self.task_dispatcher_list: List[BackendSimulator.SPAcquireTaskDispatcher] = []
+            self.lock = threading.RLock()
+
+        def unregisterTaskDispatcher(self, task_dispatcher) -> None:
+            with self.lock:
+                if task_dispatcher in self.task_dispatcher_list:
+                    self.task_dispatcher_list.remove(task_dispatcher)
+
+        def getTaskDispatcher(self, address: str):
+            with self.lock:
+                return next((task_dispatcher for task_dispatcher in self.task_dispatcher_list
+                             if task_dispatcher.address == address), None)
+
+        def execute(self, request: Message, response: Message) -> bool:
+            with self.lock:
+                if self.getTaskDispatcher(request.getHeader('address')) is not None:
+                    return False
+                task_dispatcher = BackendSimulator.SPAcquireTaskDispatcher(self.app_context, request, response)
+                self.task_dispatcher_list.append(task_dispatcher)
+            task_dispatcher.start()
+            return True
+
+        def stop(self, request: Message, response: Message) -> bool:
+            task_dispatcher = self.getTaskDispatcher(request.getHeader('address'))
+            return task_dispatcher is not None and task_dispatcher.shutdown()
+
+        def shutdownAll(self) -> None:
+            with self.lock:
+                task_dispatchers = list(self.task_dispatcher_list)
+            for task_dispatcher in task_dispatchers:
+                task_dispatcher.shutdown()
+
+    class XYAcquireManager:
+        """
+        横移连拍管理器，将4096x4096的画面按照x_split和y_split切分，每个区域提交一个拍摄任务，
+        每个区域的响应携带行优先的区域序号，前端据此记录哪些区域已经完成；
+        请求携带区间编码的tiles时仅拍摄其中的区域，用于中断之后续拍
+        """
+        x_size = 4096  # 相机画面尺寸
+        y_size = 4096
+
+        def __init__(self, app_context):
+            self.app_context = app_context
+
+        def execute(self, request: Message, response: Message) -> bool:
+            cam_id, exposure = val(request.get('cam_id')), val(request.get('exposure'))
+            x_bin, y_bin = val(request.get('x_bin')), val(request.get('y_bin'))
+            x_size = math.floor(self.x_size / x_bin)  # 计算binning
+            y_size = math.floor(self.y_size / y_bin)
+
+            enable_extension = val(request.get('enable_extension'))
+            extension_unit = val(request.get('extension_unit'))
+            x_off, y_off = val(request.get('x_off')), val(request.get('y_off'))
+            x_split, y_split = val(request.get('x_split')), val(request.get('y_split'))
+            x_step = math.floor(x_size / x_split)  # 计算步长
+            y_step = math.floor(y_size / y_split)
+
+            tile = 0  # 区域序号
+            tiles = decodeRanges(request.get('tiles'))  # 续拍时仅拍摄的区域，为空表示全部区域
+            for line_num in range(math.ceil(x_split)):  # 行循环
+                for col_num in range(math.ceil(y_split)):  # 列循环
+                    if tiles and not any(begin <= tile <= end for begin, end in tiles):  # 跳过已经完成的区域
+                        tile += 1
+                        continue
+                    area_t, area_l = line_num * y_step, col_num * x_step
+                    area_b, area_r = (line_num + 1) * y_step, (col_num + 1) * x_step
+
+                    if enable_extension and (x_off != 0 or y_off != 0):
+                        if extension_unit == 0:  # 像素拓展，向四周拓展
+                            area_t, area_l, area_b, area_r = area_t - y_off, area_l - x_off, area_b + y_off, area_r + x_off
+                        elif extension_unit == 1:  # 百分比拓展，与main.s一致，纵向拓展同样按照x_off计算
+                            v_off = math.floor(y_step * (0.01 * x_off))
+                            h_off = math.floor(x_step * (0.01 * x_off))
+                            area_t, area_l, area_b, area_r = area_t - v_off, area_l - h_off, area_b + v_off, area_r + h_off
+
+                    # 对坐标的圆整，注意无法访问边界坐标
+                    area_t = min(max(area_t, 0), y_size - 1)
+                    area_l = min(max(area_l, 0), x_size - 1)
+                    area_b = min(max(area_b, area_t), y_size - 1)
+                    area_r = min(max(area_r, area_l), x_size - 1)
+
+                    tile_response = allocWithHead(response)  # 每个区域单独响应
+                    tile_response.set(TILE_KEY, tile)
+                    tile += 1
+                    self.app_context.acquire_task_mq.put(AcquireTask(
+                        request, tile_response, cam_id, exposure, x_bin, y_bin, 1, area_t, area_l, area_b, area_r,
+                        self.app_context.acquire_latency))
+            return True
+
+        def stop(self, request: Message, response: Message) -> bool:
+            return True
+
+
+def loadConfig() -> Dict:
+    """ 读取后端配置文件，与中间件采用同一份backend/config.properties """
+    prop = Properties(config.BE_CONFIG_PATH).get_prop()
+    return {
+        'encoding': config.LISTEN_ENCODING,
+        'transport': prop.get('pip_transport', 'file'),
+        'shm_capacity': int(prop.get('pip_shm_capacity', 1048576)),
+        'input_pip_path': prop['input_pip_path'],
+        'input_pip_lock': prop['input_pip_lock'],
+        'output_pip_path': prop['output_pip_path'],
+        'output_pip_lock': prop['output_pip_lock'],
+        'read_interval': float(prop.get('input_pip_read_interval', 0.1)),
+        'thread_num': int(prop.get('acquire_thread_num', 5)),
+        'pos_optimize_interval': int(prop.get('pos_optimize_interval', 1)),
+        'acquire_latency': config.BE_ACQUIRE_LATENCY,
+        'dispatch_interval': config.BE_DISPATCH_INTERVAL,
+    }
+
+
+class CMD(cmd.Cmd):
+    prompt = '> '
+
+    def __init__(self):
+        super().__init__()
+        logger.info(f'Loading backend process config, path: {config.BE_CONFIG_PATH}')
+        self.simulator = BackendSimulator(**loadConfig())
+        self.simulator.launch()
+
+    def do_launch(self, line):
+        """ 启动后端模拟器，对应DM脚本GUI中的Initiate按钮 """
+        self.simulator.launch()
+
+    def do_shutdown(self, line):
+        """ 停止后端模拟器，删除管道文件和锁文件，对应DM脚本GUI中的Terminate按钮 """
+        self.simulator.terminate(True)
+        logger.info('Backend simulator successfully shutdown')
+
+    def do_latency(self, line):
+        """ 查看或设置单次拍摄耗时，单位为秒，例如：latency 0.05 """
+        if line.strip():
+            self.simulator.acquire_latency = float(line)
+        print(f'acquire latency: {self.simulator.acquire_latency}s')
+
+    def do_status(self, line):
+        """ 查看各个队列的积压数量、正在执行的单点连拍任务数以及各个响应码的写出次数 """
+        for key, value in self.simulator.getStatistics().items():
+            print(f'{key:<16}{value}')
+
+    def do_quit(self, line):
+        """ 停止后端模拟器之后退出程序 """
+        self.simulator.terminate(True)
+        logger.info('Backend simulator successfully shutdown')
+        return True
+
+    def default(self, line):  # 默认指令
+        """Default action for any command not recognized"""
+        print("指令未识别，键入 'help' 来查询可用的指令.")
+
+    @staticmethod
+    def run():
+        CMD().cmdloop("Successfully launch backend simulator, input 'help' for available command.")
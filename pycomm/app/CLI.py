@@ -0,0 +1,65 @@
+"""
+Created on 2024.4.9
+@author: Pineclone
+命令行前端，与图形界面采用相同的网络通讯模块，不依赖PyQt5
+"""
+import cmd
+from concurrent import futures
+
+from loguru import logger
+
+from . import config
+from .comm import ClientSocketProcessor, Message
+
+
+class CMD(cmd.Cmd):
+    prompt = '> '
+
+    def __init__(self):
+        logger.info(f'Launching MainCMD program by python')
+        super().__init__()
+        self.processor = ClientSocketProcessor(
+            config.CONNECT_HOST, config.CONNECT_PORT, config.CONNECT_TIMEOUT, codecs=config.CONNECT_CODECS,
+            correlation_ttl=config.CONNECT_CORRELATION_TTL, correlation_capacity=config.CONNECT_CORRELATION_CAPACITY)
+        self.processor.launch()  # 启动响应接收线程
+
+    def do_send(self, line):
+        """ 以字符串的形式发送请求 """
+        self.processor.send(Message.loads(line))
+
+    def do_request(self, line):
+        """ 以字符串的形式发送请求，打印进度响应并等待最终响应 """
+        future = self.processor.request(Message.loads(line), lambda response: print(response))
+        try:
+            print(future.result(config.CONNECT_TIMEOUT))
+        except futures.TimeoutError:
+            print('No terminal response yet, progress responses will keep printing')
+
+    def do_plan(self, line):
+        """ 执行YAML批量拍摄计划: plan <计划文件> [耗时统计保存路径] """
+        arguments = line.split()
+        if not arguments:
+            print('usage: plan <plan.yaml> [summary.csv]')
+            return
+        import yaml  # 计划相关的依赖仅在执行计划时导入
+        from .plan import runPlan
+        try:
+            runPlan(self.processor, arguments[0], arguments[1] if len(arguments) > 1 else config.PLAN_SUMMARY_PATH)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            print(f'Cannot run plan {arguments[0]}: {e}')
+
+    def do_inflight(self, line):
+        """ 查看等待响应的请求数 """
+        statistics = self.processor.getStatistics()
+        print(f'in flight: {statistics["in_flight"]}, completed: {statistics["completed"]}, '
+              f'evicted: {statistics["evicted"]}')
+
+    def do_quit(self, line):
+        """ 终止程序 """
+        self.processor.terminate()
+        logger.info('MainCMD successfully shutdown')
+        return True
+
+    @staticmethod
+    def run():
+        CMD().cmdloop("Program already launched, Type 'help' for available commands.")
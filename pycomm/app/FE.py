@@ -2,11 +2,13 @@
 Created on 2024.4.9
 @author: Pineclone
 """
-import cmd
+import os
 import sys
+import threading
+import time
 from datetime import datetime
 from enum import Enum
-from typing import List
+from typing import Dict, List
 
 from PyQt5 import QtCore
 from PyQt5 import uic
@@ -16,10 +18,8 @@ from PyQt5.QtWidgets import *
 from loguru import logger
 
 from . import config
-from .comm import ClientSocketProcessor, Message
-
-logger.info(f'Launching frontend process by python')
-QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling)  # 修正窗口界面尺寸
+from .comm import ClientSocketProcessor, Message, AGGREGATE_HEADER, AGGREGATE_CODE
+from .tiles import TileProgressStore, TileTracker
 
 DEF_FONT = QFont(config.UI_FONT, config.UI_FONTSIZE)  # 字体设定
 DEF_WINDOW_TITLE = 'continuous acquire scripts'  # 窗口标题设置
@@ -36,42 +36,18 @@ class Status(Enum):
     XY_ACQUIRE_RUN = {'tag': '-XY-', 'title': 'xp acquire run'}
 
 
-class CMD(cmd.Cmd):
-    prompt = '> '
-
-    def __init__(self):
-        logger.info(f'Launching MainCMD program by python')
-        super().__init__()
-        self.processor = ClientSocketProcessor(
-            config.CONNECT_HOST, config.CONNECT_PORT, config.CONNECT_TIMEOUT)
-
-    def do_send(self, line):
-        """ 以字符串的形式发送请求 """
-        self.processor.send(Message.loads(line))
-
-    def do_quit(self, line):
-        """ 终止程序 """
-        self.processor.terminate()
-        logger.info('MainCMD successfully shutdown')
-        return True
-
-    @staticmethod
-    def run():
-        CMD().cmdloop("Program already launched, Type 'help' for available commands.")
-
-
 class GUI(QWidget):
     # 基础常量
     CHECK_BOX_CHECKED = 2  # 单选框被选中后表现的value
     TAB_XY_CONTINUOUS_NUM = 0  # xy坐标横移连拍tab对应的下标
     TAB_SINGLE_POINT_NUM = 1  # 单点连拍tab对应的下标
+    LAUNCH_TERMINAL_CODES = ('400', '404', '503')  # 启动任务请求的终止响应码，启动成功的任务在结束时显式完成关联
+    STOP_TERMINAL_CODES = ('202', '401', '404', '503')  # 停止任务请求的终止响应码
     DEF_EXTENSION_UNIT_LIST = ['px', '%', ]  # 边缘拓展单位
     DEF_DURATION_UNIT_LIST = ['s', 'm', 'h']  # 可用时间单位列表
 
-    progress_signal = pyqtSignal(int)  # 进度条信号，提供线程设置主线程进度条渲染的能力
     log_signal = pyqtSignal(str)  # 控制台信号，提供线程在控制台打印输出的能力
     status_signal = pyqtSignal(Status)  # 回复执行按钮信号，提供线程恢复主控按钮exec的能力
-    count_signal = pyqtSignal(int)  # 统计目前完成拍摄数量
 
     @staticmethod
     def clamp(val, min_val, max_val):
@@ -84,6 +60,72 @@ class GUI(QWidget):
             return max_val
         return val
 
+    class LogBuffer:
+        """
+        日志缓冲，print_log只将日志加入待显示队列，由定时器在每个刷新间隔内一次性追加到日志窗口，
+        日志窗口仅保留最近的若干行，完整的历史追加写入spill文件
+        """
+
+        def __init__(self, spill_path: str = None):
+            self.pending: List[str] = []  # 等待追加到日志窗口的行
+            self.spill = None  # 完整历史
+            if spill_path:
+                os.makedirs(os.path.dirname(os.path.abspath(spill_path)), exist_ok=True)
+                self.spill = open(spill_path, 'a', encoding='utf-8')
+
+        def append(self, timestamp: str, line: str) -> None:
+            self.pending.append(f'<span style="color:red">{timestamp}:</span><br/>'
+                                f'<span style="color:black">{line}</span>')
+            if self.spill is not None:
+                self.spill.write(f'{timestamp}: {line}\n')
+
+        def drain(self) -> List[str]:
+            """ 取出待显示的行，同时将历史写入文件 """
+            pending, self.pending = self.pending, []
+            if self.spill is not None:
+                self.spill.flush()
+            return pending
+
+        def close(self) -> None:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+    class UICoalescer:
+        """
+        界面更新合并器，网络线程只记录每个界面项的最新值，由主线程定时器按固定刷新率统一渲染，
+        刷新间隔内对同一界面项的多次更新只保留最后一次
+        """
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.pending: Dict[str, int] = {}  # 等待渲染的最新值
+            self.submitted = 0  # 提交的更新次数
+            self.merged = 0  # 被后续更新覆盖而未渲染的次数
+            self.flushes = 0  # 实际渲染次数
+
+        def post(self, name: str, value: int) -> None:
+            with self.lock:
+                if name in self.pending:
+                    self.merged += 1
+                self.pending[name] = value
+                self.submitted += 1
+
+        def take(self) -> Dict[str, int]:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                if pending:
+                    self.flushes += 1
+                return pending
+
+        def getStatistics(self) -> Dict[str, int]:
+            with self.lock:
+                return {
+                    'submitted_updates': self.submitted,
+                    'merged_updates': self.merged,
+                    'flushes': self.flushes
+                }
+
     class TaskCountManager:
         def __init__(self, app_context):
             self.done = 0  # 完成任务数
@@ -96,16 +138,12 @@ class GUI(QWidget):
             self.done = 0
             self.ignored = 0
 
-        def count(self):
-            self.done += 1
-            if self.done > self.total or self.ignored + self.done > self.total:
-                self.done -= 1
-            self.app_context.count_signal.emit(self.done)
+        def count(self, num=1):
+            self.done = max(self.done, min(self.done + num, self.total - self.ignored))  # 完成数不超过剩余任务数
+            self.app_context.ui_coalescer.post('count', self.done)
 
-        def countIgnored(self):
-            self.ignored += 1
-            if self.ignored > self.total or self.ignored + self.done > self.total:
-                self.ignored -= 1
+        def countIgnored(self, num=1):
+            self.ignored = max(self.ignored, min(self.ignored + num, self.total - self.done))  # 忽略数不超过剩余任务数
 
         def getPercentage(self):  # 以整数返回
             return GUI.clamp(round(100 / self.total * self.done), 0, 100)
@@ -135,9 +173,22 @@ class GUI(QWidget):
         uic.loadUi(config.UI_PATH, self)
         self.setWindowTitle(DEF_WINDOW_TITLE)
         self.components = self.__dict__  # 将组件作为对象属性
-        self.log_cache: List[str] = []  # 程序输出窗口信息缓存
-        self.processor = ClientSocketProcessor(config.CONNECT_HOST, config.CONNECT_PORT, config.CONNECT_TIMEOUT)
+        self.log_buffer = GUI.LogBuffer(config.UI_LOG_SPILL_PATH)  # 程序输出窗口信息缓存
+        self.log_timer = QtCore.QTimer(self)  # 日志窗口刷新定时器，合并刷新间隔内的日志
+        self.ui_coalescer = GUI.UICoalescer()  # 进度条与完成计数的更新合并器
+        self.ui_timer = QtCore.QTimer(self)  # 界面刷新定时器，按固定刷新率渲染合并后的更新
+        self.processor = ClientSocketProcessor(config.CONNECT_HOST, config.CONNECT_PORT, config.CONNECT_TIMEOUT,
+                                               codecs=config.CONNECT_CODECS,
+                                               correlation_ttl=config.CONNECT_CORRELATION_TTL,
+                                               correlation_capacity=config.CONNECT_CORRELATION_CAPACITY)
         self.count_manager = GUI.TaskCountManager(self)  # 任务计数器
+        self.tile_tracker = TileTracker(0)  # 横移连拍的区域完成位图
+        self.tile_store = TileProgressStore(config.XY_PROGRESS_DIR) if config.XY_PROGRESS_DIR else None  # 横移连拍进度记录
+        self.xy_body = None  # 当前横移连拍任务的参数
+        self.xy_callback_id = None  # 当前横移连拍任务的关联序号
+        self.sp_callback_id = None  # 当前单点连拍任务的关联序号
+        self.xy_saved_at = 0  # 上一次保存进度记录的时间
+        self.xy_stopped = False  # 当前横移连拍任务是否已经停止，停止之后到达的进度不再按照间隔保存
 
         logger.debug('Initializing GUI')
         self.init_gui()  # 初始化GUI界面
@@ -191,9 +242,9 @@ class GUI(QWidget):
         self.components['enable_duration'].stateChanged.connect(self.check_enable_duration_slot)  # 是否启用单区域连拍持续时间
 
         self.log_signal.connect(self.print_log)  # 日志信号，控制日志输出
-        self.progress_signal.connect(self.set_progress)  # 渲染进度条
+        self.log_timer.timeout.connect(self.flush_log)  # 刷新日志窗口
+        self.ui_timer.timeout.connect(self.flush_ui)  # 渲染进度条以及完成任务个数
         self.status_signal.connect(self.setStatus)  # 设置窗体状态
-        self.count_signal.connect(self.setCompleteCount)  # 设置当前完成任务个数
 
     def init_font(self):
         # 初始化字体
@@ -257,8 +308,13 @@ class GUI(QWidget):
     def init_progress_bar(self):
         # 初始化进度条
         self.components['progress_bar'].setValue(0)
+        self.ui_timer.setInterval(config.UI_REFRESH_INTERVAL)  # 刷新率与帧到达速度无关
+        self.ui_timer.start()
 
     def init_program_output(self):
+        self.components['program_output_text'].document().setMaximumBlockCount(config.UI_LOG_MAX_LINES)  # 仅保留最近的日志
+        self.log_timer.setSingleShot(True)
+        self.log_timer.setInterval(config.UI_LOG_FLUSH_INTERVAL)
         if config.UI_ENABLE_LOG:
             self.stick_resize(DEF_WIDTH_WITH_LOG, DEF_HEIGHT)
             self.components['program_output'].setChecked(True)
@@ -304,6 +360,12 @@ class GUI(QWidget):
     def closeEvent(self, event):
         logger.debug('Closing network connection')
         self.processor.terminate()
+        self.save_xy_progress(True)  # 保存未完成的横移连拍任务，下次可以续拍
+        self.ui_timer.stop()
+        statistics = self.ui_coalescer.getStatistics()
+        logger.debug(f'UI updates: {statistics["submitted_updates"]} submitted, '
+                     f'{statistics["merged_updates"]} merged, {statistics["flushes"]} flushes')
+        self.log_buffer.close()
         logger.debug('Frontend process successfully terminated')
         event.accept()
 
@@ -324,8 +386,8 @@ class GUI(QWidget):
 
     # 清除控制台输出
     def click_output_clean_slot(self):
-        self.log_cache.clear()  # 清空日志窗口内容
-        self.components['program_output_text'].setText('')
+        self.log_buffer.drain()  # 清空日志窗口内容，完整历史仍然保留在spill文件中
+        self.components['program_output_text'].clear()
 
     def click_exec_btn_slot(self):
         """
@@ -340,7 +402,7 @@ class GUI(QWidget):
             message = Message()  # 停止连续拍摄
             message.set('name', 'ContinuousAcquire')
             message.set('option', 2)
-            self.processor.send(message, self.xy_acquire_callback)
+            self.processor.send(message, self.xy_acquire_callback, self.STOP_TERMINAL_CODES)
             return
 
         if self.status is Status.SP_ACQUIRE_RUN:  # 正在执行SP任务
@@ -348,7 +410,7 @@ class GUI(QWidget):
             message = Message()  # 停止连续拍摄
             message.set('name', 'ContinuousAcquire')
             message.set('option', 3)
-            self.processor.send(message, self.sp_acquire_callback)
+            self.processor.send(message, self.sp_acquire_callback, self.STOP_TERMINAL_CODES)
             return
 
         if self.status is Status.VANILLA:
@@ -362,7 +424,7 @@ class GUI(QWidget):
                 self.sp_acquire()  # 单点连拍
 
     def xy_acquire(self):
-        self.progress_signal.emit(0)  # 清空进度条
+        self.ui_coalescer.post('progress', 0)  # 清空进度条
         # cam_name = self.components['camera_combo_box'].currentText()
         # cam_id = cam_name  # 当前使用相机id，从下拉菜单获取
         cam_id = 1
@@ -370,9 +432,6 @@ class GUI(QWidget):
         x_split = self.components['x_splitting_format'].value()  # 分片数量
         y_split = self.components['y_splitting_format'].value()
 
-        # 初始化任务统计
-        self.count_manager.init(x_split * y_split)
-
         x_off, y_off, extension_unit = 0, 0, 0  # 拓展单位和拓展量
         if enable_extension:
             x_off = self.components['x_off'].value()
@@ -396,18 +455,57 @@ class GUI(QWidget):
         message.set('y_bin', y_bin)
         message.set('x_split', x_split)
         message.set('y_split', y_split)
-
-        self.print_log(f'submit {self.count_manager.getTotalNum()} tasks')
-        self.processor.send(message, self.xy_acquire_callback)  # 发送消息
+        if config.XY_AGGREGATE_INTERVAL > 0:  # 由中间件汇总逐帧响应，完成的区域以区间编码给出
+            message.setHeader(AGGREGATE_HEADER, config.XY_AGGREGATE_INTERVAL)
+
+        # 初始化区域完成位图，区域序号按照行优先编号，与后端响应中的序号一致
+        total = x_split * y_split
+        self.tile_tracker = TileTracker(total)
+        self.xy_body, self.xy_saved_at, self.xy_stopped = dict(message.getBody()), time.monotonic(), False
+
+        # 相同参数的任务曾经中断时，可以仅续拍未完成的区域
+        tracker = self.tile_store.load(self.xy_body, total) if self.tile_store is not None else None
+        if tracker is not None and QMessageBox.question(
+                self, 'Resume XY task', f'{tracker.getDoneNum()} of {total} tiles of this task are '
+                                        f'already complete, acquire only the remaining tiles?') == QMessageBox.Yes:
+            self.tile_tracker = tracker
+            message.set('tiles', tracker.getPendingRanges())
+
+        self.count_manager.init(total)
+        self.count_manager.count(self.tile_tracker.getDoneNum())
+        self.ui_coalescer.post('progress', self.count_manager.getPercentage())
+        if self.tile_tracker is tracker:
+            self.print_log(f'resume {self.count_manager.getLeftNum()} of {self.count_manager.getTotalNum()} tasks')
+        else:
+            self.print_log(f'submit {self.count_manager.getTotalNum()} tasks')
+        # 先注册回调并记录关联序号再发送，避免快速返回的终止响应在记录之前到达回调
+        self.xy_callback_id, _ = self.processor.correlations.register(self.xy_acquire_callback,
+                                                                      self.LAUNCH_TERMINAL_CODES)
+        message.setHeader('callback_id', self.xy_callback_id)
+        self.processor.send(message)  # 发送消息
+
+    def save_xy_progress(self, force=False):
+        """ 保存横移连拍进度，任务执行期间按照XY_PROGRESS_SAVE_INTERVAL的间隔保存 """
+        if self.tile_store is None or self.xy_body is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.xy_saved_at < config.XY_PROGRESS_SAVE_INTERVAL:
+            return
+        self.xy_saved_at = now
+        try:
+            self.tile_store.save(self.xy_body, self.tile_tracker)
+        except OSError as e:
+            logger.warning(f'Cannot save XY progress: {e}')
 
     def xy_acquire_callback(self, response: Message):
         code = response.get('code')
         message = response.get("message")
-        if code == '200':  # 任务成功执行
-            self.count_manager.count()
-            self.progress_signal.emit(self.count_manager.getPercentage())
-        elif code == '403':  # 任务被忽略
-            self.count_manager.countIgnored()
+        if code in ('200', '403', AGGREGATE_CODE):  # 任务成功执行、任务被忽略或者汇总响应，重复的区域不重复计数
+            done, ignored = self.tile_tracker.update(response)
+            self.count_manager.count(done)
+            self.count_manager.countIgnored(ignored)
+            self.ui_coalescer.post('progress', self.count_manager.getPercentage())
+            self.save_xy_progress(self.xy_stopped)  # 停止响应不会带出该任务尚未发出的汇总，之后到达的进度立即保存
         elif code == '400':  # 任务启动失败
             self.log_signal.emit(f'Submit task fail: {message}')
             self.status_signal.emit(Status.VANILLA)
@@ -418,18 +516,27 @@ class GUI(QWidget):
             self.log_signal.emit(f'Cannot stop task: {message}')
         elif code == '202':  # 停止任务成功
             self.log_signal.emit(f'{message}')
+            self.xy_stopped = True
+            self.save_xy_progress(True)
+        elif code == '503':  # 中间件繁忙，请求未被受理
+            self.log_signal.emit(f'Request rejected: {message}')
 
         if self.count_manager.isDone():  # 任务全部完成
-            self.progress_signal.emit(100)
+            self.ui_coalescer.post('progress', 100)
             self.log_signal.emit(f'Complete {self.count_manager.getDoneNum()} tasks')
+            self.save_xy_progress(True)  # 删除进度记录
+            self.processor.correlations.complete(self.xy_callback_id)  # 任务结束，不再接收该任务的响应
             self.status_signal.emit(Status.VANILLA)
         elif self.count_manager.isDoneWithPartIgnored():  # 部分任务被忽略
+            self.save_xy_progress(True)
             self.log_signal.emit(f'Complete {self.count_manager.getDoneNum()} tasks, '
-                                 f'left {self.count_manager.getLeftNum()} undone')
+                                 f'left {self.count_manager.getLeftNum()} undone, '
+                                 f'execute the same XY task again to resume')
+            self.processor.correlations.complete(self.xy_callback_id)
             self.status_signal.emit(Status.VANILLA)
 
     def sp_acquire(self):
-        self.progress_signal.emit(0)  # 清空进度条
+        self.ui_coalescer.post('progress', 0)  # 清空进度条
         # cam_name = self.components['camera_combo_box'].currentText()
         # cam_id = cam_name  # 相机id
         cam_id = 1
@@ -476,6 +583,8 @@ class GUI(QWidget):
         message.set('x_bin', x_bin)
         message.set('y_bin', y_bin)
         message.set('enable_optimize', 1 if enable_optimize else 0)  # 自动坐标修正
+        if config.SP_AGGREGATE_INTERVAL > 0:  # 由中间件汇总逐帧响应
+            message.setHeader(AGGREGATE_HEADER, config.SP_AGGREGATE_INTERVAL)
 
         if duration != -1:
             unit_str = ''
@@ -490,7 +599,11 @@ class GUI(QWidget):
             log_str = 'execute infinite task, task must be stop manually'
 
         self.print_log(log_str)
-        self.processor.send(message, self.sp_acquire_callback)
+        # 先注册回调并记录关联序号再发送，避免快速返回的终止响应在记录之前到达回调
+        self.sp_callback_id, _ = self.processor.correlations.register(self.sp_acquire_callback,
+                                                                      self.LAUNCH_TERMINAL_CODES)
+        message.setHeader('callback_id', self.sp_callback_id)
+        self.processor.send(message)  # 发送消息
 
     def sp_acquire_callback(self, response: Message):
         code = response.get('code')
@@ -505,21 +618,28 @@ class GUI(QWidget):
             left_num = self.count_manager.getLeftNum()
             if left_num > 0:
                 self.log_signal.emit(f'Undone task count: {left_num}')
+            self.processor.correlations.complete(self.sp_callback_id)  # 任务已停止，不再接收该任务的响应
             self.status_signal.emit(Status.VANILLA)
         elif code == '400':  # 任务无法启动
             self.log_signal.emit(f'Cannot launch task: {message}')
             self.status_signal.emit(Status.VANILLA)
         elif code == '401':  # 任务停止失败
             self.log_signal.emit(f'Cannot stop task: {message}')
+        elif code == '503':  # 中间件繁忙，请求未被受理
+            self.log_signal.emit(f'Request rejected: {message}')
 
         if self.count_manager.getTotalNum() > 0:  # 非永久任务
             if code == '200':  # 任务成功执行
                 self.count_manager.count()
-                self.progress_signal.emit(self.count_manager.getPercentage())
+                self.ui_coalescer.post('progress', self.count_manager.getPercentage())
+            elif code == AGGREGATE_CODE:  # 汇总响应，与逐帧响应一致仅统计完成帧数
+                self.count_manager.count(int(response.get('done')))
+                self.ui_coalescer.post('progress', self.count_manager.getPercentage())
 
             if self.count_manager.isDone():  # 任务全部完成
-                self.progress_signal.emit(100)
+                self.ui_coalescer.post('progress', 100)
                 self.log_signal.emit(f'Complete {self.count_manager.getDoneNum()} tasks')
+                self.processor.correlations.complete(self.sp_callback_id)
                 self.status_signal.emit(Status.VANILLA)
         else:  # 永久任务
             ...
@@ -578,16 +698,33 @@ class GUI(QWidget):
         """
         控制台输出方法，可以向GUI中的控制台输出信息
         """
-        # 通过菜单控制台打印日志输出
-        log_line = f'<span style="color:red">{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}:</span><br/><span style="color:black">{line}</span><br/>'
-        self.log_cache.append(log_line)
-        text = " ".join(self.log_cache)
-        self.components['program_output_text'].setText(text)
-        bottom = self.components['program_output_text'].verticalScrollBar().maximum()
-        self.components['program_output_text'].verticalScrollBar().setValue(bottom)  # 滚动到最底部
+        # 通过菜单控制台打印日志输出，由定时器合并刷新
+        self.log_buffer.append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), line)
+        if not self.log_timer.isActive():
+            self.log_timer.start()
+
+    def flush_log(self):
+        """ 将刷新间隔内的日志一次性追加到日志窗口，超出最大行数的最早日志由窗口自动移除 """
+        output = self.components['program_output_text']
+        output.setUpdatesEnabled(False)
+        for log_line in self.log_buffer.drain():
+            output.append(log_line)
+        output.setUpdatesEnabled(True)
+        bottom = output.verticalScrollBar().maximum()
+        output.verticalScrollBar().setValue(bottom)  # 滚动到最底部
+
+    def flush_ui(self):
+        """ 将刷新间隔内记录的最新进度和完成数一次性渲染到界面 """
+        pending = self.ui_coalescer.take()
+        if 'progress' in pending:
+            self.set_progress(pending['progress'])
+        if 'count' in pending:
+            self.setCompleteCount(pending['count'])
 
     @staticmethod
     def run():
+        logger.info(f'Launching frontend process by python')
+        QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling)  # 修正窗口界面尺寸，须在创建QApplication之前设置
         app = QApplication(sys.argv)
         menu = GUI()
         menu.show()
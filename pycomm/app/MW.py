@@ -5,56 +5,184 @@ Created on 2024.4.24
 主要是为后端提供socket连接适配，创建中间件线程接收前端数据，处理之后将数据转发到后端程序，
 """
 import cmd
+import collections
+import os
+import sys
+import threading
+import time
+from typing import Dict, List
+
 from loguru import logger
-from .comm import ServerSocketProcessor, DMProcessor
+
+from .comm import ServerSocketProcessor, AsyncServerSocketProcessor, DMProcessor, LatencyTracer, Properties
 from . import config
 
 
-class Properties:
+def loadConfig() -> Dict:
+    """ 读取后端配置文件，返回管道处理器的配置，在启动中间件时读取，导入模块不读取任何文件 """
+    logger.debug(f'Loading backend process config, path: {config.BE_CONFIG_PATH}')
+    prop = Properties(config.BE_CONFIG_PATH).get_prop()
+    logger.debug(f'Complete loading program config')
+    return {
+        'timeout': config.LISTEN_TIMEOUT,  # 超时时间，超时后会再次检查线程状态
+        'encoding': config.LISTEN_ENCODING,
+        'input_pip_path': prop['input_pip_path'],  # 输入管道文件
+        'input_pip_lock': prop['input_pip_lock'],  # 输入管道锁文件
+        'output_pip_path': prop['output_pip_path'],  # 输出管道文件
+        'output_pip_lock': prop['output_pip_lock'],  # 输出管道锁文件
+        'transport': prop.get('pip_transport', 'file'),  # 管道传输方式
+        'shm_capacity': int(prop.get('pip_shm_capacity', 1048576)),  # 共享内存环形缓冲区大小
+        'watch_mode': config.PIP_WATCH_MODE,
+        'batch_window': config.PIP_BATCH_WINDOW,
+        'batch_size': config.PIP_BATCH_SIZE,
+        'log_messages': config.PIP_LOG_MESSAGES,
+        'buffer_size': config.PIP_BUFFER_SIZE  # 中间件各级消息缓冲容量
+    }
+
+
+class Dashboard:
     """
-    Properties配置文件类
+    top风格的实时面板，每个刷新间隔采集一次各组件的计数器，按照两次采集之间的差值计算速率，
+    计数器均为单线程修改的整数，采集时不获取任何锁，中间件饱和时面板仍然可以刷新
     """
-    def __init__(self, file_name):
-        self.file_name = file_name
+    PIPLINES = ('RequestPipline', 'PipFileWriter', 'ResponsePipline')
 
-    def get_prop(self):
-        try:
-            pro_file = open(self.file_name, 'r', encoding='utf-8')
-            properties = {}
-            for line in pro_file:
-                if line.find('=') > 0:
-                    strs = line.replace('\n', '').split('=')
-                    properties[strs[0]] = strs[1]
-        except Exception as e:
-            raise e
-        else:
-            pro_file.close()
-        return properties
+    def __init__(self, socket_processor, dm_processor, interval: float = 1):
+        self.socket_processor = socket_processor
+        self.dm_processor = dm_processor
+        self.interval = interval  # 刷新间隔
+
+    def collect(self) -> Dict:
+        return {
+            'time': time.monotonic(),
+            'components': {**self.socket_processor.getPiplineStatistics(), **self.dm_processor.getStatistics()},
+            'connections': self.socket_processor.getStatistics(),
+        }
+
+    @staticmethod
+    def rate(current: Dict, previous: Dict, key: str, elapsed: float) -> float:
+        return (current.get(key, 0) - previous.get(key, 0)) / elapsed
+
+    def render(self, previous: Dict, current: Dict) -> List[str]:
+        """ 将两次采集的结果渲染为文本行 """
+        elapsed = max(current['time'] - previous['time'], 1e-6)
+        components, last_components = current['components'], previous['components']
+        writer, last_writer = components['PipFileWriter'], last_components['PipFileWriter']
+        reader, last_reader = components['PipFileReader'], last_components['PipFileReader']
+        batches = writer['batch_count'] - last_writer['batch_count']
+        records = writer['record_count'] - last_writer['record_count']
+        reads = reader['read_count'] - last_reader['read_count']
+        lines = reader['line_count'] - last_reader['line_count']
+        connections = current['connections']
+
+        rows = [f'{type(self.socket_processor).__name__} on {self.socket_processor.host}:{self.socket_processor.port}, '
+                f'{len(connections)} connections, refresh every {self.interval}s, press q to quit', '',
+                f'{"component":<18}{"depth":>8}{"high water":>12}{"capacity":>10}{"rejected":>10}{"blocked":>10}']
+        for name in self.PIPLINES:
+            item = components[name]
+            rows.append(f'{name:<18}{item["queue_depth"]:>8}{item["queue_high_water"]:>12}{item["queue_capacity"]:>10}'
+                        f'{item["rejected_puts"]:>10}{item["blocked_puts"]:>10}')
+        rows += ['', f'{"pipe":<18}{"msg/s":>10}{"batch/s":>10}{"avg batch":>11}{"max batch":>11}{"pending":>9}',
+                 f'{"write":<18}{records / elapsed:>10.1f}{batches / elapsed:>10.1f}'
+                 f'{records / batches if batches else 0:>11.1f}{writer["max_records_per_batch"]:>11}'
+                 f'{writer["pending_records"]:>9}',
+                 f'{"read":<18}{lines / elapsed:>10.1f}{reads / elapsed:>10.1f}{lines / reads if reads else 0:>11.1f}'
+                 f'{"":>11}{reader["stalled_reads"]:>9} stalled',
+                 '', f'{"address":<28}{"req/s":>9}{"resp/s":>9}{"requests":>10}{"responses":>11}{"queue":>7}'
+                     f'{"dropped":>9}']
+        last_connections = previous['connections']
+        for address, item in sorted(connections.items()):
+            last = last_connections.get(address, {})
+            rows.append(f'{address:<28}{self.rate(item, last, "request_count", elapsed):>9.1f}'
+                        f'{self.rate(item, last, "response_count", elapsed):>9.1f}{item["request_count"]:>10}'
+                        f'{item["response_count"]:>11}{item["queue_depth"]:>7}{item["dropped_frames"]:>9}')
+        return rows
+
+    def run(self, screen) -> None:
+        """ curses主循环，按q退出 """
+        import curses
+        curses.curs_set(0)
+        screen.timeout(int(self.interval * 1000))  # getch等待一个刷新间隔
+        previous = self.collect()
+        while screen.getch() not in (ord('q'), ord('Q')):
+            current = self.collect()
+            height, width = screen.getmaxyx()
+            screen.erase()
+            screen.redrawwin()  # 整屏重绘，覆盖期间输出到终端的日志
+            for row, line in enumerate(self.render(previous, current)[:height]):
+                try:
+                    screen.addnstr(row, 0, line, width - 1)
+                except curses.error:  # 终端尺寸过小
+                    pass
+            screen.refresh()
+            previous = current
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    采样分析器，在独立线程中按照固定频率通过sys._current_frames()读取所有存活线程的调用栈，
+    以线程类名（普通线程为线程名）作为栈底，同类线程合并统计，输出flamegraph.pl所采用的折叠栈格式，
+    采样期间中间件各线程照常运行，不需要重启
+    """
 
+    def __init__(self, duration: float, rate: float = 100, excluded=()):
+        super().__init__(name='SamplingProfiler', daemon=True)
+        self.duration = duration  # 采样时长
+        self.interval = 1 / rate  # 采样间隔
+        self.excluded = set(excluded)  # 不采样的线程，例如等待采样结果的命令行线程
+        self.stacks = collections.Counter()  # 折叠栈 -> 采样次数
+        self.sample_count = 0  # 采样轮数
+        self.elapsed = 0  # 实际采样时长
 
-logger.info(f'Launching MQ process by python')
-logger.debug(f'Loading backend process config, path: {config.BE_CONFIG_PATH}')
-prop = Properties(config.BE_CONFIG_PATH).get_prop()
-logger.debug(f'Complete loading program config')
+    @staticmethod
+    def describe(thread: threading.Thread) -> str:
+        return thread.name if type(thread) is threading.Thread else type(thread).__name__
 
-input_pip_path = prop['input_pip_path']  # 输入管道文件
-input_pip_lock = prop['input_pip_lock']  # 输入管道锁文件
-output_pip_path = prop['output_pip_path']  # 输出管道文件
-output_pip_lock = prop['output_pip_lock']  # 输出管道锁文件
+    @staticmethod
+    def collapse(frame) -> str:
+        """ 将调用栈转换为从外层到内层、分号分隔的帧序列 """
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
 
-encoding = config.LISTEN_ENCODING  # 编码格式
-host = config.LISTEN_HOST  # 中间件绑定ip地址
-port = config.LISTEN_PORT  # 中间件绑定端口
-timeout = config.LISTEN_TIMEOUT  # 超时时间，超时后会再次检查线程状态
+    def run(self) -> None:
+        excluded = self.excluded | {threading.get_ident()}
+        begin = time.perf_counter()
+        deadline = begin + self.duration
+        next_sample = begin
+        while next_sample < deadline:
+            names = {thread.ident: self.describe(thread) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident not in excluded:
+                    self.stacks[f'{names.get(ident, ident)};{self.collapse(frame)}'] += 1
+            self.sample_count += 1
+            next_sample += self.interval
+            time.sleep(max(0.0, next_sample - time.perf_counter()))
+        self.elapsed = time.perf_counter() - begin
 
-dm_config = {
-    'timeout': timeout,
-    'encoding': encoding,
-    'input_pip_path': input_pip_path,
-    'input_pip_lock': input_pip_lock,
-    'output_pip_path': output_pip_path,
-    'output_pip_lock': output_pip_lock
-}
+    def write(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+    def getSummary(self) -> List[str]:
+        """ 每个线程的采样数，以及采样次数最多的栈顶帧 """
+        threads, leaves = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            threads[frames[0]] += count
+            leaves[f'{frames[0]}: {frames[-1]}'] += count
+        rate = self.sample_count / max(self.elapsed, 1e-6)
+        lines = [f'{self.sample_count} samples in {self.elapsed:.2f}s ({rate:.0f}/s)',
+                 f'{"thread":<32}{"samples":>10}']
+        lines += [f'{thread:<32}{count:>10}' for thread, count in threads.most_common()]
+        lines += ['', f'{"top frames":<80}{"samples":>10}']
+        lines += [f'{leaf:<80}{count:>10}' for leaf, count in leaves.most_common(10)]
+        return lines
 
 
 class CMD(cmd.Cmd):
@@ -64,11 +192,28 @@ class CMD(cmd.Cmd):
         cmd.Cmd.__init__(self)
         self.socket_processor = None  # Socket服务端处理器
         self.dm_processor = None
+        self.tracer = LatencyTracer(config.LISTEN_TRACE)  # 逐跳延迟追踪，重启后继续累计
         self.simpleLaunch()
 
     def simpleLaunch(self):
-        self.socket_processor = ServerSocketProcessor(host, port, timeout, encoding)  # Socket服务端处理器
-        self.dm_processor = DMProcessor(**dm_config)
+        server_config = (
+            config.LISTEN_HOST,  # 中间件绑定ip地址
+            config.LISTEN_PORT,  # 中间件绑定端口
+            config.LISTEN_TIMEOUT,  # 超时时间，超时后会再次检查线程状态
+            config.LISTEN_ENCODING,  # 编码格式
+            config.LISTEN_CODECS,  # 消息编码格式
+            config.LISTEN_FLUSH_INTERVAL,  # 响应合并写出窗口
+            config.LISTEN_QUEUE_SIZE,  # 每个前端连接的待写出队列容量
+            config.LISTEN_SLOW_POLICY,  # 待写出队列已满时的处理策略
+            config.PIP_BUFFER_SIZE,  # 中间件各级消息缓冲容量
+            config.LISTEN_AGGREGATE_INTERVAL,  # 逐帧响应的默认汇总间隔
+            self.tracer
+        )
+        if config.LISTEN_MODE == 'asyncio':  # 所有连接共用一个事件循环线程
+            self.socket_processor = AsyncServerSocketProcessor(*server_config)
+        else:
+            self.socket_processor = ServerSocketProcessor(*server_config)  # Socket服务端处理器
+        self.dm_processor = DMProcessor(**loadConfig(), tracer=self.tracer)
 
         self.socket_processor.linkTo(self.dm_processor.getNode())  # 服务端请求连接到DM进程
         self.dm_processor.linkTo(self.socket_processor.getNode())  # DM进程响应连接到服务端
@@ -80,6 +225,75 @@ class CMD(cmd.Cmd):
         self.socket_processor.terminate(True)
         self.dm_processor.terminate(True)
 
+    def do_queues(self, line):
+        """ 查看每个前端连接的待写出队列深度、最大深度以及丢弃的帧数 """
+        print(f'{"address":<28}{"depth":>8}{"high water":>12}{"dropped":>10}{"blocked":>10}')
+        for address, statistics in self.socket_processor.getStatistics().items():
+            print(f'{address:<28}{statistics["queue_depth"]:>8}{statistics["queue_high_water"]:>12}'
+                  f'{statistics["dropped_frames"]:>10}{statistics["blocked_puts"]:>10}')
+
+    def do_buffers(self, line):
+        """ 查看请求管道、管道写线程以及响应管道的缓冲深度、最大深度以及拒绝的请求数 """
+        statistics = {**self.socket_processor.getPiplineStatistics(), **self.dm_processor.getStatistics()}
+        print(f'{"component":<18}{"depth":>8}{"high water":>12}{"capacity":>10}{"rejected":>10}{"blocked":>10}')
+        for name in ('RequestPipline', 'PipFileWriter', 'ResponsePipline'):
+            item = statistics[name]
+            print(f'{name:<18}{item["queue_depth"]:>8}{item["queue_high_water"]:>12}{item["queue_capacity"]:>10}'
+                  f'{item["rejected_puts"]:>10}{item["blocked_puts"]:>10}')
+        print(f'PipFileReader stalled {statistics["PipFileReader"]["stalled_reads"]} times, '
+              f'{statistics["PipFileWriter"]["pending_records"]} records waiting for backend')
+        aggregator = statistics['ProgressAggregator']
+        print(f'ProgressAggregator merged {aggregator["aggregated_frames"]} frames into {aggregator["summaries"]} '
+              f'summaries, {aggregator["aggregating"]} requests aggregating')
+
+    def do_trace(self, line):
+        """ 启用或者停用逐跳延迟追踪: trace on|off """
+        if line.strip() == 'on' and not self.tracer.enabled:
+            self.tracer.reset()  # 每秒消息数从启用时开始计算
+            self.tracer.enabled = True
+        elif line.strip() == 'off':
+            self.tracer.enabled = False
+        print(f'tracing {"enabled" if self.tracer.enabled else "disabled"}')
+
+    def do_stats(self, line):
+        """ 查看各阶段延迟的p50/p95/p99以及每秒消息数，stats reset清空统计 """
+        if line.strip() == 'reset':
+            self.tracer.reset()
+            return
+        if not self.tracer.enabled:
+            print("tracing disabled, input 'trace on' to enable")
+        print(f'{"stage":<12}{"count":>10}{"msg/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+        for stage, item in self.tracer.getStatistics().items():
+            print(f'{stage:<12}{item["count"]:>10}{item["per_sec"]:>10.1f}{item["p50_ms"]:>10.3f}'
+                  f'{item["p95_ms"]:>10.3f}{item["p99_ms"]:>10.3f}')
+
+    def do_top(self, line):
+        """ 实时查看连接、各级缓冲深度、管道批大小以及每个前端的请求和响应速率，按q返回命令行 """
+        try:
+            import curses  # Windows需要额外安装windows-curses
+        except ImportError:
+            print('curses is not available, install windows-curses on Windows')
+            return
+        curses.wrapper(Dashboard(self.socket_processor, self.dm_processor, config.LISTEN_TOP_INTERVAL).run)
+
+    def do_profile(self, line):
+        """ 对中间件所有线程采样，输出折叠栈文件用于生成火焰图: profile <秒数> [输出路径] """
+        arguments = line.split()
+        try:
+            duration = float(arguments[0])
+        except (IndexError, ValueError):
+            print('usage: profile <seconds> [output.folded]')
+            return
+        path = arguments[1] if len(arguments) > 1 else \
+            os.path.join(config.LISTEN_PROFILE_DIR, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+        profiler = SamplingProfiler(duration, config.LISTEN_PROFILE_RATE, (threading.get_ident(),))
+        print(f'Sampling all threads at {config.LISTEN_PROFILE_RATE}/s for {duration}s')
+        profiler.start()
+        profiler.join()
+        profiler.write(path)
+        print('\n'.join(profiler.getSummary()))
+        print(f'Collapsed stacks written to {path}')
+
     def do_restart(self, line):
         """ 重新启动中间件 """
         self.simpleQuit()
@@ -98,5 +312,6 @@ class CMD(cmd.Cmd):
 
     @staticmethod
     def run():
+        logger.info(f'Launching MQ process by python')
         CMD().cmdloop("Successfully launch Middleware for DM Script, input 'help' for available command.")
 
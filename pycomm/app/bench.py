@@ -0,0 +1,928 @@
+"""
+Created on 2024.5.20
+@author: Pineclone
+性能基准测试，用于比较通讯模块各个实现之间的吞吐量差异，
+返回统计结果的测试会被汇总为JSON，可以与上一次保存的结果（基线）进行比较，追踪各个版本之间的性能回退
+"""
+import asyncio
+import json
+import os
+import platform
+import queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from loguru import logger
+
+from .comm import Message, CODECS, FrameReader, FrameWriter, OutboundQueue, TextCodec, decodeMessage, PipComponent, \
+    ClientSocketProcessor, ServerSocketProcessor, AsyncServerSocketProcessor, DMProcessor, CorrelationTable, \
+    TERMINAL_CODES, AsyncClient, AGGREGATE_HEADER, MessageBuffer
+from .transport import LockFileWatcher, TRANSPORTS, createChannels
+
+BENCHMARKS: Dict[str, Callable[[], Dict or None]] = {}  # 基准测试注册表，名称->测试函数，测试函数可以返回统计结果
+
+
+def benchmark(name: str):
+    """ 注册基准测试 """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def sampleMessages():
+    """ 构造典型消息：拍摄请求，以及逐帧的拍摄响应 """
+    request = Message()
+    request.setHeader('address', ('127.0.0.1', 52188))
+    request.setHeader('callback_id', 'f3b2a7d4-6c1e-4a53-9d1a-2c3b9a5e7f10')
+    for key, val in (('name', 'ContinuousAcquire'), ('option', 1), ('cam_id', 1), ('pos_top', 0), ('pos_left', 0),
+                     ('pos_bottom', 512), ('pos_right', 512), ('duration', 3600), ('framerate', 30),
+                     ('exposure', 1), ('x_bin', 1), ('y_bin', 1), ('enable_optimize', 1)):
+        request.set(key, val)
+
+    response = Message()
+    response.setHeader('address', ('127.0.0.1', 52188))
+    response.setHeader('callback_id', 'f3b2a7d4-6c1e-4a53-9d1a-2c3b9a5e7f10')
+    response.set('code', 200)
+    response.set('message', 'Done')
+    response.set('timestamp', time.time())
+    return {'request': request, 'response': response}
+
+
+def percentile(samples, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summarize(name: str, samples: List[float], operations: int = 1) -> Dict:
+    """
+    汇总一组耗时样本并打印
+    :param samples: 每个样本的耗时，单位为秒
+    :param operations: 每个样本包含的操作数，统计结果按单次操作折算
+    :return: 每秒操作数以及单次操作耗时的p50、p90、p99、最大值，单位为微秒
+    """
+    per_operation = [sample / operations * 1e6 for sample in samples]
+    result = {
+        'ops_per_sec': len(samples) * operations / sum(samples),
+        'p50_us': percentile(per_operation, 50),
+        'p90_us': percentile(per_operation, 90),
+        'p99_us': percentile(per_operation, 99),
+        'max_us': max(per_operation),
+        'samples': len(samples),
+    }
+    print(f'{name:<24}{result["ops_per_sec"]:>14,.0f}{result["p50_us"]:>12.2f}{result["p90_us"]:>12.2f}'
+          f'{result["p99_us"]:>12.2f}{result["max_us"]:>12.2f}')
+    return result
+
+
+def printSummaryHeader():
+    print(f'{"metric":<24}{"ops/s":>14}{"p50 us":>12}{"p90 us":>12}{"p99 us":>12}{"max us":>12}')
+
+
+def sample(func: Callable[[], None], operations: int, repeat: int) -> List[float]:
+    """ 重复执行repeat轮，每轮调用func共operations次，返回每轮的耗时 """
+    samples = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        for _ in range(operations):
+            func()
+        samples.append(time.perf_counter() - begin)
+    return samples
+
+
+def createPipConfig(directory: str) -> Dict:
+    """ 在临时目录中创建文件管道以及锁文件，模拟后端进程启动之后的状态 """
+    config = {'timeout': 0.5, 'encoding': 'gbk', 'transport': 'file', 'watch_mode': 'auto'}
+    for side in ('in', 'out'):
+        config[f'{side}put_pip_path'] = os.path.join(directory, f'dm_{side}.pip')
+        config[f'{side}put_pip_lock'] = os.path.join(directory, f'dm_{side}.lock')
+    for key in ('input_pip_path', 'input_pip_lock', 'output_pip_path', 'output_pip_lock'):
+        open(config[key], 'w').close()
+    return config
+
+
+@benchmark('message')
+def benchMessage(operations: int = 1000, repeat: int = 50) -> Dict:
+    """ 文本格式消息的序列化与反序列化 """
+    printSummaryHeader()
+    results = {}
+    for message_name, message in sampleMessages().items():
+        line = Message.dumps(message)
+        results[f'dumps_{message_name}'] = summarize(f'dumps {message_name}', sample(
+            lambda: Message.dumps(message), operations, repeat), operations)
+        results[f'loads_{message_name}'] = summarize(f'loads {message_name}', sample(
+            lambda: Message.loads(line), operations, repeat), operations)
+    return results
+
+
+@benchmark('handoff')
+def benchHandoff(messages: int = 50000, batch: int = 500) -> Dict:
+    """ 管道组件之间的消息交接：生产者投递消息，组件线程取出后写入下游队列，统计吞吐量以及单条消息的交接延迟 """
+    component, sink = PipComponent(0.5), queue.Queue()
+    component.link(sink)
+    component.start()
+    message = sampleMessages()['response']
+    latencies, batches = [], []
+    for _ in range(messages // batch):
+        begin = time.perf_counter()
+        for _ in range(batch):
+            component.postMessage(message)
+        for _ in range(batch):
+            sink.get()
+        batches.append(time.perf_counter() - begin)
+
+        posted = time.perf_counter()  # 单条消息的交接延迟
+        component.postMessage(message)
+        sink.get()
+        latencies.append(time.perf_counter() - posted)
+    component.terminate()
+    component.join()
+
+    printSummaryHeader()
+    return {'throughput': summarize('handoff batch', batches, batch), 'latency': summarize('handoff single', latencies)}
+
+
+@benchmark('drain')
+def benchDrain(messages: int = 100000, batch_sizes=(1, 16, 256)) -> Dict:
+    """ 管道组件批量取出：生产者逐条投递消息，组件每次加锁取出至多batch_size条并整批写入下游缓冲，比较吞吐量 """
+    message = sampleMessages()['response']
+    results = {}
+    print(f'{"batch size":<12}{"msg/s":>12}')
+    for batch_size in batch_sizes:
+        component, sink = PipComponent(0.5, batch_size=batch_size), PipComponent(0.5)
+        component.link(sink)
+        component.start()
+        begin = time.perf_counter()
+        for _ in range(messages):
+            component.postMessage(message)
+        received = 0
+        while received < messages:
+            received += len(sink.input_buffer.getBatch(messages, 3))
+        elapsed = time.perf_counter() - begin
+        component.terminate()
+        component.join()
+        results[f'batch_{batch_size}'] = {'ops_per_sec': messages / elapsed}
+        print(f'{batch_size:<12}{messages / elapsed:>12,.0f}')
+    return results
+
+
+@benchmark('correlation')
+def benchCorrelation(operations: int = 1000, repeat: int = 50) -> Dict:
+    """ 请求关联：注册回调、收到一条进度响应以及最终响应，比较原先的uuid4字典（从不移除）与关联表 """
+    progress, terminal = Message(), Message()
+    progress.set('code', '300')
+    terminal.set('code', '201')
+    callbacks = {}
+
+    def legacy():
+        callback_id = str(uuid.uuid4())
+        callbacks[callback_id] = str
+        callbacks.get(callback_id)(progress)
+        callbacks.get(callback_id)(terminal)
+
+    table = CorrelationTable()
+
+    def correlate():
+        callback_id, _ = table.register(str, TERMINAL_CODES)
+        table.dispatch(callback_id, progress)
+        table.dispatch(callback_id, terminal)
+
+    printSummaryHeader()
+    results = {'legacy': summarize('uuid4 dict', sample(legacy, operations, repeat), operations),
+               'table': summarize('correlation table', sample(correlate, operations, repeat), operations)}
+    print(f'callbacks left: uuid4 dict {len(callbacks)}, correlation table {table.getStatistics()["in_flight"]}')
+    return results
+
+
+@benchmark('roundtrip')
+def benchRoundTrip(rounds: int = 2000) -> Dict:
+    """ 客户端经回环中间件（请求管道直接连接响应管道）的请求往返延迟，逐条发送，收到响应之后再发送下一条 """
+    logger.disable('app')
+    processor = ServerSocketProcessor('127.0.0.1', 0, 0.5, 'utf-8')
+    processor.linkTo(processor.getNode())  # 回环
+    processor.launch()
+    client = ClientSocketProcessor('127.0.0.1', processor.connection_builder.server.getsockname()[1], 0.5)
+    client.launch()
+
+    received = threading.Event()
+    request = sampleMessages()['request']
+    samples = []
+    for _ in range(rounds):
+        received.clear()
+        begin = time.perf_counter()
+        client.send(request, lambda response: received.set())
+        received.wait(3)
+        samples.append(time.perf_counter() - begin)
+        client.correlations.complete(request.getHeader('callback_id'))  # 回环响应不携带终止响应码，显式完成
+    client.terminate(True)
+    processor.terminate(True)
+    logger.enable('app')
+
+    printSummaryHeader()
+    return {'rtt': summarize('proxy round trip', samples)}
+
+
+@benchmark('pipwriter')
+def benchPipWriter(operations: int = 200, repeat: int = 20) -> Dict:
+    """ 文件管道写出：锁文件存在时调用PipFileWriter.onHandling写出一条请求，随后模拟后端读取之后重新创建锁文件 """
+    request = sampleMessages()['request']
+    with tempfile.TemporaryDirectory() as directory:
+        config = createPipConfig(directory)
+        processor = DMProcessor(**config)
+
+        def cycle():
+            processor.pip_writer.onHandling(request)
+            open(config['input_pip_path'], 'w').close()  # 后端清空管道并重新创建锁文件
+            open(config['input_pip_lock'], 'w').close()
+
+        samples = sample(cycle, operations, repeat)
+        processor.input_channel.close()
+        processor.output_channel.close()
+
+    printSummaryHeader()
+    return {'cycle': summarize('pip write cycle', samples, operations)}
+
+
+@benchmark('groupcommit')
+def benchGroupCommit(requests: int = 20000, batch_windows=(0, 0.002)) -> Dict:
+    """
+    文件管道组提交：持续向PipFileWriter投递请求，模拟后端按照锁文件协议读取，
+    统计不同组提交窗口下的吞吐量、每批记录数以及每批从取得第一条请求到写出完成的耗时
+    """
+    request = sampleMessages()['request']
+    results = {}
+    print(f'{"batch window":<14}{"msg/s":>12}{"batches":>10}{"records/batch":>15}{"p50 ms":>10}{"p99 ms":>10}')
+    for batch_window in batch_windows:
+        with tempfile.TemporaryDirectory() as directory:
+            config = createPipConfig(directory)
+            backend, _ = createChannels(config, 'backend')  # 后端一侧的输入通道
+            processor = DMProcessor(**config, batch_window=batch_window)
+            writer = processor.pip_writer
+            writer.start()
+            received = 0
+            begin = time.perf_counter()
+            for _ in range(requests):
+                writer.postMessage(request)
+            while received < requests and time.perf_counter() - begin < 30:
+                received += len(backend.read(0.5))
+            elapsed = time.perf_counter() - begin
+            writer.terminate()
+            writer.join()
+            backend.close()
+            processor.output_channel.close()
+
+        statistics = writer.getStatistics()
+        results[f'window_{batch_window * 1000:g}ms'] = {
+            'ops_per_sec': received / elapsed, 'batches': statistics['batch_count'],
+            'records_per_batch': statistics['records_per_batch'],
+            'p50_us': statistics['batch_latency_p50_ms'] * 1000, 'p99_us': statistics['batch_latency_p99_ms'] * 1000}
+        print(f'{batch_window * 1000:>10.1f} ms{received / elapsed:>12,.0f}{statistics["batch_count"]:>10}'
+              f'{statistics["records_per_batch"]:>15.1f}{statistics["batch_latency_p50_ms"]:>10.2f}'
+              f'{statistics["batch_latency_p99_ms"]:>10.2f}')
+    return results
+
+
+@benchmark('pipreader')
+def benchPipReader(cycles: int = 100, batch_sizes=(1, 100, 10000)) -> Dict:
+    """ 文件管道读取：后端追加写入一批响应并删除锁文件，统计PipFileReader读取、清空并重新创建锁文件的整个周期 """
+    line = Message.dumps(sampleMessages()['response']) + '\n'
+    results = {}
+    printSummaryHeader()
+    for batch in batch_sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            config = createPipConfig(directory)
+            processor = DMProcessor(**config)
+            sink = PipComponent(0.5)
+            processor.linkTo(sink)
+            processor.pip_reader.start()
+            samples = []
+            for _ in range(max(5, cycles // batch)):
+                with open(config['output_pip_path'], 'a', encoding='gbk') as pip:
+                    pip.write(line * batch)
+                begin = time.perf_counter()
+                os.remove(config['output_pip_lock'])
+                count = 0
+                while count < batch:
+                    count += len(sink.input_buffer.get(timeout=3))
+                while not os.path.exists(config['output_pip_lock']):  # 等待锁文件重新创建
+                    time.sleep(0)
+                samples.append(time.perf_counter() - begin)
+            processor.pip_reader.terminate()
+            processor.pip_reader.join()
+            processor.input_channel.close()
+        results[f'cycle_{batch}'] = summarize(f'pip read cycle x{batch}', samples, batch)
+    return results
+
+
+@benchmark('pipdecode')
+def benchPipDecode(batch: int = 10000, cycles: int = 10) -> Dict:
+    """
+    输出管道单批10k条响应的读取周期，比较原先逐行解析、逐条投递并输出调试日志、分三次打开文件的读取方式，
+    与当前一次读取、同一句柄清空、整批解析并一次投递的读取方式
+    """
+    line = Message.dumps(sampleMessages()['response']) + '\n'
+
+    def legacy(config: Dict, sink: PipComponent):  # 原PipFileReader读取锁文件删除之后的处理
+        read_pip = open(config['output_pip_path'], 'r', encoding='gbk')
+        for record in read_pip:
+            message = Message.loads(record.strip())
+            logger.debug(f"line from output pip : {message}")
+            sink.postMessage(message)
+        read_pip.close()
+        open(config['output_pip_path'], 'w', encoding='gbk').close()
+        open(config['output_pip_lock'], 'w', encoding='gbk').close()
+
+    def current(channel, sink: PipComponent):
+        sink.postMessages(Message.loadsBatch(channel.read(0)))
+
+    logger.disable('app')  # 日志被禁用时f-string仍然会被求值
+    results = {}
+    printSummaryHeader()
+    for name in ('legacy', 'current'):
+        with tempfile.TemporaryDirectory() as directory:
+            config = createPipConfig(directory)
+            _, channel = createChannels(config, 'middleware')
+            sink = PipComponent()
+            samples = []
+            for _ in range(cycles):
+                with open(config['output_pip_path'], 'a', encoding='gbk') as pip:
+                    pip.write(line * batch)
+                os.remove(config['output_pip_lock'])
+                begin = time.perf_counter()
+                legacy(config, sink) if name == 'legacy' else current(channel, sink)
+                samples.append(time.perf_counter() - begin)
+                sink.input_buffer = MessageBuffer()  # 清空已投递的消息
+            channel.close()
+        results[name] = summarize(f'{name} x{batch}', samples, batch)
+    logger.enable('app')
+    return results
+
+
+@benchmark('slowconsumer')
+def benchSlowConsumer(responses: int = 20000, queue_size: int = 1024, payload: int = 4096):
+    """
+    一个前端停止接收响应，另一个前端正常接收，响应管道交替向两者投递逐帧响应（附带payload字节的数据，使停止接收的连接
+    很快填满套接字缓冲区），投递速度与正常前端的接收速度保持一致，
+    比较各个服务端模式以及处理策略下正常前端的接收吞吐量，以及停止接收的前端的待写出队列
+    """
+    response = sampleMessages()['response']
+    response.set('data', 'x' * payload)
+    logger.disable('app')
+    print(f'{"mode":<10}{"policy":<12}{"fast msg/s":>12}{"received":>10}{"slow depth":>12}{"high water":>12}'
+          f'{"dropped":>9}')
+    for mode, processor_class in (('thread', ServerSocketProcessor), ('asyncio', AsyncServerSocketProcessor)):
+        for policy in OutboundQueue.policies:
+            processor = processor_class('127.0.0.1', 0, 0.5, 'utf-8', flush_interval=0.001, queue_size=queue_size,
+                                        slow_policy=policy)
+            processor.launch()
+            port = processor.connection_builder.server.getsockname()[1]
+            slow = socket.socket()
+            slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            slow.connect(('127.0.0.1', port))  # 从不读取
+            fast = socket.create_connection(('127.0.0.1', port))
+            received = []
+
+            def receive():
+                reader = FrameReader(fast)
+                try:
+                    while reader.fill():
+                        received.append(sum(1 for _ in reader.frames()))
+                except OSError:  # 测试结束时连接被关闭
+                    pass
+
+            thread = threading.Thread(target=receive, daemon=True)
+            thread.start()
+            time.sleep(0.3)  # 等待服务端完成连接的接收
+            addresses = [str(sock.getsockname()) for sock in (fast, slow)]
+            begin = time.perf_counter()
+            deadline = begin + 5
+            for index in range(responses):
+                message = Message()
+                message.head = {'address': addresses[index % 2]}
+                message.body = response.body
+                processor.getNode().postMessage(message)
+                while index // 2 - sum(received) > queue_size // 2 and time.perf_counter() < deadline:
+                    time.sleep(0.001)  # 等待正常前端接收
+            while sum(received) < responses // 2 + 1 and time.perf_counter() < deadline:  # 包含编码格式提议
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - begin
+            statistics = processor.getStatistics().get(addresses[1], {})
+            print(f'{mode:<10}{policy:<12}{(sum(received) - 1) / elapsed:>12,.0f}{sum(received) - 1:>10}'
+                  f'{statistics.get("queue_depth", "closed"):>12}{statistics.get("queue_high_water", "-"):>12}'
+                  f'{statistics.get("dropped_frames", "-"):>9}')
+            slow.close()  # 关闭连接，唤醒阻塞的响应管道
+            fast.close()
+            processor.terminate(True)
+    logger.enable('app')
+
+
+@benchmark('overload')
+def benchOverload(requests: int = 20000, buffer_sizes=(0, 1024)):
+    """
+    后端停止读取输入管道时，一个前端持续提交请求，比较不限制容量与有界缓冲下各级缓冲的最大深度以及繁忙响应数，
+    随后后端恢复读取，检查所有被受理的请求都能够到达后端
+    """
+    request = sampleMessages()['request']
+    logger.disable('app')
+    print(f'{"buffer size":<13}{"accepted":>10}{"busy":>8}{"request hw":>12}{"writer hw":>11}{"cached":>8}'
+          f'{"delivered":>11}')
+    for buffer_size in buffer_sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            config = createPipConfig(directory)
+            backend, _ = createChannels(config, 'backend')
+            os.remove(config['input_pip_lock'])  # 后端尚未读取上一批请求
+            server = ServerSocketProcessor('127.0.0.1', 0, 0.5, 'utf-8', buffer_size=buffer_size)
+            processor = DMProcessor(**config, buffer_size=buffer_size)
+            server.linkTo(processor.getNode())
+            processor.linkTo(server.getNode())
+            server.launch()
+            processor.launch()
+            client = socket.create_connection(('127.0.0.1', server.connection_builder.server.getsockname()[1]))
+            busy = []
+
+            def receive():
+                reader = FrameReader(client)
+                try:
+                    while reader.fill():
+                        busy.extend(1 for frame in reader.frames()
+                                    if decodeMessage(frame, 'utf-8').get('code') == '503')
+                except OSError:  # 测试结束时连接被关闭
+                    pass
+
+            threading.Thread(target=receive, daemon=True).start()
+            data = TextCodec.encode(request, 'utf-8')
+            frame = len(data).to_bytes(4, byteorder='big') + data
+            for _ in range(requests // 100):
+                client.sendall(frame * 100)
+            deadline = time.perf_counter() + 10
+            previous = -1
+            while time.perf_counter() < deadline:  # 等待请求全部进入缓冲或者被拒绝
+                current = len(busy) + server.request_pipline.input_buffer.qsize() + \
+                          processor.pip_writer.input_buffer.qsize()
+                if current == previous:
+                    break
+                previous = current
+                time.sleep(0.2)
+            pipline = server.getPiplineStatistics()['RequestPipline']
+            writer = processor.pip_writer.getStatistics()
+            accepted = requests - len(busy)
+
+            open(config['input_pip_lock'], 'w').close()  # 后端恢复读取
+            delivered = 0
+            while delivered < accepted and time.perf_counter() < deadline + 10:
+                delivered += len(backend.read(0.5))
+            print(f'{buffer_size:<13}{accepted:>10}{len(busy):>8}{pipline["queue_high_water"]:>12}'
+                  f'{writer["queue_high_water"]:>11}{writer["pending_records"]:>8}{delivered:>11}')
+            client.close()
+            server.terminate(True)
+            processor.terminate(True)
+            backend.close()
+    logger.enable('app')
+
+
+@benchmark('codec')
+def benchCodec(rounds: int = 50000):
+    """ 比较各个编码格式的编解码吞吐量以及单条消息字节数 """
+    print(f'{"codec":<8}{"message":<10}{"bytes":>8}{"encode msg/s":>16}{"decode msg/s":>16}')
+    for message_name, message in sampleMessages().items():
+        for name, codec in CODECS.items():
+            begin = time.perf_counter()
+            for _ in range(rounds):
+                data = codec.encode(message, 'utf-8')
+            encode_rate = rounds / (time.perf_counter() - begin)
+
+            begin = time.perf_counter()
+            for _ in range(rounds):
+                decoded = decodeMessage(data, 'utf-8')
+            decode_rate = rounds / (time.perf_counter() - begin)
+
+            assert decoded.head == message.head and decoded.body == message.body, f'{name} codec is not lossless'
+            print(f'{name:<8}{message_name:<10}{len(data):>8}{encode_rate:>16,.0f}{decode_rate:>16,.0f}')
+
+
+@benchmark('framing')
+def benchFraming(bursts: int = 200, burst_size: int = 500):
+    """ 模拟逐帧响应的突发流量，统计帧读取器的吞吐量以及单次读取解析得到的帧数 """
+    data = TextCodec.encode(sampleMessages()['response'], 'utf-8')
+    frame = len(data).to_bytes(4, byteorder='big') + data
+    burst = frame * burst_size
+    sender, receiver = socket.socketpair()
+
+    def send():
+        for _ in range(bursts):
+            sender.sendall(burst)
+        sender.close()
+
+    thread = threading.Thread(target=send)
+    reader = FrameReader(receiver)
+    begin = time.perf_counter()
+    thread.start()
+    while reader.fill():
+        for payload in reader.frames():
+            decodeMessage(payload, 'utf-8')
+    elapsed = time.perf_counter() - begin
+    thread.join()
+    receiver.close()
+
+    statistics = reader.getStatistics()
+    print(f'frames: {statistics["frame_count"]}, msg/s: {statistics["frame_count"] / elapsed:,.0f}, '
+          f'recv calls: {statistics["recv_count"]} (legacy loop: {2 * statistics["frame_count"]}), '
+          f'frames/recv: {statistics["frames_per_recv"]:.1f}, max frames/recv: {statistics["max_frames_per_recv"]}')
+
+
+@benchmark('coalescing')
+def benchCoalescing(frames: int = 100000, flush_intervals=(0, 0.001, 0.005)):
+    """ 比较不同合并窗口下写出逐帧响应所需的系统调用次数以及吞吐量 """
+    data = TextCodec.encode(sampleMessages()['response'], 'utf-8')
+    print(f'{"flush window":<14}{"msg/s":>12}{"writes":>10}{"frames/write":>14}{"max frames/write":>18}')
+    for flush_interval in flush_intervals:
+        sender, receiver = socket.socketpair()
+        received = []
+
+        def receive():
+            reader = FrameReader(receiver)
+            while reader.fill():
+                received.append(sum(1 for _ in reader.frames()))
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        writer = FrameWriter(sender, flush_interval)
+        begin = time.perf_counter()
+        for _ in range(frames):
+            writer.put(data)
+        writer.close()
+        sender.close()
+        thread.join()
+        elapsed = time.perf_counter() - begin
+        receiver.close()
+
+        assert sum(received) == frames, 'frames lost while coalescing'
+        statistics = writer.getStatistics()
+        print(f'{flush_interval * 1000:>10.1f} ms{frames / elapsed:>12,.0f}{statistics["write_count"]:>10}'
+              f'{statistics["frames_per_write"]:>14.1f}{statistics["max_frames_per_write"]:>18}')
+
+
+@benchmark('clients')
+def benchClients(clients: int = 300, rounds: int = 20):
+    """
+    大量前端同时连接回环中间件（请求管道直接连接响应管道），比较两种服务端模式的线程数以及往返吞吐量，
+    客户端以协程的形式运行在主线程中，不额外占用线程
+    """
+    request = sampleMessages()['request']
+
+    async def client(port: int, connected: asyncio.Event, started: asyncio.Event, ready: list):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        ready.append(writer)
+        if len(ready) == clients:
+            connected.set()
+        await started.wait()
+        data = TextCodec.encode(request, 'utf-8')
+        for _ in range(rounds):
+            writer.write(len(data).to_bytes(4, byteorder='big') + data)
+            while True:  # 跳过编码格式提议
+                length = int.from_bytes(await reader.readexactly(4), byteorder='big')
+                if decodeMessage(await reader.readexactly(length), 'utf-8').getHeader('codec_offer') is None:
+                    break
+        writer.close()
+
+    async def drive(port: int):
+        connected, started, ready = asyncio.Event(), asyncio.Event(), []
+        tasks = [asyncio.ensure_future(client(port, connected, started, ready)) for _ in range(clients)]
+        await connected.wait()
+        await asyncio.sleep(0.5)  # 等待服务端完成所有连接的接收
+        threads = threading.active_count()
+        begin = time.perf_counter()
+        started.set()
+        await asyncio.gather(*tasks)
+        return threads, time.perf_counter() - begin
+
+    logger.disable('app')
+    print(f'{"mode":<10}{"clients":>8}{"threads":>9}{"round trip/s":>15}')
+    for mode, processor_class in (('thread', ServerSocketProcessor), ('asyncio', AsyncServerSocketProcessor)):
+        processor = processor_class('127.0.0.1', 0, 0.5, 'utf-8')
+        processor.linkTo(processor.getNode())  # 回环
+        processor.launch()
+        threads, elapsed = asyncio.new_event_loop().run_until_complete(
+            drive(processor.connection_builder.server.getsockname()[1]))
+        processor.terminate(True)
+        print(f'{mode:<10}{clients:>8}{threads:>9}{clients * rounds / elapsed:>15,.0f}')
+    logger.enable('app')
+
+
+class FrameSource(PipComponent):
+    """ 模拟后端，为每个请求立即产生frames帧拍摄响应 """
+
+    def __init__(self, frames: int):
+        super().__init__(0.5)
+        self.frames = frames
+
+    def onHandlingBatch(self, requests: List[Message]) -> None:
+        responses = []
+        for request in requests:
+            for _ in range(self.frames):
+                response = Message()
+                response.head = request.head
+                response.set('code', '200')
+                response.set('message', 'Done')
+                responses.append(response)
+        self.forward(responses)
+
+
+def launchFrameSource(frames: int):
+    """ 启动asyncio服务端以及模拟后端，返回服务端、模拟后端以及监听端口 """
+    processor, source = AsyncServerSocketProcessor('127.0.0.1', 0, 0.5, 'utf-8'), FrameSource(frames)
+    processor.linkTo(source)
+    source.link(processor.getNode())
+    processor.launch()
+    source.start()
+    return processor, source, processor.connection_builder.server.getsockname()[1]
+
+
+def terminateFrameSource(processor, source) -> None:
+    source.terminate()
+    processor.terminate(True)
+    source.join()
+
+
+@benchmark('asyncjobs')
+def benchAsyncJobs(jobs: int = 200, frames: int = 50) -> Dict:
+    """
+    一个AsyncClient连接并发驱动多个拍摄任务，模拟后端为每个请求立即产生frames帧拍摄响应，
+    统计所有任务的帧吞吐量，以及客户端是否额外占用线程
+    """
+    async def drive(port: int):
+        async with AsyncClient('127.0.0.1', port, 'utf-8') as client:
+            threads = threading.active_count()
+
+            async def job():
+                return len([response async for response in client.stream(sampleMessages()['request'], frames)])
+
+            begin = time.perf_counter()
+            received = sum(await asyncio.gather(*(job() for _ in range(jobs))))
+            elapsed = time.perf_counter() - begin
+            return received, elapsed, threading.active_count() - threads, client.correlations.getStatistics()
+
+    logger.disable('app')
+    processor, source, port = launchFrameSource(frames)
+    received, elapsed, threads, statistics = asyncio.new_event_loop().run_until_complete(drive(port))
+    terminateFrameSource(processor, source)
+    logger.enable('app')
+    print(f'{"jobs":<8}{"frames":>10}{"frames/s":>12}{"extra threads":>15}{"in flight":>11}')
+    print(f'{jobs:<8}{received:>10}{received / elapsed:>12,.0f}{threads:>15}{statistics["in_flight"]:>11}')
+    return {'frames': {'ops_per_sec': received / elapsed}}
+
+
+@benchmark('aggregate')
+def benchAggregate(jobs: int = 20, frames: int = 2000, intervals=(None, 0.05)) -> Dict:
+    """
+    逐帧响应汇总：并发驱动多个拍摄任务，比较逐帧接收与中间件汇总两种方式下前端收到的消息数、字节数以及耗时
+    """
+    async def drive(port: int, interval):
+        async with AsyncClient('127.0.0.1', port, 'utf-8') as client:
+            received = []
+
+            async def job():
+                request = sampleMessages()['request']
+                if interval is not None:
+                    request.setHeader(AGGREGATE_HEADER, interval)
+                async for response in client.stream(request, frames):
+                    received.append(len(Message.dumps(response)))
+
+            begin = time.perf_counter()
+            await asyncio.gather(*(job() for _ in range(jobs)))
+            return received, time.perf_counter() - begin
+
+    logger.disable('app')
+    results = {}
+    print(f'{"interval":<10}{"frames":>10}{"messages":>10}{"bytes":>12}{"elapsed s":>11}')
+    for interval in intervals:
+        processor, source, port = launchFrameSource(frames)
+        received, elapsed = asyncio.new_event_loop().run_until_complete(drive(port, interval))
+        terminateFrameSource(processor, source)
+        name = 'per frame' if interval is None else f'{interval * 1000:g} ms'
+        results[name.replace(' ', '_')] = {'messages': len(received), 'bytes': sum(received)}
+        print(f'{name:<10}{jobs * frames:>10}{len(received):>10}{sum(received):>12,}{elapsed:>11.2f}')
+    logger.enable('app')
+    return results
+
+
+@benchmark('tiles')
+def benchTiles(split: int = 64, repeat: int = 20) -> Dict:
+    """
+    横移连拍区域追踪：split x split个区域乱序完成时，比较逐帧响应与汇总响应区间编码之间的消息字节数，
+    以及前端TileTracker按照汇总响应更新位图的耗时
+    """
+    from .comm import ProgressAggregator, TILE_KEY
+    from .tiles import TileTracker
+
+    total, chunk = split ** 2, 512  # 每个汇总间隔约完成chunk个区域
+    aggregator, tracker, messages = ProgressAggregator(), TileTracker(total), {'per frame': [], 'aggregated': []}
+    order = random.sample(range(total), total)  # 拍摄线程池乱序完成各个区域
+    for begin in range(0, total, chunk):
+        for tile in order[begin:begin + chunk]:
+            frame = sampleMessages()['response']
+            frame.setHeader(AGGREGATE_HEADER, 0.5)
+            frame.set(TILE_KEY, tile)
+            messages['per frame'].append(Message.dumps(frame))
+            aggregator.offer(frame)
+        for summary in aggregator.summaries.values():  # 到达汇总间隔
+            summary.deadline = 0
+        messages['aggregated'].extend(Message.dumps(summary) for summary in aggregator.expire())
+    for line in messages['aggregated']:
+        tracker.update(Message.loads(line))
+    assert tracker.getDoneNum() == total and not tracker.getPendingRanges()
+
+    summaries = [Message.loads(line) for line in messages['aggregated']]
+    printSummaryHeader()
+    results = {'update': summarize(f'track {split}x{split}', sample(
+        lambda: [TileTracker(total).update(summary) for summary in summaries], 1, repeat), len(summaries))}
+    for name, lines in messages.items():
+        print(f'{total} tiles {name}: {len(lines)} messages, {sum(map(len, lines)):,} bytes')
+        results[name.replace(' ', '_')] = {'messages': len(lines), 'bytes': sum(map(len, lines))}
+    return results
+
+
+@benchmark('importtime')
+def benchImportTime(entries=('app.MW', 'app.CLI', 'app.BE'), rounds: int = 5,
+                    forbidden=('PyQt5', 'yaml')) -> Dict:
+    """
+    启动程序的冷启动耗时：在子进程中以-X importtime导入中间件、命令行前端以及后端模拟器模块，统计模块导入的累计耗时，
+    重启中间件时同样需要付出该耗时；同时检查这些入口没有导入PyQt5等仅图形界面或者批量计划需要的依赖
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results, details = {}, []
+    printSummaryHeader()
+    for entry in entries:
+        samples, imported = [], {}
+        for _ in range(rounds + 1):  # 第一轮用于生成字节码缓存，不计入统计
+            output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {entry}'], cwd=root,
+                                    stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+            imported = {}
+            for line in output.splitlines():
+                if not line.startswith('import time:') or 'cumulative' in line:
+                    continue
+                own, cumulative, name = line[len('import time:'):].split('|')
+                imported[name.strip()] = (int(own), int(cumulative))
+            samples.append(imported[entry][1] / 1e6)
+        leaked = [name for name in imported if name.split('.')[0] in forbidden]
+        assert not leaked, f'{entry} imports {", ".join(sorted(set(name.split(".")[0] for name in leaked)))}'
+        slowest = sorted(imported, key=lambda name: imported[name][0], reverse=True)[:3]
+        results[entry] = summarize(f'import {entry}', samples[1:])
+        details.append(f'{entry}: {len(imported)} modules, slowest {", ".join(slowest)}')
+    print('\n'.join(details))
+    return results
+
+
+@benchmark('watcher')
+def benchWatcher(rounds: int = 50):
+    """ 比较锁文件被删除到读线程感知之间的延迟：原先的固定0.1s轮询、自适应轮询以及inotify """
+    def legacy(path: str, timeout: float) -> bool:  # 原PipFileReader的等待方式
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            if not os.path.exists(path):
+                return True
+        return False
+
+    print(f'{"mode":<10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'dm_out.lock')
+        for mode in ('fixed', 'polling', 'auto'):
+            watcher = LockFileWatcher(path, 'auto' if mode == 'auto' else 'polling')
+            wait = (lambda timeout: legacy(path, timeout)) if mode == 'fixed' else watcher.waitForRemoval
+            latencies = []
+            for _ in range(rounds):
+                open(path, 'w').close()
+                removed_at = []
+
+                def remove():
+                    time.sleep(random.uniform(0.01, 0.15))  # 后端在随机时刻写完响应
+                    removed_at.append(time.perf_counter())
+                    os.remove(path)
+
+                thread = threading.Thread(target=remove)
+                thread.start()
+                wait(3)
+                latencies.append((time.perf_counter() - removed_at[0]) * 1000)
+                thread.join()
+            name = watcher.mode if mode != 'fixed' else 'fixed'
+            watcher.close()
+            print(f'{name:<10}{percentile(latencies, 50):>10.2f}{percentile(latencies, 99):>10.2f}'
+                  f'{max(latencies):>10.2f}')
+
+
+@benchmark('transport')
+def benchTransport(records: int = 20000, batch: int = 100):
+    """
+    DM传输层一致性与吞吐量测试，对每一种传输方式：先检查后端尚未就绪时的写出行为、多字节字符以及记录顺序，
+    再由写线程按批次写出记录、读线程读取，统计每秒传递的消息数
+    """
+    line = Message.dumps(sampleMessages()['response'])
+    print(f'{"transport":<11}{"conformance":<13}{"msg/s":>12}{"reads":>8}')
+    for name in TRANSPORTS:
+        with tempfile.TemporaryDirectory() as directory:
+            config = {'transport': name, 'encoding': 'gbk', 'watch_mode': 'auto', 'shm_capacity': 1024 * 1024}
+            for side in ('input', 'output'):
+                config[f'{side}_pip_path'] = os.path.join(directory, f'dm_{side[:-3]}.pip')
+                config[f'{side}_pip_lock'] = os.path.join(directory, f'dm_{side[:-3]}.lock')
+            try:
+                writer, output = createChannels(config, 'middleware')
+                reader, peer = createChannels(config, 'backend')
+            except OSError as e:
+                print(f'{name:<11}unsupported: {e}')
+                continue
+
+            # 一致性：连接建立后记录完整、有序，且不丢失多字节字符
+            expected = [f'{line}##seq=>{index}##message=>拍摄完成' for index in range(10)]
+            pending, received, deadline = list(expected), [], time.monotonic() + 3
+            while len(received) < len(expected) and time.monotonic() < deadline:
+                del pending[:writer.write(pending)]
+                received += reader.read(0.05)
+            conformance = 'ok' if received == expected else f'FAILED ({len(received)}/{len(expected)})'
+
+            # 吞吐量
+            def write():
+                for begin in range(0, records, batch):
+                    chunk = [line] * min(batch, records - begin)
+                    while chunk:
+                        written = writer.write(chunk)
+                        del chunk[:written]
+                        if chunk:
+                            time.sleep(0)  # 对端尚未读取，让出执行权
+
+            thread = threading.Thread(target=write)
+            count, reads = 0, 0
+            begin = time.perf_counter()
+            thread.start()
+            while count < records and time.perf_counter() - begin < 30:
+                count += len(reader.read(0.5))
+                reads += 1
+            elapsed = time.perf_counter() - begin
+            thread.join()
+            for channel in (writer, output, reader, peer):
+                channel.close()
+            print(f'{name:<11}{conformance:<13}{count / elapsed:>12,.0f}{reads:>8}')
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    将统计结果与基线比较，单次操作耗时的p50超过基线(1 + tolerance)倍时视为性能回退
+    :return: 发生回退的指标
+    """
+    regressions = []
+    print(f'{"metric":<32}{"baseline p50":>14}{"current p50":>14}{"ratio":>8}')
+    for name, metrics in results.items():
+        for metric, result in metrics.items():
+            base = baseline.get('results', {}).get(name, {}).get(metric)
+            if base is None or 'p50_us' not in base or 'p50_us' not in result:  # 仅统计吞吐量或者消息数的指标不参与比较
+                continue
+            ratio = result['p50_us'] / base['p50_us']
+            result['baseline_ratio'] = ratio
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append(f'{name}.{metric}')
+                flag = '  REGRESSION'
+            print(f'{name + "." + metric:<32}{base["p50_us"]:>14.2f}{result["p50_us"]:>14.2f}{ratio:>8.2f}{flag}')
+    return regressions
+
+
+def run(names=None, output: str = None, baseline: str = None, tolerance: float = 0.1) -> int:
+    """
+    执行基准测试
+    :param names: 需要执行的测试名称，为空时执行全部测试
+    :param output: 统计结果的JSON输出路径
+    :param baseline: 基线JSON路径，通常为上一个版本的输出
+    :param tolerance: 允许的p50耗时增长比例
+    :return: 发生性能回退的指标数
+    """
+    results = {}
+    for name in names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            print(f'Unknown benchmark: {name}, available: {", ".join(BENCHMARKS)}')
+            continue
+        print(f'== {name} ==')
+        result = BENCHMARKS[name]()
+        if result is not None:
+            results[name] = result
+
+    regressions = []
+    if baseline is not None:
+        print('== baseline ==')
+        with open(baseline, 'r', encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), tolerance)
+        print(f'{len(regressions)} regression(s) beyond {tolerance:.0%}' +
+              (f': {", ".join(regressions)}' if regressions else ''))
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump({'python': sys.version.split()[0], 'platform': platform.platform(), 'timestamp': time.time(),
+                       'results': results}, file, indent=2)
+        print(f'Results written to {output}')
+    return len(regressions)
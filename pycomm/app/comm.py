@@ -1,13 +1,20 @@
+import asyncio
+import collections
+import itertools
+import math
 import os
 import queue
 import socket
+import struct
 import threading
 import time
-import uuid
-from typing import Callable, Dict, List
+from concurrent import futures
+from typing import Callable, Dict, List, Tuple
 
 from loguru import logger
 
+from .transport import createChannels
+
 
 class Message:
     """
@@ -84,16 +91,305 @@ class Message:
         except Exception as e:
             logger.error(f'Unable load a message due to incorrect message type : {line}, exception: {e}')
 
+    @staticmethod
+    def loadsBatch(lines: List[str]) -> List:
+        """
+        一次解析一批文本格式的消息，无法解析的记录会被跳过
+        :return: 成功解析的消息列表
+        """
+        messages = []
+        for line in lines:
+            message = Message.loads(line)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    # 二进制格式：帧头(魔数、版本、消息头条目数、消息体条目数) + 键序号表(每个条目一个字节) + 以NUL分隔的字段，
+    # 键序号为键在binary_keys中的位置加1，0表示键不在表中，此时键名作为一个字段存放在值之前，字段均按字符串存储
+    binary_magic = 0  # 文本格式的消息不会以NUL字节开头，依此区分两种格式
+    binary_version = 2
+    binary_header = struct.Struct('>BBBB')
+    binary_keys = ('address', 'callback_id', 'codec_offer', 'codec_accept', 'aggregate', 'trace_recv', 'trace_write',
+                   'trace_read', 'name', 'option', 'code', 'message', 'timestamp', 'cam_id', 'exposure', 'x_bin',
+                   'y_bin', 'x_split', 'y_split', 'x_off', 'y_off', 'enable_extension', 'extension_unit', 'pos_top',
+                   'pos_left', 'pos_bottom', 'pos_right', 'duration', 'framerate', 'enable_optimize', 'done',
+                   'ignored', 'tile', 'tiles', 'ignored_tiles')  # 常用键，只能在末尾追加，调整已有顺序时需要提升版本
+    binary_key_ids = {key: index + 1 for index, key in enumerate(binary_keys)}
+    binary_key_names = (None,) + binary_keys  # 键序号->键名
+    binary_field_seperator = '\0'
+    # 同一类消息的键序列相同，缓存键序列与帧头(包括键序号表)之间的对应关系，仅缓存全部为常用键的消息
+    binary_prefixes: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], bytes] = {}  # (消息头键序列, 消息体键序列)->帧头
+    binary_layouts: Dict[bytes, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {}  # 帧头->(消息头键序列, 消息体键序列)
+    binary_cache_capacity = 1024
+
+    @staticmethod
+    def dumpb(msg, encoding='utf-8') -> bytes:
+        """
+        将消息编码为二进制格式，常用键以单字节序号代替
+        :raise ValueError: 消息头或消息体超过255个条目，或者字段中包含NUL字符时无法编码
+        """
+        head, body = msg.head, msg.body
+        layout = (tuple(head), tuple(body))
+        prefix = Message.binary_prefixes.get(layout)
+        if prefix is not None:
+            fields = [*head.values(), *body.values()]
+        else:
+            ids, fields = [], []
+            for entries in (head, body):
+                for key, val in entries.items():
+                    key_id = Message.binary_key_ids.get(key, 0)
+                    ids.append(key_id)
+                    if not key_id:
+                        fields.append(key)
+                    fields.append(val)
+            try:
+                prefix = bytes((Message.binary_magic, Message.binary_version, len(head), len(body), *ids))
+            except ValueError:
+                raise ValueError('Too many entries for binary format')
+            if 0 not in ids and len(Message.binary_prefixes) < Message.binary_cache_capacity:
+                Message.binary_prefixes[layout] = prefix
+
+        text = Message.binary_field_seperator.join(fields)
+        if fields and text.count(Message.binary_field_seperator) != len(fields) - 1:
+            raise ValueError('Field contains NUL character')
+        return prefix + text.encode(encoding)
+
+    @staticmethod
+    def loadb(data, encoding='utf-8'):
+        """
+        从二进制格式解码消息，data可以是bytes、bytearray或memoryview
+        """
+        try:
+            magic, version, head_count, body_count = Message.binary_header.unpack_from(data, 0)
+            if magic != Message.binary_magic or version != Message.binary_version:
+                raise ValueError(f'unsupported binary message version {version}')
+            count = head_count + body_count
+            offset = Message.binary_header.size + count
+            prefix = bytes(data[:offset])
+            fields = str(data[offset:], encoding).split(Message.binary_field_seperator) if count else []
+
+            layout = Message.binary_layouts.get(prefix)
+            if layout is None:
+                ids = prefix[Message.binary_header.size:]
+                if 0 in ids:  # 存在不在表中的键，键名位于值之前
+                    names, remaining = Message.binary_key_names, iter(fields)
+                    items = [(names[key_id] if key_id else next(remaining), next(remaining)) for key_id in ids]
+                    keys, fields = tuple(key for key, _ in items), [val for _, val in items]
+                else:
+                    keys = tuple(map(Message.binary_key_names.__getitem__, ids))
+                layout = (keys[:head_count], keys[head_count:])
+                if 0 not in ids and len(Message.binary_layouts) < Message.binary_cache_capacity:
+                    Message.binary_layouts[prefix] = layout
+            if len(fields) != count:
+                raise ValueError(f'expect {count} fields but got {len(fields)}')
+
+            msg = Message()
+            msg.head = dict(zip(layout[0], fields))
+            msg.body = dict(zip(layout[1], fields[head_count:]))
+            return msg
+        except Exception as e:
+            logger.error(f'Unable load a binary message, exception: {e}')
+
+
+class TextCodec:
+    """
+    文本编解码器，即 key=>val##key=>val$$$key=>val 格式，兼容旧版本客户端以及DM进程
+    """
+    name = 'text'
+
+    @staticmethod
+    def encode(message: Message, encoding: str) -> bytes:
+        return Message.dumps(message).encode(encoding)
+
+
+class BinaryCodec:
+    """
+    二进制编解码器，对于无法以二进制格式编码的消息回退到文本格式，接收端可以根据首字节自动区分
+    """
+    name = 'binary'
+
+    @staticmethod
+    def encode(message: Message, encoding: str) -> bytes:
+        try:
+            return Message.dumpb(message, encoding)
+        except ValueError:
+            return TextCodec.encode(message, encoding)
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec, TextCodec)}  # 可用编解码器，名称->编解码器
+PROGRESS_CODES = ('200', '300')  # 进度消息的响应码，对端接收缓慢时可以按照策略丢弃
+BUSY_CODE = '503'  # 中间件缓冲已满，请求未被受理，客户端可以稍后重试
+TERMINAL_CODES = ('201', '202', '400', '401', '404', BUSY_CODE)  # 请求的最终响应码：任务启动、停止、失败以及请求被拒绝
+FRAME_CODES = ('200', '403')  # 逐帧的拍摄响应码：拍摄完成、拍摄被忽略
+AGGREGATE_HEADER = 'aggregate'  # 请求头，值为汇总间隔（秒），中间件将该请求的逐帧响应合并为周期性的汇总响应
+AGGREGATE_CODE = '206'  # 汇总响应码，消息体包含done（完成帧数）、ignored（忽略帧数）以及timestamp（最后一帧的到达时间）
+TILE_KEY = 'tile'  # 横移连拍逐帧响应中的区域序号，按照行优先编号，与前端的区域规划一致
+
+
+def busyResponse(request: Message, reason: str) -> Message:
+    """ 构建请求被拒绝时的响应，沿用请求的消息头以便客户端匹配回调 """
+    response = Message()
+    response.head = dict(request.head)
+    response.set('code', BUSY_CODE)
+    response.set('message', reason)
+    return response
+
+
+def encodeRanges(indices) -> str:
+    """ 将序号编码为区间，例如[0, 1, 2, 5, 7, 8]编码为'0-2,5,7-8'，序号可以无序或者重复 """
+    ranges = []
+    for index in sorted(set(indices)):
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ','.join(str(begin) if begin == end else f'{begin}-{end}' for begin, end in ranges)
+
+
+def decodeRanges(text: str) -> List[Tuple[int, int]]:
+    """ 将区间编码解析为闭区间列表，例如'0-2,5'解析为[(0, 2), (5, 5)] """
+    ranges = []
+    for item in (text or '').split(','):
+        if not item:
+            continue
+        begin, _, end = item.partition('-')
+        ranges.append((int(begin), int(end or begin)))
+    return ranges
+
+
+class MessageBuffer(queue.Queue):
+    """
+    PipComponent的消息缓冲，容量按照消息条数计算，批量投递的消息列表按照其中的消息条数计入深度，
+    深度未达到容量时整批接收，因此实际深度至多超出容量一批，capacity为0时不限制容量
+    """
+
+    def __init__(self, capacity: int = 0):
+        super().__init__(capacity)
+        self.depth = 0  # 缓冲中的消息条数
+        self.high_water = 0  # 最大深度
+        self.rejected_count = 0  # 因缓冲已满被拒绝的投递次数
+        self.blocked_count = 0  # 因缓冲已满而等待的投递次数
+
+    def _qsize(self):
+        return self.depth
+
+    def _put(self, item):
+        self.queue.append(item)
+        self.depth += len(item) if isinstance(item, list) else 1
+        self.high_water = max(self.high_water, self.depth)
+
+    def _get(self):
+        item = self.queue.popleft()
+        self.depth -= len(item) if isinstance(item, list) else 1
+        return item
+
+    def offer(self, item, timeout: float = None) -> bool:
+        """
+        投递消息，缓冲已满时至多等待timeout秒
+        :param timeout: 等待时间，0表示不等待，None表示一直等待
+        :return: 是否投递成功
+        """
+        with self.mutex:
+            if 0 < self.maxsize <= self.depth:
+                if timeout == 0:
+                    self.rejected_count += 1
+                    return False
+                self.blocked_count += 1
+        try:
+            self.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            with self.mutex:
+                self.rejected_count += 1
+            return False
+
+    def getBatch(self, limit: int, timeout: float = None, budget: float = 0) -> List[Message]:
+        """
+        等待第一条消息，随后在同一次加锁中取出已经到达的消息，批量投递的消息列表超出limit时剩余部分留在缓冲头部
+        :param limit: 单批最大消息条数
+        :param timeout: 等待第一条消息的时间，超时抛出queue.Empty
+        :param budget: 取得第一条消息之后继续等待后续消息的时间，0表示仅取出已经到达的消息
+        """
+        with self.not_empty:
+            if not self.waitNotEmpty(timeout):
+                raise queue.Empty
+            messages = []
+            deadline = None
+            while True:
+                while self.queue and len(messages) < limit:
+                    item = self._get()
+                    if isinstance(item, list):
+                        room = limit - len(messages)
+                        if len(item) > room:
+                            self.queue.appendleft(item[room:])
+                            self.depth += len(item) - room
+                            item = item[:room]
+                        messages.extend(item)
+                    else:
+                        messages.append(item)
+                if len(messages) >= limit or budget <= 0:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + budget
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.not_empty.wait(remaining) and not self.queue:
+                    break
+            self.not_full.notify_all()
+            return messages
+
+    def waitNotEmpty(self, timeout: float = None) -> bool:
+        """ 在已经持有锁的情况下等待缓冲非空，超时返回假 """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.queue:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.not_empty.wait(remaining)
+        return True
+
+    def force(self, item) -> None:
+        """ 忽略容量投递消息，用于连接断开等不能丢失的控制消息 """
+        with self.not_full:
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def getStatistics(self) -> Dict[str, float]:
+        """ 计数器只在持有锁时修改，读取时不加锁，缓冲饱和时也不会等待锁，各项数值之间可能相差一次投递 """
+        return {
+            'queue_depth': self.depth,
+            'queue_high_water': self.high_water,
+            'queue_capacity': self.maxsize,
+            'rejected_puts': self.rejected_count,
+            'blocked_puts': self.blocked_count,
+        }
+
+
+def decodeMessage(data, encoding: str) -> Message or None:
+    """
+    解码一帧消息，根据首字节判断采用二进制格式还是文本格式
+    """
+    if len(data) > 0 and data[0] == Message.binary_magic:
+        return Message.loadb(data, encoding)
+    return Message.loads(str(data, encoding))
+
 
 class PipComponent(threading.Thread):
     input_buffer = None  # 消息缓冲
     output_buffer = None  # 消息缓冲
 
-    def __init__(self, timeout: float = 3):
+    def __init__(self, timeout: float = 3, capacity: int = 0, batch_size: int = 256, batch_window: float = 0):
+        """
+        :param capacity: 缓冲容量，单位为消息条数，0表示不限制
+        :param batch_size: 单次从缓冲中取出的最大消息条数
+        :param batch_window: 取得第一条消息之后继续收集后续消息的时间，单位为秒，0表示仅取出已经到达的消息
+        """
         threading.Thread.__init__(self)
         self.is_terminated = False
         self.timeout = timeout
-        self.input_buffer = queue.Queue()  # 消息缓冲
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.input_buffer = MessageBuffer(capacity)  # 消息缓冲，capacity为0时不限制容量
         self.output_buffer = None  # 消息缓冲
 
     def onLaunching(self) -> bool:
@@ -108,14 +404,67 @@ class PipComponent(threading.Thread):
     def postHandling(self, message: Message) -> bool:
         return True
 
+    def onHandlingBatch(self, messages: List[Message]) -> None:
+        """
+        处理一批消息，默认逐条执行preHandling/onHandling/postHandling，处理结果作为一批写入输出区，
+        子类可以覆盖该方法整批处理，分摊写出等I/O操作的开销
+        """
+        outputs = []
+        for message in messages:
+            if not self.preHandling(message):  # 过滤消息
+                continue
+
+            self.onHandling(message)  # 处理消息
+
+            if not self.postHandling(message):  # 后置处理消息
+                continue
+            outputs.append(message)
+
+        if self.output_buffer and outputs:  # 将消息写入输出区
+            self.forward(outputs)
+
     def onTerminating(self) -> bool:
         return True
 
     def onClosing(self, reason: str) -> None:
         pass
 
-    def postMessage(self, message: Message):
-        self.input_buffer.put(message)
+    def pollTimeout(self) -> float:
+        """ 等待下一批消息的时间，子类可以缩短该时间以便在onIdle中执行定时任务 """
+        return self.timeout
+
+    def onIdle(self) -> None:
+        """ 等待消息超时 """
+        pass
+
+    def postMessage(self, message: Message, timeout: float = None) -> bool:
+        """
+        投递消息，缓冲已满时至多等待timeout秒
+        :return: 是否投递成功，失败时调用方负责通知请求方或者重试
+        """
+        return self.input_buffer.offer(message, timeout)
+
+    def postMessages(self, messages: List[Message], timeout: float = None) -> bool:
+        """ 通过一次队列操作投递一批消息，由组件线程逐条处理 """
+        if not messages:
+            return True
+        return self.input_buffer.offer(messages, timeout)
+
+    def forward(self, messages: List[Message]) -> bool:
+        """ 将一批消息写入输出区，下游缓冲已满时等待，组件终止后放弃，输出区为普通队列时逐条写入 """
+        for item in (messages,) if isinstance(self.output_buffer, MessageBuffer) else messages:
+            while True:
+                try:
+                    self.output_buffer.put(item, timeout=self.timeout)
+                    break
+                except queue.Full:
+                    if self.is_terminated:
+                        logger.warning(f'{self.name} dropped messages on shutdown, downstream buffer is full')
+                        return False
+        return True
+
+    def getStatistics(self) -> Dict[str, float]:
+        return self.input_buffer.getStatistics()
 
     def terminate(self) -> None:
         if not self.onTerminating():
@@ -135,32 +484,401 @@ class PipComponent(threading.Thread):
         reason = 'normal'
         while not self.is_terminated:
             try:
-                message: Message = self.input_buffer.get(timeout=self.timeout)
-                if not self.preHandling(message):  # 过滤消息
-                    continue
+                messages = self.input_buffer.getBatch(self.batch_size, self.pollTimeout(), self.batch_window)
+            except queue.Empty:
+                if self.is_terminated:  # 超时退出
+                    reason = 'timeout'
+                    break
+                self.onIdle()
+                continue
+            self.onHandlingBatch(messages)  # 一次加锁取出的消息整批处理
+        self.onClosing(reason)
 
-                self.onHandling(message)  # 处理消息
 
-                if not self.postHandling(message):  # 后置处理消息
+class FrameReader:
+    """
+    帧读取器，以recv_into将socket数据读入可复用的缓冲区，按4字节长度前缀切分出完整的消息帧，
+    一次读取可能包含多个完整帧，不完整的尾部会保留到下一次读取时继续拼接
+    """
+
+    def __init__(self, connection: socket, capacity: int = 64 * 1024):
+        self.connection = connection
+        self.buffer = bytearray(capacity)  # 接收缓冲区
+        self.view = memoryview(self.buffer)
+        self.begin = 0  # 未解析数据起点
+        self.end = 0  # 未解析数据终点
+        self.recv_count = 0  # 读取次数
+        self.frame_count = 0  # 解析得到的帧数
+        self.max_frames_per_recv = 0  # 单次读取解析得到的最大帧数
+
+    def fill(self) -> int:
+        """
+        从socket读取数据追加到缓冲区尾部
+        :return: 读取的字节数，返回0表示连接已经关闭
+        """
+        if self.end == len(self.buffer):
+            self.reserve(len(self.buffer) - self.begin + 1)
+        received = self.connection.recv_into(self.view[self.end:])
+        self.end += received
+        self.recv_count += 1
+        return received
+
+    def reserve(self, size: int) -> None:
+        """
+        保证缓冲区能够从未解析数据起点容纳size字节，优先将未解析数据移动到缓冲区头部，容量不足时扩容
+        """
+        pending = self.end - self.begin
+        if size > len(self.buffer):  # 扩容，已经交出的帧视图仍然指向旧缓冲区，不受影响
+            buffer = bytearray(max(size, len(self.buffer) * 2))
+            buffer[:pending] = self.view[self.begin:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.begin + size > len(self.buffer):  # 移动未解析数据，等长切片赋值不会改变缓冲区大小
+            self.buffer[:pending] = self.buffer[self.begin:self.end]
+        else:
+            return
+        self.begin, self.end = 0, pending
+
+    def frames(self):
+        """
+        解析缓冲区中所有完整的帧，以memoryview的形式逐个返回帧数据，帧视图仅在处理当前帧期间有效
+        """
+        count = 0
+        while self.end - self.begin >= 4:
+            length = int.from_bytes(self.view[self.begin:self.begin + 4], byteorder='big')
+            if self.end - self.begin - 4 < length:  # 帧不完整，等待下一次读取
+                self.reserve(length + 4)
+                break
+            start = self.begin + 4
+            self.begin = start + length
+            count += 1
+            yield self.view[start:self.begin]
+
+        if self.begin == self.end:  # 数据全部解析完毕，复位读写位置
+            self.begin = self.end = 0
+        self.frame_count += count
+        self.max_frames_per_recv = max(self.max_frames_per_recv, count)
+
+    def getStatistics(self) -> Dict[str, float]:
+        return {
+            'recv_count': self.recv_count,
+            'frame_count': self.frame_count,
+            'frames_per_recv': self.frame_count / self.recv_count if self.recv_count else 0,
+            'max_frames_per_recv': self.max_frames_per_recv,
+            'bytes_buffered': self.end - self.begin,
+            'buffer_capacity': len(self.buffer),
+        }
+
+
+class OutboundQueue:
+    """
+    连接的待写出帧队列，长度前缀和帧数据交替排列，容量以帧为单位，0表示不限制，队列已满时按照策略处理：
+    block：阻塞直到写出方取走数据；drop：丢弃最早的一条进度消息，队列中没有进度消息时丢弃新的进度消息，
+    其余消息仍然写入，避免丢失任务状态；disconnect：拒绝写入，由调用方断开连接
+    """
+    policies = ('block', 'drop', 'disconnect')
+
+    def __init__(self, capacity: int = 0, policy: str = 'block', on_ready: Callable[[], None] = None):
+        """
+        :param on_ready: 队列由空变为非空时调用，用于唤醒不在条件变量上等待的写出方（例如事件循环）
+        """
+        if policy not in self.policies:
+            raise ValueError(f'Unsupported slow consumer policy: {policy}, available: {", ".join(self.policies)}')
+        self.capacity = capacity
+        self.policy = policy
+        self.on_ready = on_ready
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.buffers: List[bytes] = []  # 等待写出的缓冲区
+        self.droppable: List[bool] = []  # 每一帧是否为可以丢弃的进度消息
+        self.is_closed = False
+        self.high_water = 0  # 队列的最大深度
+        self.dropped_count = 0  # 丢弃的帧数
+        self.blocked_count = 0  # 写入方因队列已满而阻塞的次数
+
+    def put(self, data: bytes, droppable: bool = False) -> bool:
+        """
+        写入一帧数据
+        :param droppable: 是否为可以丢弃的进度消息
+        :return: 队列已关闭，或者队列已满且策略为disconnect时返回假
+        """
+        with self.lock:
+            return self.append(data, droppable)
+
+    def putBatch(self, frames: List[Tuple[bytes, bool]]) -> bool:
+        """
+        在一次加锁中写入一批帧，写出方在整批写入之后才能取走数据
+        :param frames: (帧数据, 是否为可以丢弃的进度消息)列表
+        """
+        with self.lock:
+            for data, droppable in frames:
+                if not self.append(data, droppable):
+                    return False
+            return True
+
+    def append(self, data: bytes, droppable: bool) -> bool:
+        """ 写入一帧数据，调用方需要持有锁 """
+        if self.capacity and len(self.droppable) >= self.capacity and not self.is_closed:
+            if self.policy == 'block':
+                self.blocked_count += 1
+                while len(self.droppable) >= self.capacity and not self.is_closed:
+                    self.not_full.wait()
+            elif self.policy == 'disconnect':
+                return False
+            elif True in self.droppable:  # 丢弃最早的进度消息
+                index = self.droppable.index(True)
+                del self.buffers[index * 2:index * 2 + 2]
+                del self.droppable[index]
+                self.dropped_count += 1
+            elif droppable:
+                self.dropped_count += 1
+                return True
+        if self.is_closed:
+            return False
+
+        self.buffers.append(len(data).to_bytes(4, byteorder='big'))
+        self.buffers.append(data)
+        self.droppable.append(droppable)
+        self.high_water = max(self.high_water, len(self.droppable))
+        if len(self.droppable) == 1:  # 仅在队列由空变为非空时唤醒写出方
+            self.not_empty.notify()
+            if self.on_ready is not None:
+                self.on_ready()
+        return True
+
+    def wait(self) -> bool:
+        """
+        等待队列非空
+        :return: 队列已关闭且为空时返回假
+        """
+        with self.lock:
+            while not self.buffers and not self.is_closed:
+                self.not_empty.wait()
+            return bool(self.buffers)
+
+    def take(self) -> List[bytes]:
+        """ 取走队列中的所有缓冲区 """
+        with self.lock:
+            buffers, self.buffers, self.droppable = self.buffers, [], []
+            self.not_full.notify_all()
+        return buffers
+
+    def close(self) -> None:
+        """ 关闭队列，唤醒所有等待的写入方和写出方，队列中剩余的数据仍然可以被取走 """
+        with self.lock:
+            self.is_closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def getStatistics(self) -> Dict[str, float]:
+        return {
+            'queue_depth': len(self.droppable),
+            'queue_high_water': self.high_water,
+            'queue_capacity': self.capacity,
+            'dropped_frames': self.dropped_count,
+            'blocked_puts': self.blocked_count,
+        }
+
+
+class FrameWriter:
+    """
+    帧写出器，长度前缀和帧数据作为同一次写出的两个缓冲区，不再单独写出长度前缀，
+    启用合并窗口或者限制队列容量时由写出线程收集队列中的所有帧，通过一次sendmsg(writev)写出，
+    不支持sendmsg的平台(Windows)回退为拼接之后一次sendall
+    """
+    max_buffers = 1024  # 单次sendmsg的最大缓冲区数，受限于IOV_MAX
+
+    def __init__(self, connection: socket, flush_interval: float = 0, name: str = 'FrameWriter',
+                 capacity: int = 0, policy: str = 'block'):
+        """
+        :param capacity: 待写出队列容量，单位为帧，0表示不限制
+        :param policy: 队列已满时的处理策略，参考OutboundQueue
+        """
+        self.connection = connection
+        self.flush_interval = flush_interval  # 合并窗口，单位为秒，0表示不等待
+        self.is_terminated = False
+        self.queue = OutboundQueue(capacity, policy)  # 待写出队列
+        self.write_count = 0  # 写出系统调用次数
+        self.frame_count = 0  # 写出帧数
+        self.max_frames_per_write = 0  # 单次系统调用写出的最大帧数
+        self.thread = None
+        if flush_interval > 0 or capacity > 0:
+            self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+            self.thread.start()
+
+    def put(self, data: bytes, droppable: bool = False) -> bool:
+        """
+        写出一帧数据，存在写出线程时仅加入待写出队列
+        :param droppable: 是否为可以丢弃的进度消息
+        :return: 写出器已关闭，或者因为对端接收缓慢而断开连接时返回假
+        """
+        if self.thread is None:
+            self.send([len(data).to_bytes(4, byteorder='big'), data])
+            return True
+        if self.queue.put(data, droppable):
+            return True
+        if not self.queue.is_closed:  # 队列已满，断开接收缓慢的连接
+            logger.warning(f'Disconnect slow consumer, {self.queue.capacity} frames pending')
+            self.abort()
+        return False
+
+    def putBatch(self, frames: List[Tuple[bytes, bool]]) -> bool:
+        """ 写出一批帧，不存在写出线程时通过一次sendmsg写出，否则在一次加锁中加入待写出队列 """
+        if self.thread is None:
+            buffers = []
+            for data, _ in frames:
+                buffers.append(len(data).to_bytes(4, byteorder='big'))
+                buffers.append(data)
+            self.send(buffers)
+            return True
+        if self.queue.putBatch(frames):
+            return True
+        if not self.queue.is_closed:  # 队列已满，断开接收缓慢的连接
+            logger.warning(f'Disconnect slow consumer, {self.queue.capacity} frames pending')
+            self.abort()
+        return False
+
+    def send(self, buffers: List[bytes]) -> None:
+        """ 写出缓冲区列表，处理部分写出的情况，已经写出的缓冲区会从列表中移除 """
+        frames = len(buffers) // 2
+        if not hasattr(self.connection, 'sendmsg'):
+            self.connection.sendall(b''.join(buffers))
+            self.countWrite(frames)
+            buffers.clear()
+            return
+
+        index = 0  # 第一个未完整写出的缓冲区
+        try:
+            while index < len(buffers):
+                if not len(buffers[index]):  # 空缓冲区写出0字节，直接跳过以免循环无法推进
+                    index += 1
                     continue
+                batch = buffers[index:index + self.max_buffers]
+                sent = self.connection.sendmsg(batch)
+                self.countWrite(len(batch) // 2)
+                while sent > 0:  # 跳过已经完整写出的缓冲区，截断部分写出的缓冲区
+                    if sent >= len(buffers[index]):
+                        sent -= len(buffers[index])
+                        index += 1
+                    else:
+                        buffers[index] = memoryview(buffers[index])[sent:]
+                        sent = 0
+        finally:
+            del buffers[:index]  # 出现异常时调用方可以继续写出剩余的缓冲区
+
+    def countWrite(self, frames: int) -> None:
+        self.write_count += 1
+        self.frame_count += frames
+        self.max_frames_per_write = max(self.max_frames_per_write, frames)
 
-                if self.output_buffer:  # 将消息写入输出区
-                    self.output_buffer.put(message)
+    def run(self):
+        while self.queue.wait():
+            if self.flush_interval > 0 and not self.is_terminated:
+                time.sleep(self.flush_interval)  # 收集合并窗口内的后续帧
+            buffers = self.queue.take()
 
-            except queue.Empty:
-                if self.is_terminated:  # 超时退出
-                    reason = 'timeout'
+            while buffers:
+                try:
+                    self.send(buffers)
+                except socket.timeout:  # 对端接收缓慢，继续写出剩余数据
+                    if self.is_terminated:
+                        return
+                except OSError as e:
+                    logger.error(f'Unable to write frames: {e}')
+                    self.is_terminated = True
+                    self.queue.close()
+                    return
+
+    def abort(self) -> None:
+        """ 丢弃待写出的帧并断开连接，连接的读取线程随之退出 """
+        self.is_terminated = True
+        self.queue.close()
+        self.queue.take()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        """ 停止写出线程，待写出的帧会在线程退出前写出 """
+        self.is_terminated = True
+        self.queue.close()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def getStatistics(self) -> Dict[str, float]:
+        return {
+            'write_count': self.write_count,
+            'frame_count': self.frame_count,
+            'frames_per_write': self.frame_count / self.write_count if self.write_count else 0,
+            'max_frames_per_write': self.max_frames_per_write,
+            'pending_frames': len(self.queue.droppable),
+            **self.queue.getStatistics(),
+        }
+
+
+class CodecNegotiator:
+    """
+    编码格式协商，服务端在连接建立后发出codec_offer，客户端从中选出双方都支持的格式并回复codec_accept，
+    旧版本客户端会忽略codec_offer，旧版本服务端不会发出codec_offer，双方因此保持文本格式，
+    子类需要提供codecs、codec属性以及write方法
+    """
+    codecs: List[str] = [TextCodec.name]  # 本端支持的编码格式，按优先级排列
+    codec = TextCodec  # 发送消息采用的编码格式，协商完成之前采用文本格式
+
+    def write(self, message: Message) -> None:
+        pass
+
+    def offerCodecs(self) -> None:
+        """ 提议编码格式，接收端解码时自动识别格式，因此无需等待协商结果 """
+        offer = Message()
+        offer.setHeader('codec_offer', ','.join(self.codecs))
+        self.write(offer)
+
+    def negotiate(self, message: Message) -> bool:
+        """
+        处理协商消息
+        :return: 消息为协商消息时返回真，协商消息不会交给上层处理
+        """
+        offer = message.getHeader('codec_offer')
+        if offer is not None:
+            offered = offer.split(',')
+            for name in self.codecs:  # 按本端优先级选择编码格式
+                if name in offered:
+                    reply = Message()
+                    reply.setHeader('codec_accept', name)
+                    self.write(reply)  # 回复采用原编码格式
+                    self.codec = CODECS[name]
+                    logger.debug(f'Negotiated codec: {name}')
                     break
-        self.onClosing(reason)
+            return True
+
+        accept = message.getHeader('codec_accept')
+        if accept is not None:
+            if accept in self.codecs:
+                self.codec = CODECS[accept]
+                logger.debug(f'Negotiated codec: {accept}')
+            return True
+        return False
 
 
-class ConnectionProxy(threading.Thread):
-    def __init__(self, connection: socket, timeout: float = 3.0, encoding='utf-8'):
+class ConnectionProxy(threading.Thread, CodecNegotiator):
+    def __init__(self, connection: socket, timeout: float = 3.0, encoding='utf-8',
+                 codecs=(TextCodec.name,), offering: bool = False, flush_interval: float = 0,
+                 queue_size: int = 0, slow_policy: str = 'block'):
         super().__init__()
         self.is_terminated = True
         self.encoding = encoding
         self.connection = connection
+        self.codecs = [name for name in codecs if name in CODECS]  # 本端支持的编码格式，按优先级排列
+        self.codec = TextCodec  # 发送消息采用的编码格式，协商完成之前采用文本格式
+        self.offering = offering  # 是否在连接建立后主动提议编码格式，由服务端发起
         self.connection.settimeout(timeout)  # 设置超时时间
+        self.reader = FrameReader(connection)  # 帧读取器
+        self.writer = FrameWriter(connection, flush_interval, capacity=queue_size, policy=slow_policy)  # 帧写出器
+        self.request_count = 0  # 接收的消息数，仅由接收线程修改
+        self.response_count = 0  # 发送的消息数，服务端仅由响应管道线程修改
         self.pre_sending = lambda message: True  # 消息发送前
         self.post_sending = lambda message: None  # 消息发送后
         self.pre_receiving = lambda message: True  # 消息接收前
@@ -246,32 +964,58 @@ class ConnectionProxy(threading.Thread):
         if not self.pre_sending(message):  # 消息预发送
             return
 
-        data = Message.dumps(message).encode(encoding=self.encoding)  # 编码对象
-        length = len(data).to_bytes(4, byteorder='big')
-        self.connection.sendall(length)  # 发送数据长度
-        self.connection.sendall(data)  # 发送数据
+        self.response_count += 1
+        self.write(message)
         self.post_sending(message)  # 消息已发送
 
+    def write(self, message: Message) -> None:
+        self.writer.put(self.codec.encode(message, self.encoding),
+                        message.get('code') in PROGRESS_CODES)  # 编码对象，写出长度前缀和数据
+
+    def sendBatch(self, messages: List[Message]) -> None:
+        """ 发送一批消息，逐条执行发送前后的回调，编码之后作为一批交给写出器 """
+        if self.is_terminated:
+            logger.error('Proxy has already terminated')
+            return
+
+        messages = [message for message in messages if message and self.pre_sending(message)]
+        self.response_count += len(messages)
+        self.writer.putBatch([(self.codec.encode(message, self.encoding), message.get('code') in PROGRESS_CODES)
+                              for message in messages])
+        for message in messages:
+            self.post_sending(message)
+
+    def getStatistics(self) -> Dict[str, float]:
+        return {
+            'request_count': self.request_count,
+            'response_count': self.response_count,
+            **self.writer.getStatistics(),
+        }
+
     def run(self):  # 消息接受线程
         if not self.on_launching():
             return
 
         self.is_terminated = False
         closing_reason = 'normal'
+        if self.offering:  # 提议编码格式
+            self.offerCodecs()
+
         while not self.is_terminated:
             try:
-                length_prefix = self.connection.recv(4)
-                if not length_prefix:
+                if not self.reader.fill():  # 连接已关闭
                     break
-                length = int.from_bytes(length_prefix, byteorder='big')  # 获取数据长度
-                message_data = self.connection.recv(length)  # 接收指定长度数据
-                message = Message.loads(message_data.decode(encoding=self.encoding))  # 解码
+                for frame in self.reader.frames():  # 一次读取可能包含多条消息
+                    message = decodeMessage(frame, self.encoding)  # 解码
+                    if message is None or self.negotiate(message):
+                        continue
 
-                if not self.pre_receiving(message):  # 消息预接收
-                    return
+                    if not self.pre_receiving(message):  # 消息预接收
+                        continue
 
-                self.on_receiving(message)  # 接收消息
-                self.post_receiving(message)  # 消息已接收
+                    self.request_count += 1
+                    self.on_receiving(message)  # 接收消息
+                    self.post_receiving(message)  # 消息已接收
 
             except socket.timeout:
                 if self.is_terminated:
@@ -281,6 +1025,7 @@ class ConnectionProxy(threading.Thread):
                 closing_reason = 'Detected connection reset'
                 break
 
+        self.writer.close()  # 写出剩余的帧
         self.connection.close()  # 线程退出
         self.on_closing(closing_reason)  # 线程退出
 
@@ -299,31 +1044,154 @@ class Processor:  # 处理器门户
         pass
 
 
+class CorrelationTable:
+    """
+    请求关联表，序号->关联项，按照最近一次收到响应的时间排列，
+    收到终止响应码或者调用complete时关联项被移除，超过ttl秒没有收到响应或者超出容量时淘汰最久未活动的关联项
+    """
+
+    class Correlation:
+        def __init__(self, callback: Callable[[Message], None], terminal_codes, expires: float):
+            self.callback = callback  # 每次收到响应时调用
+            self.terminal_codes = terminal_codes  # 终止响应码
+            self.expires = expires  # 过期时间
+            self.future = futures.Future()  # 终止响应
+
+    def __init__(self, ttl: float = 600, capacity: int = 4096):
+        self.ttl = ttl  # 关联项的存活时间，单位为秒，每次收到响应时刷新
+        self.capacity = capacity  # 最大关联项数量，0表示不限制
+        self.lock = threading.Lock()
+        self.correlations: collections.OrderedDict = collections.OrderedDict()
+        self.sequence = itertools.count(1)  # 关联序号
+        self.completed_count = 0  # 收到终止响应或者显式完成的关联项数量
+        self.evicted_count = 0  # 过期或者超出容量被淘汰的关联项数量
+
+    def register(self, callback: Callable[[Message], None] = None,
+                 terminal_codes=()) -> Tuple[str, futures.Future]:
+        """
+        注册关联项
+        :param callback: 收到响应时调用，收到终止响应之后不再调用
+        :param terminal_codes: 终止响应码，收到其中之一时以该响应完成Future
+        :return: 关联序号以及终止响应的Future
+        """
+        now = time.monotonic()
+        correlation = CorrelationTable.Correlation(callback, terminal_codes, now + self.ttl)
+        with self.lock:
+            correlation_id = str(next(self.sequence))
+            self.correlations[correlation_id] = correlation
+            evicted = self.evict(now)
+        self.expire(evicted)
+        return correlation_id, correlation.future
+
+    def dispatch(self, correlation_id: str, message: Message) -> bool:
+        """
+        将响应交给关联项，刷新关联项的存活时间
+        :return: 关联项是否存在
+        """
+        with self.lock:
+            correlation = self.correlations.get(correlation_id)
+            if correlation is None:
+                return False
+            terminal = message.get('code') in correlation.terminal_codes
+            if terminal:
+                del self.correlations[correlation_id]
+                self.completed_count += 1
+            else:
+                correlation.expires = time.monotonic() + self.ttl
+                self.correlations.move_to_end(correlation_id)
+
+        if correlation.callback is not None:
+            correlation.callback(message)
+        if terminal:
+            correlation.future.set_result(message)
+        return True
+
+    def complete(self, correlation_id: str) -> bool:
+        """ 显式完成关联项，此后不再调用回调，尚未完成的Future被取消 """
+        with self.lock:
+            correlation = self.correlations.pop(correlation_id, None)
+            if correlation is None:
+                return False
+            self.completed_count += 1
+        correlation.future.cancel()
+        return True
+
+    def evict(self, now: float) -> List:
+        """ 淘汰过期以及超出容量的关联项，调用方需要持有锁 """
+        evicted = []
+        while self.correlations:
+            correlation_id, correlation = next(iter(self.correlations.items()))
+            if correlation.expires > now and (not self.capacity or len(self.correlations) <= self.capacity):
+                break
+            del self.correlations[correlation_id]
+            evicted.append(correlation)
+        self.evicted_count += len(evicted)
+        return evicted
+
+    def abort(self, exception: Exception) -> None:
+        """ 连接关闭时移除所有关联项，尚未完成的Future以exception结束 """
+        with self.lock:
+            correlations, self.correlations = list(self.correlations.values()), collections.OrderedDict()
+        for correlation in correlations:
+            if not correlation.future.done():
+                correlation.future.set_exception(exception)
+
+    @staticmethod
+    def expire(evicted: List) -> None:
+        for correlation in evicted:
+            if not correlation.future.done():
+                correlation.future.set_exception(
+                    futures.TimeoutError('Correlation evicted before terminal response'))
+
+    def getStatistics(self) -> Dict[str, float]:
+        with self.lock:
+            evicted = self.evict(time.monotonic())
+            statistics = {
+                'in_flight': len(self.correlations),
+                'completed': self.completed_count,
+                'evicted': self.evicted_count,
+            }
+        self.expire(evicted)
+        return statistics
+
+
 class ClientSocketProcessor(Processor):
-    def __init__(self, host: str, port: int, timout: float = 3, encoding='utf-8') -> None:
-        self.callbacks: Dict[str, Callable[[Message], None]] = {}  # 回调映射，uuid->callback
+    def __init__(self, host: str, port: int, timout: float = 3, encoding='utf-8',
+                 codecs=(TextCodec.name,), correlation_ttl: float = 600, correlation_capacity: int = 4096) -> None:
+        self.correlations = CorrelationTable(correlation_ttl, correlation_capacity)  # 请求关联表
         connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         logger.info(f'Connecting to MessageQueue Server on {host}:{port}')
         connection.connect((host, port))
         logger.info(f'Connection established')
 
-        self.proxy = ConnectionProxy(connection, timout, encoding)
+        self.proxy = ConnectionProxy(connection, timout, encoding, codecs)
         self.proxy.onReceiving(self.onReceiving)  # 执行回调
         self.proxy.onLaunching(ClientSocketProcessor.launchingProxy)
         self.proxy.onClosing(lambda reason: logger.info(f'ConnectionProxy Closed: {reason}'))
 
-    def send(self, message, callback: Callable[[Message], None] = None) -> None:
+    def send(self, message, callback: Callable[[Message], None] = None, terminal_codes=()) -> futures.Future or None:
         """
         直接发送消息实例，消息回传之后会执行回调函数
         :param message: message实例
         :param callback: 回调函数，在请求响应时会被调用
+        :param terminal_codes: 终止响应码，例如TERMINAL_CODES，收到之后完成返回的Future并且不再调用回调，
+            为空时关联项在ttl时间内没有收到响应后被淘汰
+        :return: 终止响应的Future，不需要响应时返回None
         """
-        if callback:
-            callback_id = str(uuid.uuid4())
+        future = None
+        if callback or terminal_codes:
+            callback_id, future = self.correlations.register(callback, terminal_codes)
             message.setHeader('callback_id', callback_id)  # 注册回调
-            self.callbacks[callback_id] = callback
         self.proxy.send(message)  # 发送消息
+        return future
+
+    def request(self, message: Message, callback: Callable[[Message], None] = None) -> futures.Future:
+        """ 发送请求，返回最终响应(TERMINAL_CODES)的Future，最终响应之前的进度响应交给回调 """
+        return self.send(message, callback, TERMINAL_CODES)
+
+    def getStatistics(self) -> Dict[str, float]:
+        return self.correlations.getStatistics()
 
     @staticmethod
     def launchingProxy() -> bool:
@@ -336,9 +1204,7 @@ class ClientSocketProcessor(Processor):
     def onReceiving(self, message: Message) -> None:
         callback_id = message.getHeader('callback_id')
         if callback_id:
-            callback = self.callbacks.get(callback_id)
-            if callback:
-                callback(message)
+            self.correlations.dispatch(callback_id, message)
 
     def terminate(self, synchronized: bool = False):
         self.proxy.terminate()
@@ -346,12 +1212,336 @@ class ClientSocketProcessor(Processor):
             self.proxy.join()
 
 
+class RequestError(Exception):
+    """ 请求失败或者被拒绝，response为失败响应 """
+
+    def __init__(self, response: Message):
+        super().__init__(f'{response.get("code")}: {response.get("message")}')
+        self.response = response
+
+
+class AsyncClient(CodecNegotiator):
+    """
+    基于asyncio的客户端，与ClientSocketProcessor采用相同的帧格式和消息类型，一个事件循环可以驱动多个连接以及并发的多个任务，
+    request返回请求的最终响应（例如任务的启动响应），stream逐条产出任务每一帧的拍摄响应
+    """
+
+    def __init__(self, host: str, port: int, encoding='utf-8', codecs=(TextCodec.name,),
+                 correlation_ttl: float = 600, correlation_capacity: int = 4096):
+        self.host = host
+        self.port = port
+        self.encoding = encoding
+        self.codecs = [name for name in codecs if name in CODECS]
+        self.codec = TextCodec
+        self.correlations = CorrelationTable(correlation_ttl, correlation_capacity)  # 请求关联表
+        self.streams = set()  # 正在迭代的响应队列，连接关闭时唤醒
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.receiver: asyncio.Future = None  # 响应接收协程
+
+    async def connect(self):
+        logger.info(f'Connecting to MessageQueue Server on {self.host}:{self.port}')
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.receiver = asyncio.ensure_future(self.receive())
+        logger.info(f'Connection established')
+        return self
+
+    async def close(self) -> None:
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.receiver.cancel()
+        await asyncio.gather(self.receiver, return_exceptions=True)
+        self.writer = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def write(self, message: Message) -> None:
+        data = self.codec.encode(message, self.encoding)
+        self.writer.write(len(data).to_bytes(4, byteorder='big') + data)
+
+    async def send(self, message: Message) -> None:
+        """ 发送消息，不等待响应 """
+        self.write(message)
+        await self.writer.drain()
+
+    async def request(self, message: Message, timeout: float = None) -> Message:
+        """
+        发送请求，等待最终响应(TERMINAL_CODES)，例如拍摄请求的启动响应201或者失败响应400，此后的进度响应被忽略
+        :param timeout: 等待时间，超时抛出asyncio.TimeoutError
+        """
+        callback_id, future = self.correlations.register(None, TERMINAL_CODES)
+        message.setHeader('callback_id', callback_id)
+        await self.send(message)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self.correlations.complete(callback_id)
+            raise
+
+    async def stream(self, message: Message, frames: int = None):
+        """
+        发送拍摄请求，逐条产出每一帧的拍摄响应(200)，后端不会发出任务完成的响应，因此与前端界面一致，
+        收到frames帧响应（包括被忽略的403）之后结束，frames为None时持续产出直到调用方停止迭代，
+        横移连拍的帧数为x_split * y_split；请求头携带AGGREGATE_HEADER时产出汇总响应(206)，按照其中的帧数计数；
+        任务启动失败或者请求被拒绝时抛出RequestError
+        """
+        responses = asyncio.Queue()
+        callback_id, _ = self.correlations.register(responses.put_nowait)
+        message.setHeader('callback_id', callback_id)
+        self.streams.add(responses)
+        try:
+            await self.send(message)
+            count = 0
+            while frames is None or count < frames:
+                response = await responses.get()
+                if response is None:  # 连接已关闭
+                    raise ConnectionError('Connection closed before the acquisition finished')
+                code = response.get('code')
+                if code == '200':
+                    count += 1
+                    yield response
+                elif code == '403':  # 拍摄请求被忽略
+                    count += 1
+                elif code == AGGREGATE_CODE:
+                    count += int(response.get('done')) + int(response.get('ignored'))
+                    yield response
+                elif code in TERMINAL_CODES and code not in ('201', '202'):
+                    raise RequestError(response)
+        finally:
+            self.streams.discard(responses)
+            self.correlations.complete(callback_id)
+
+    async def receive(self) -> None:
+        reason = 'normal'
+        try:
+            while True:
+                length_prefix = await self.reader.readexactly(4)
+                length = int.from_bytes(length_prefix, byteorder='big')  # 获取数据长度
+                message = decodeMessage(await self.reader.readexactly(length), self.encoding)
+                if message is None or self.negotiate(message):
+                    continue
+                callback_id = message.getHeader('callback_id')
+                if callback_id:
+                    self.correlations.dispatch(callback_id, message)
+        except asyncio.IncompleteReadError:
+            pass
+        except asyncio.CancelledError:
+            reason = 'Client closing'
+        except ConnectionError:
+            reason = 'Detected connection reset'
+        finally:
+            logger.info(f'Connection to {self.host}:{self.port} closed: {reason}')
+            self.correlations.abort(ConnectionError(f'Connection closed: {reason}'))
+            for responses in self.streams:
+                responses.put_nowait(None)
+
+
+class ProgressAggregator:
+    """
+    逐帧响应汇总，请求头中携带AGGREGATE_HEADER时，按照(地址, callback_id)累计该请求的逐帧响应(200/403)，
+    每个汇总间隔发出一条汇总响应(206)，其余响应（例如启动、停止、失败响应）立即发出，发出之前先发出已累计的汇总，保持响应顺序；
+    逐帧响应携带区域序号(TILE_KEY)时，汇总响应以区间编码给出间隔内完成(tiles)和忽略(ignored_tiles)的区域
+    """
+    min_interval = 0.01  # 最小汇总间隔，单位为秒
+
+    class Summary:
+        def __init__(self, head: Dict[str, str], deadline: float):
+            self.head = dict(head)  # 汇总响应沿用逐帧响应的消息头
+            self.deadline = deadline  # 发出汇总响应的时间
+            self.done = 0  # 完成帧数
+            self.ignored = 0  # 忽略帧数
+            self.timestamp = 0  # 最后一帧的到达时间
+            self.done_tiles: List[int] = []  # 完成的区域序号
+            self.ignored_tiles: List[int] = []  # 忽略的区域序号
+
+        def toMessage(self) -> Message:
+            summary = Message()
+            summary.head = self.head
+            summary.set('code', AGGREGATE_CODE)
+            summary.set('done', self.done)
+            summary.set('ignored', self.ignored)
+            summary.set('timestamp', self.timestamp)
+            if self.done_tiles:
+                summary.set('tiles', encodeRanges(self.done_tiles))
+            if self.ignored_tiles:
+                summary.set('ignored_tiles', encodeRanges(self.ignored_tiles))
+            return summary
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval  # 请求头中的汇总间隔无法解析时采用的默认间隔
+        self.summaries: Dict[Tuple[str, str], ProgressAggregator.Summary] = {}  # (地址, callback_id)->累计中的汇总
+        self.frame_count = 0  # 被汇总的逐帧响应数
+        self.summary_count = 0  # 发出的汇总响应数
+
+    def parseInterval(self, value: str) -> float:
+        try:
+            interval = float(value)
+        except ValueError:
+            return self.interval
+        return max(interval, self.min_interval) if interval > 0 else self.interval
+
+    def offer(self, message: Message) -> List[Message]:
+        """
+        处理一条响应
+        :return: 需要立即发出的响应
+        """
+        interval = message.getHeader(AGGREGATE_HEADER)
+        if interval is None:
+            return [message]
+
+        key = (message.getHeader('address'), message.getHeader('callback_id'))
+        code = message.get('code')
+        if code in FRAME_CODES:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = ProgressAggregator.Summary(
+                    message.head, time.monotonic() + self.parseInterval(interval))
+            tile = message.get(TILE_KEY)
+            if code == '200':
+                summary.done += 1
+                if tile is not None:
+                    summary.done_tiles.append(int(tile))
+            else:
+                summary.ignored += 1
+                if tile is not None:
+                    summary.ignored_tiles.append(int(tile))
+            summary.timestamp = time.time()
+            self.frame_count += 1
+            return []
+
+        summary = self.summaries.pop(key, None)
+        if summary is None:
+            return [message]
+        self.summary_count += 1
+        return [summary.toMessage(), message]
+
+    def expire(self) -> List[Message]:
+        """ 取出已经到达汇总间隔的汇总响应 """
+        now = time.monotonic()
+        expired = [key for key, summary in self.summaries.items() if summary.deadline <= now]
+        self.summary_count += len(expired)
+        return [self.summaries.pop(key).toMessage() for key in expired]
+
+    def nextDeadline(self) -> float or None:
+        """ 距离下一条汇总响应的时间，没有累计中的汇总时返回None """
+        if not self.summaries:
+            return None
+        return max(0.0, min(summary.deadline for summary in self.summaries.values()) - time.monotonic())
+
+    def getStatistics(self) -> Dict[str, float]:
+        return {
+            'aggregating': len(self.summaries),
+            'aggregated_frames': self.frame_count,
+            'summaries': self.summary_count,
+        }
+
+
+class LatencyTracer:
+    """
+    逐跳延迟追踪，启用后中间件在请求经过的每一跳写入单调时钟时间戳请求头：前端请求到达(trace_recv)、
+    管道写线程取出请求(trace_write)、管道读线程读取响应(trace_read)，后端复制请求头到响应中，
+    响应管道发出响应时计算各阶段耗时并移除这些请求头，前端请求自带的追踪请求头在提交时移除；
+    各阶段耗时按照对数分桶统计，未启用时各组件仅做一次布尔判断
+    阶段：request（前端请求到达 -> 管道写线程取出）、pipe_write（管道写线程取出 -> 写入完成，即等待后端读取上一批请求的握手时间）、
+    backend（管道写线程取出 -> 读取到响应）、response（读取到响应 -> 写入前端连接）、total（前端请求到达 -> 写入前端连接），
+    其中request、backend和total仅统计最终响应(TERMINAL_CODES)，逐帧响应的backend耗时为任务已经执行的时间，不代表延迟
+    """
+    HOPS = ('trace_recv', 'trace_write', 'trace_read')
+    STAGES = ('request', 'pipe_write', 'backend', 'response', 'total')
+    resolution = 8  # 每倍耗时的分桶数，分位数的相对误差约为9%
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Dict[int, int]] = {}  # 阶段 -> 分桶序号 -> 次数
+        self.since = time.monotonic()  # 统计开始时间
+
+    @staticmethod
+    def stamp(message: Message, hop: str) -> None:
+        message.setHeader(hop, time.monotonic())
+
+    @classmethod
+    def strip(cls, message: Message) -> None:
+        """ 移除前端请求自带的追踪请求头，追踪请求头只能由中间件写入 """
+        for hop in cls.HOPS:
+            message.head.pop(hop, None)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        bucket = math.floor(math.log2(max(seconds, 1e-7)) * self.resolution)
+        with self.lock:
+            histogram = self.histograms.setdefault(stage, {})
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def record(self, message: Message) -> None:
+        """ 响应发出时记录各阶段耗时，并移除追踪请求头 """
+        try:
+            hops = {hop: float(message.head.pop(hop)) for hop in self.HOPS if hop in message.head}
+        except ValueError:  # 后端回传了无法解析的时间戳，放弃该样本
+            self.strip(message)
+            return
+        if not hops:
+            return
+        now = time.monotonic()
+        if 'trace_read' in hops:
+            self.observe('response', now - hops['trace_read'])
+        if message.get('code') not in TERMINAL_CODES:
+            return
+        if 'trace_recv' in hops:
+            self.observe('total', now - hops['trace_recv'])
+        if 'trace_write' in hops:
+            if 'trace_recv' in hops:
+                self.observe('request', hops['trace_write'] - hops['trace_recv'])
+            if 'trace_read' in hops:
+                self.observe('backend', hops['trace_read'] - hops['trace_write'])
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms = {}
+            self.since = time.monotonic()
+
+    def getStatistics(self) -> Dict[str, Dict[str, float]]:
+        """ 各阶段的次数、每秒次数以及p50、p95、p99耗时，单位为毫秒，分位数取所在分桶的上界 """
+        with self.lock:
+            histograms = {stage: sorted(histogram.items()) for stage, histogram in self.histograms.items()}
+            elapsed = max(time.monotonic() - self.since, 1e-6)
+        statistics = {}
+        for stage in self.STAGES:
+            buckets = histograms.get(stage)
+            if not buckets:
+                continue
+            count = sum(times for _, times in buckets)
+            result = {'count': count, 'per_sec': count / elapsed}
+            for name, p in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+                rank, seen = math.ceil(count * p), 0
+                for bucket, times in buckets:
+                    seen += times
+                    if seen >= rank:
+                        result[name] = 2 ** ((bucket + 1) / self.resolution) * 1000
+                        break
+            statistics[stage] = result
+        return statistics
+
+
 class ServerSocketProcessor(Processor):
-    def __init__(self, host: str, port: int, timeout: float = 3, encoding='utf-8'):
+    def __init__(self, host: str, port: int, timeout: float = 3, encoding='utf-8', codecs=(TextCodec.name,),
+                 flush_interval: float = 0, queue_size: int = 0, slow_policy: str = 'block', buffer_size: int = 0,
+                 aggregate_interval: float = 0.5, tracer: LatencyTracer = None):
         self.host = host  # 服务器绑定主机
         self.port = port  # 服务器绑定端口
         self.timeout = timeout  # 超时时间
         self.encoding = encoding  # 编解码字符集
+        self.codecs = codecs  # 支持的编码格式，按优先级排列
+        self.flush_interval = flush_interval  # 响应合并写出窗口
+        self.queue_size = queue_size  # 每个连接的待写出队列容量，单位为帧
+        self.slow_policy = slow_policy  # 待写出队列已满时的处理策略
+        self.buffer_size = buffer_size  # 请求管道和响应管道的缓冲容量，单位为消息条数
+        self.aggregate_interval = aggregate_interval  # 逐帧响应的默认汇总间隔
+        self.tracer = tracer or LatencyTracer()  # 逐跳延迟追踪，与DMProcessor共用
 
         self.connection_builder = self.ConnectionBuilder(self)  # 连接构建器
         self.connection_context = self.ConnectionContext(self)  # 连接上下文
@@ -364,6 +1554,42 @@ class ServerSocketProcessor(Processor):
     def linkTo(self, pip_component: PipComponent):
         self.request_pipline.link(pip_component)
 
+    def getStatistics(self) -> Dict[str, Dict[str, float]]:
+        """
+        各个连接的收发统计，地址->统计数据，其中queue_depth为待写出队列深度，
+        不获取连接上下文的锁，字典复制在解释器中一次完成，连接建立或断开时不会读到不完整的字典
+        """
+        proxies = dict(self.connection_context.connection_context)
+        return {address: proxy.getStatistics() for address, proxy in proxies.items()}
+
+    def getPiplineStatistics(self) -> Dict[str, Dict[str, float]]:
+        """ 请求管道和响应管道的缓冲统计 """
+        return {
+            'RequestPipline': self.request_pipline.getStatistics(),
+            'ResponsePipline': self.response_pipline.getStatistics(),
+            'ProgressAggregator': self.response_pipline.aggregator.getStatistics(),
+        }
+
+    def submit(self, message: Message) -> None:
+        """
+        提交前端请求，请求管道已满时不等待，通过响应管道向前端回复繁忙响应，
+        避免阻塞连接的接收线程或者事件循环，响应管道同样已满时放弃回复
+        """
+        LatencyTracer.strip(message)  # 追踪请求头由前端控制时会破坏统计，无论是否启用追踪都移除
+        if self.tracer.enabled:
+            LatencyTracer.stamp(message, 'trace_recv')
+        if self.request_pipline.postMessage(message, 0):
+            return
+        logger.debug(f'Request pipline is full, reject request from {message.getHeader("address")}')
+        self.response_pipline.postMessage(busyResponse(message, 'Middleware is busy, retry later'), 0)
+
+    def submitClosing(self, address) -> None:
+        """ 向后端提交连接断开事件，断开事件用于释放后端资源，忽略缓冲容量 """
+        connection_closing_message = Message()
+        connection_closing_message.setHeader('address', address)
+        connection_closing_message.set('name', 'ConnectionClosing')
+        self.request_pipline.input_buffer.force(connection_closing_message)
+
     def launch(self):  # 启动服务端处理器
         self.connection_builder.start()
         self.request_pipline.start()
@@ -430,19 +1656,19 @@ class ServerSocketProcessor(Processor):
             self.connection_context: Dict[str, ConnectionProxy] = {}
 
         def addConnection(self, address, connection: socket, timeout=3, encoding='utf-8'):
-            proxy = ConnectionProxy(connection, timeout, encoding)  # 创建代理
+            proxy = ConnectionProxy(connection, timeout, encoding, self.app_context.codecs, offering=True,
+                                    flush_interval=self.app_context.flush_interval,
+                                    queue_size=self.app_context.queue_size,
+                                    slow_policy=self.app_context.slow_policy)  # 创建代理
 
             def onClosing(reason: str) -> None:  # 构建代理对象
                 logger.info(f'Connection {str(address)} closed: {reason}')
-                connection_closing_message = Message()  # 向后端提交连接断开事件
-                connection_closing_message.setHeader('address', address)
-                connection_closing_message.set('name', 'ConnectionClosing')
-                self.app_context.request_pipline.postMessage(connection_closing_message)
+                self.app_context.submitClosing(address)  # 向后端提交连接断开事件
                 self.remConnection(address)
 
             def onReceiving(message: Message) -> None:
                 message.setHeader('address', address)  # 设置头部信息
-                self.app_context.request_pipline.postMessage(message)  # 提交请求到输出管道
+                self.app_context.submit(message)  # 提交请求到输出管道
 
             proxy.onClosing(onClosing)  # 线程退出时需要退出上下文
             proxy.onReceiving(onReceiving)  # 代理会将接收到的消息提交给消息队列
@@ -477,33 +1703,277 @@ class ServerSocketProcessor(Processor):
 
     class RequestPipline(PipComponent):
         def __init__(self, app_context):
-            super().__init__(app_context.timeout)
+            super().__init__(app_context.timeout, app_context.buffer_size)
             self.app_context = app_context
 
     class ResponsePipline(PipComponent):
         def __init__(self, app_context):
-            super().__init__(app_context.timeout)
+            super().__init__(app_context.timeout, app_context.buffer_size)
             self.is_terminated = False
             self.app_context = app_context
+            self.aggregator = ProgressAggregator(app_context.aggregate_interval)  # 逐帧响应汇总
+
+        def onHandlingBatch(self, messages: List[Message]) -> None:
+            outputs = []
+            for message in messages:
+                outputs.extend(self.aggregator.offer(message))
+            outputs.extend(self.aggregator.expire())
+            self.deliver(outputs)
+
+        def pollTimeout(self) -> float:
+            deadline = self.aggregator.nextDeadline()
+            return self.timeout if deadline is None else min(self.timeout, deadline)
+
+        def onIdle(self) -> None:
+            self.deliver(self.aggregator.expire())
+
+        def deliver(self, messages: List[Message]) -> None:
+            """ 按照地址分组，同一连接的响应作为一批写入其待写出队列 """
+            groups: Dict[str, List[Message]] = {}
+            tracer = self.app_context.tracer
+            for message in messages:
+                if tracer.enabled:
+                    tracer.record(message)
+                address = message.getHeader('address')
+                if not address:  # 地址不存在
+                    logger.error(f'\'address\' cannot be found at {message}')
+                    continue
+                groups.setdefault(address, []).append(message)
 
-        def onHandling(self, message):
-            address = message.getHeader('address')
-            if not address:  # 地址不存在
-                logger.error(f'\'address\' cannot be found at {message}')
-                return
+            for address, group in groups.items():
+                proxy = self.app_context.connection_context.getConnection(address)
+                if not proxy:  # 连接不存在
+                    logger.error(f'Hit nonexistent connection for {address}')
+                    continue
+                proxy.sendBatch(group)  # 响应消息
+
+
+class AsyncServerSocketProcessor(ServerSocketProcessor):
+    """
+    基于asyncio的服务端处理器，所有连接运行在同一个事件循环线程中，不再为每个连接创建代理线程，
+    对DMProcessor暴露的getNode()/linkTo()接口以及请求、响应管道与ServerSocketProcessor一致
+    """
 
-            proxy = self.app_context.connection_context.getConnection(address)  # 通过连接发送请求
-            if not proxy:  # 连接不存在
-                logger.error(f'Hit nonexistent connection for {address}')
+    class ConnectionProxy(CodecNegotiator):
+        """
+        事件循环中的连接代理，send方法可以在任意线程调用，消息进入连接的待写出队列，
+        由该连接的写出协程取出之后交给传输层，传输层缓冲区超过高水位时写出协程等待对端接收，
+        期间到达的消息留在有界的待写出队列中，按照策略处理
+        """
+
+        def __init__(self, app_context, address, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+            self.app_context = app_context
+            self.address = address
+            self.writer = writer
+            self.loop = loop
+            self.encoding = app_context.encoding
+            self.codecs = [name for name in app_context.codecs if name in CODECS]
+            self.codec = TextCodec
+            self.ready = asyncio.Event()  # 待写出队列非空
+            self.queue = OutboundQueue(app_context.queue_size, app_context.slow_policy, self.wake)
+            self.write_count = 0  # 写出次数
+            self.frame_count = 0  # 写出帧数
+            self.max_frames_per_write = 0  # 单次写出的最大帧数
+            self.request_count = 0  # 接收的消息数，仅由事件循环修改
+            self.response_count = 0  # 发送的消息数，仅由响应管道线程修改
+
+        def send(self, message: Message) -> None:
+            if not message:
+                logger.error('A NULL message cannot be sent')
                 return
+            self.response_count += 1
+            self.write(message)
+
+        def write(self, message: Message) -> None:
+            data = self.codec.encode(message, self.encoding)
+            if not self.queue.put(data, message.get('code') in PROGRESS_CODES) and not self.queue.is_closed:
+                logger.warning(f'Disconnect slow consumer {self.address}, {self.queue.capacity} frames pending')
+                self.abort()
+
+        def sendBatch(self, messages: List[Message]) -> None:
+            frames = [(self.codec.encode(message, self.encoding), message.get('code') in PROGRESS_CODES)
+                      for message in messages if message]
+            self.response_count += len(frames)
+            if not self.queue.putBatch(frames) and not self.queue.is_closed:
+                logger.warning(f'Disconnect slow consumer {self.address}, {self.queue.capacity} frames pending')
+                self.abort()
+
+        def wake(self) -> None:
+            try:
+                self.loop.call_soon_threadsafe(self.ready.set)
+            except RuntimeError:  # 事件循环已经关闭
+                pass
+
+        def abort(self) -> None:
+            """ 丢弃待写出的帧并断开连接 """
+            self.queue.close()
+            self.queue.take()
+            try:
+                self.loop.call_soon_threadsafe(self.writer.transport.abort)
+            except RuntimeError:
+                pass
+
+        async def drain(self) -> None:
+            """ 连接的写出协程 """
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                if self.app_context.flush_interval > 0:
+                    await asyncio.sleep(self.app_context.flush_interval)  # 收集合并窗口内的后续帧
+                buffers = self.queue.take()
+                if not buffers:
+                    continue
+                self.writer.writelines(buffers)  # 合并窗口内的所有帧一次交给传输层
+                frames = len(buffers) // 2
+                self.write_count += 1
+                self.frame_count += frames
+                self.max_frames_per_write = max(self.max_frames_per_write, frames)
+                try:
+                    await self.writer.drain()  # 传输层缓冲区超过高水位时等待对端接收
+                except ConnectionError:  # 连接已断开，由连接处理协程负责清理
+                    return
 
-            proxy.send(message)  # 响应消息
+        def getStatistics(self) -> Dict[str, float]:
+            return {
+                'request_count': self.request_count,
+                'response_count': self.response_count,
+                'write_count': self.write_count,
+                'frame_count': self.frame_count,
+                'frames_per_write': self.frame_count / self.write_count if self.write_count else 0,
+                'max_frames_per_write': self.max_frames_per_write,
+                'pending_frames': len(self.queue.droppable),
+                **self.queue.getStatistics(),
+            }
+
+    class ConnectionBuilder(threading.Thread):
+        """
+        连接构建器，在独立线程中运行事件循环，监听客户端连接并在事件循环中处理所有连接的读写
+        """
+
+        def __init__(self, app_context):
+            super().__init__()
+            self.app_context = app_context  # 应用程序上下文
+            self.loop = asyncio.new_event_loop()
+            self.stopping = None  # 停止事件，在事件循环中创建
+
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.bind((self.app_context.host, self.app_context.port))
+
+        def run(self):
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self.serve())
+            finally:
+                self.loop.close()
+
+        async def serve(self):
+            self.stopping = asyncio.Event()
+            server = await asyncio.start_server(self.handle, sock=self.server)
+            logger.info(f'Connection Builder launched on event loop, listening connection '
+                        f'from {self.app_context.host}:{self.app_context.port}')
+            await self.stopping.wait()
+
+            server.close()  # 停止监听，关闭所有连接
+            handlers = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await server.wait_closed()
+
+        async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            address = writer.get_extra_info('peername')
+            logger.info(f'Accept connection from {address[0]}:{address[1]}')
+            proxy = self.app_context.ConnectionProxy(self.app_context, address, writer, self.loop)
+            self.app_context.connection_context.addConnection(address, proxy)
+            drainer = asyncio.ensure_future(proxy.drain())  # 连接的写出协程
+            proxy.offerCodecs()
+
+            closing_reason = 'normal'
+            try:
+                while True:
+                    length_prefix = await reader.readexactly(4)
+                    length = int.from_bytes(length_prefix, byteorder='big')  # 获取数据长度
+                    message = decodeMessage(await reader.readexactly(length), self.app_context.encoding)
+                    if message is None or proxy.negotiate(message):
+                        continue
+                    proxy.request_count += 1
+                    message.setHeader('address', address)  # 设置头部信息
+                    self.app_context.submit(message)  # 提交请求到输出管道
+            except asyncio.IncompleteReadError:
+                pass
+            except asyncio.CancelledError:
+                closing_reason = 'Middleware terminating'
+            except ConnectionResetError:
+                closing_reason = 'Detected connection reset'
+            finally:
+                proxy.queue.close()
+                drainer.cancel()
+                writer.close()
+                self.app_context.connection_context.closeConnection(address, closing_reason)
+
+        def terminate(self):
+            if self.stopping is not None:
+                self.loop.call_soon_threadsafe(self.stopping.set)
+
+    class ConnectionContext:
+        def __init__(self, app_context):
+            self.is_terminated = False
+            self.lock = threading.RLock()  # 全局锁
+            self.app_context = app_context
+            self.connection_context: Dict[str, AsyncServerSocketProcessor.ConnectionProxy] = {}
+
+        def addConnection(self, address, proxy) -> None:
+            with self.lock:
+                self.connection_context[str(address)] = proxy
+
+        def getConnection(self, address):
+            return self.connection_context.get(str(address))
+
+        def closeConnection(self, address, reason: str) -> None:
+            logger.info(f'Connection {str(address)} closed: {reason}')
+            self.app_context.submitClosing(address)  # 向后端提交连接断开事件
+            with self.lock:
+                self.connection_context.pop(str(address), None)
+
+        def terminate(self) -> None:  # 连接随事件循环一同关闭
+            self.is_terminated = True
+
+        def join(self):
+            pass
+
+
+class Properties:
+    """
+    Properties配置文件类
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def get_prop(self):
+        try:
+            pro_file = open(self.file_name, 'r', encoding='utf-8')
+            properties = {}
+            for line in pro_file:
+                if line.find('=') > 0:
+                    strs = line.replace('\n', '').split('=')
+                    properties[strs[0]] = strs[1]
+        except Exception as e:
+            raise e
+        else:
+            pro_file.close()
+        return properties
 
 
 class DMProcessor(Processor):
     def __init__(self, **kwargs):
         self.timeout = kwargs['timeout']
         self.encoding = kwargs['encoding']
+        self.transport = kwargs.get('transport', 'file')  # 传输方式
+        self.batch_window = kwargs.get('batch_window', 0)  # 请求组提交窗口
+        self.batch_size = kwargs.get('batch_size', 256)  # 单批最大请求数
+        self.log_messages = kwargs.get('log_messages', False)  # 是否逐条记录后端响应
+        self.buffer_size = kwargs.get('buffer_size', 0)  # 管道写线程的缓冲容量，单位为消息条数
+        self.tracer = kwargs.get('tracer') or LatencyTracer()  # 逐跳延迟追踪，与ServerSocketProcessor共用
 
         self.input_pip_path = kwargs['input_pip_path']
         self.input_pip_lock = kwargs['input_pip_lock']
@@ -511,12 +1981,13 @@ class DMProcessor(Processor):
         self.output_pip_lock = kwargs['output_pip_lock']
 
         # 检查管道文件是否存在
-        if not os.path.exists(self.input_pip_path):
+        if self.transport == 'file' and not os.path.exists(self.input_pip_path):
             logger.error('Unable to find pip file, check if a dm script is running')
 
-        if not os.path.exists(self.output_pip_path):
+        if self.transport == 'file' and not os.path.exists(self.output_pip_path):
             logger.error('Unable to find pip file, check if a dm script is running')
 
+        self.input_channel, self.output_channel = createChannels(kwargs, 'middleware')
         self.pip_writer = self.PipFileWriter(self)
         self.pip_reader = self.PipFileReader(self)
 
@@ -526,6 +1997,12 @@ class DMProcessor(Processor):
     def linkTo(self, pip_component: PipComponent):
         self.pip_reader.linkTo(pip_component)
 
+    def getStatistics(self) -> Dict[str, Dict[str, float]]:
+        return {
+            'PipFileWriter': self.pip_writer.getStatistics(),
+            'PipFileReader': self.pip_reader.getStatistics(),
+        }
+
     def launch(self):
         self.pip_writer.start()
         self.pip_reader.start()
@@ -538,45 +2015,115 @@ class DMProcessor(Processor):
             self.pip_reader.join()
 
     class PipFileWriter(PipComponent):
+        """
+        消息中间件 -> 后端输入管道，组提交写出：取得一条请求之后继续收集batch_window时间内（最多batch_size条）到达的请求，
+        拼接为换行分隔的记录一次写出，写出完成之后才释放锁文件；后端尚未读取上一批请求时继续收集，直到通道可写，
+        缓存达到batch_size之后不再取出请求，积压留在有界的输入缓冲中，由请求管道向前端回复繁忙响应
+        """
+        retry_interval = 0.005  # 通道不可写时的重试间隔
+
         def __init__(self, app_context):
-            super().__init__(app_context.timeout)
+            super().__init__(app_context.timeout, app_context.buffer_size,
+                             app_context.batch_size, app_context.batch_window)  # 单批最大记录数以及组提交窗口
             self.app_context = app_context
-            self.request_cache: List[Message] = []
+            self.channel = app_context.input_channel
+            self.request_cache: List[str] = []  # 等待写出的记录
+            self.cache_since = 0  # 缓存中最早一条记录的取得时间
+            self.batch_count = 0  # 写出批次数
+            self.record_count = 0  # 写出记录数
+            self.max_batch_size = 0  # 单批写出的最大记录数
+            self.batch_latencies = collections.deque(maxlen=1024)  # 最近批次从取得第一条记录到写出完成的耗时
 
         def onClosing(self, reason: str) -> None:
+            self.commit()  # 尽力写出剩余的请求
+            if self.request_cache:
+                logger.warning(f'PipFileWriter dropped {len(self.request_cache)} requests on shutdown')
+            self.channel.close()
             logger.debug(f'PipFileWriter shutdown: {reason}')
 
         def onHandling(self, request: Message) -> None:
-            self.request_cache.append(request)  # 将读取的消息加入缓存
-            if not os.path.exists(self.app_context.input_pip_lock):  # 锁文件不存在，不允许写入
-                return
+            self.cache(request)
+            self.commit()
+
+        def onHandlingBatch(self, requests: List[Message]) -> None:
+            for request in requests:
+                self.cache(request)
+            self.commit()
+
+        def cache(self, request: Message) -> None:
+            if not self.request_cache:
+                self.cache_since = time.perf_counter()
+            if self.app_context.tracer.enabled:
+                LatencyTracer.stamp(request, 'trace_write')
+            self.request_cache.append(Message.dumps(request))
+
+        def commit(self) -> bool:
+            """
+            将缓存的记录作为一批写出
+            :return: 缓存是否已经全部写出
+            """
+            if not self.request_cache:
+                return True
+            written = self.channel.write(self.request_cache)
+            if written:
+                self.batch_count += 1
+                self.record_count += written
+                self.max_batch_size = max(self.max_batch_size, written)
+                self.batch_latencies.append(time.perf_counter() - self.cache_since)
+                if self.app_context.tracer.enabled:
+                    self.app_context.tracer.observe('pipe_write', self.batch_latencies[-1])
+                del self.request_cache[:written]
+                self.cache_since = time.perf_counter()
+            return not self.request_cache
 
-            input_pip = open(self.app_context.input_pip_path, 'w', encoding=self.app_context.encoding)  # 锁文件存在，允许写入
-            try:
-                for cache in self.request_cache:
-                    input_pip.writelines(Message.dumps(cache))
-                    input_pip.flush()
-            finally:
-                self.request_cache.clear()  # 清空缓存列表
-                input_pip.close()  # 关闭文件流
-
-            try:  # 删除锁文件，触发DM进程读消息
-                os.remove(self.app_context.input_pip_lock)
-            except OSError as e:
-                logger.error(f'Unable handle deleting input_pip_lock file at {self.app_context.input_pip_path}: {e}')
+        def run(self):
+            reason = 'normal'
+            while not self.is_terminated:
+                if len(self.request_cache) >= self.batch_size:  # 缓存已满，停止取出请求，等待通道可写
+                    time.sleep(self.retry_interval)
+                    self.commit()
+                    continue
+                try:  # 缓存为空时等待下一条请求，否则按照重试间隔等待通道可写，随后收集组提交窗口内的后续请求
+                    requests = self.input_buffer.getBatch(self.batch_size - len(self.request_cache),
+                                                          self.retry_interval if self.request_cache else self.timeout,
+                                                          self.batch_window)
+                except queue.Empty:
+                    if not self.commit() or not self.is_terminated:
+                        continue
+                    reason = 'timeout'
+                    break
+                self.onHandlingBatch(requests)
+            self.onClosing(reason)
+
+        def getStatistics(self) -> Dict[str, float]:
+            latencies = sorted(self.batch_latencies.copy())  # 复制在解释器中一次完成，不受写线程追加的影响
+            return {
+                'batch_count': self.batch_count,
+                'record_count': self.record_count,
+                'records_per_batch': self.record_count / self.batch_count if self.batch_count else 0,
+                'max_records_per_batch': self.max_batch_size,
+                'batch_latency_p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+                'batch_latency_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+                'pending_records': len(self.request_cache),
+                **self.input_buffer.getStatistics(),
+            }
 
     class PipFileReader(threading.Thread):
         """
         后端输出管道 -> 消息中间件
-        锁文件output_pip_lock不存在的时候可以读取，读取完成之后需要手动创建锁文件，允许后端进程继续写入响应，
-        锁文件存在的时候不允许读取，output_pip_lock锁文件由 中间件进程 维护
+        由输出通道等待并读取后端写出的响应，file传输下锁文件output_pip_lock不存在的时候可以读取，
+        读取完成之后重新创建锁文件，允许后端进程继续写入响应；响应管道已满时暂停读取，后端随之等待
         """
 
         def __init__(self, app_context):
             super().__init__()
             self.is_terminated = False
             self.app_context = app_context
+            self.channel = app_context.output_channel
             self.next_node = None
+            self.stall_count = 0  # 因响应管道已满而暂停读取的次数
+            self.read_count = 0  # 读取批次数
+            self.line_count = 0  # 读取的响应条数
 
         def linkTo(self, node: PipComponent):  # 连接输出管道
             self.next_node = node
@@ -587,30 +2134,32 @@ class DMProcessor(Processor):
         def onClosing(self, reason):
             logger.debug(f'PipFileReader shutdown: {reason}')
 
+        def getStatistics(self) -> Dict[str, float]:
+            return {'stalled_reads': self.stall_count, 'read_count': self.read_count, 'line_count': self.line_count}
+
         def run(self) -> None:
+            logger.debug(f'PipFileReader reading {self.app_context.output_pip_path} by {self.channel.name} transport')
             while not self.is_terminated:
-                time.sleep(0.1)  # 应该避免过度频繁地读取管道文件
-                if not os.path.exists(self.app_context.output_pip_lock):  # 锁文件不存在时可以执行读取操作
-                    read_pip = None
-                    try:
-                        read_pip = open(self.app_context.output_pip_path, 'r', encoding=self.app_context.encoding)
-                        for line in read_pip:
-                            message = Message.loads(line.strip())
-                            logger.debug(f"line from output pip : {message}")
-                            if self.next_node:
-                                self.next_node.postMessage(message)  # 将内容写入响应队列
-
-                    except FileNotFoundError as e:
-                        logger.error(f'could not open pip file with given path : {self.app_context.output_pip_path}')
-                    finally:
-                        if read_pip is not None:
-                            read_pip.close()
-                    write_pip = open(self.app_context.output_pip_path, 'w', encoding=self.app_context.encoding)
-                    write_pip.close()  # 清空文件内容
-
-                    pip_lock = open(self.app_context.output_pip_lock, 'w', encoding=self.app_context.encoding)
-                    pip_lock.close()  # 重新创建锁文件
-                pass  # 主循环仅仅检查文件内容
+                lines = self.channel.read(self.app_context.timeout)
+                if not lines:
+                    continue
+                messages = Message.loadsBatch(lines)  # 整批解析
+                self.read_count += 1
+                self.line_count += len(messages)
+                if self.app_context.tracer.enabled:
+                    for message in messages:
+                        LatencyTracer.stamp(message, 'trace_read')
+                if self.app_context.log_messages:
+                    for message in messages:
+                        logger.debug(f"line from output pip : {message}")
+                if not self.next_node:
+                    continue
+                if self.next_node.input_buffer.full():  # 响应管道已满，暂停读取
+                    self.stall_count += 1
+                while not self.next_node.postMessages(messages, self.app_context.timeout):  # 整批写入响应队列
+                    if self.is_terminated:
+                        logger.warning(f'PipFileReader dropped {len(messages)} responses on shutdown')
+                        break
             # 线程退出
+            self.channel.close()
             self.onClosing('normal')
-
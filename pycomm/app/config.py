@@ -3,6 +3,10 @@ UI_FONT = 'consolas'  # 默认字体
 UI_PATH = './app/app.ui'  # UI路径设定
 UI_FONTSIZE = 8  # 默认字体大小
 UI_ENABLE_LOG = True  # 是否启用日志输出窗口
+UI_LOG_MAX_LINES = 500  # 日志窗口保留的最大日志条数
+UI_LOG_FLUSH_INTERVAL = 33  # 日志窗口刷新间隔，单位为毫秒，间隔内的日志合并为一次刷新
+UI_LOG_SPILL_PATH = './logs/gui.log'  # 完整日志历史的保存路径，为空时不保存
+UI_REFRESH_INTERVAL = 33  # 进度条与完成计数的刷新间隔，单位为毫秒，间隔内的更新只渲染最新值
 UI_EXPOSURE = 1  # 曝光
 UI_X_BIN = 1
 UI_Y_BIN = 1
@@ -11,6 +15,9 @@ CONNECT_HOST = '127.0.0.1'  # 连接目标地址
 CONNECT_PORT = 25565  # 端口号
 CONNECT_TIMEOUT = 3  # 超时时间
 CONNECT_ENCODING = 'gbk'  # 采用编码
+CONNECT_CODECS = ('text', 'binary')  # 支持的消息编码格式，按优先级排列，实际格式由中间件协商决定
+CONNECT_CORRELATION_TTL = 600  # 请求关联项的存活时间，单位为秒，超过该时间没有收到响应的回调被淘汰
+CONNECT_CORRELATION_CAPACITY = 4096  # 同时等待响应的最大请求数，超出时淘汰最久未收到响应的回调
 # 横移连拍配置
 XY_X_OFF = 0  # x，y轴偏移量
 XY_Y_OFF = 0
@@ -18,6 +25,9 @@ XY_ENABLE_EXTENSION = True  # 是否启用拓展
 XY_EXTENSION_UNIT = 0  # 拓展单位， 0：px、1：%
 XY_X_SPLIT = 2
 XY_Y_SPLIT = 2
+XY_AGGREGATE_INTERVAL = 0.5  # 由中间件将逐帧的拍摄响应合并为汇总响应的间隔，单位为秒，0表示逐帧接收
+XY_PROGRESS_DIR = './logs/xy_progress'  # 中断任务的已完成区域记录目录，再次执行相同参数的任务时可以仅续拍未完成的区域，为空时不保存
+XY_PROGRESS_SAVE_INTERVAL = 5  # 任务执行期间保存进度记录的最小间隔，单位为秒
 # 单点连拍配置
 SP_AREA_T = 0  # 默认TOP坐标
 SP_AREA_L = 0  # 默认LEFT坐标
@@ -28,9 +38,34 @@ SP_DURATION_VALUE = 5  # 默认持续时间
 SP_DURATION_UNIT = 0  # 持续连拍默认采用时间单位
 SP_FRAMERATE = 1  # 默认帧率
 SP_ENABLE_OPTIMIZE = True  # 是否启用坐标修正
+SP_AGGREGATE_INTERVAL = 0.5  # 由中间件将逐帧的拍摄响应合并为汇总响应的间隔，单位为秒，0表示逐帧接收
+# 批量拍摄计划配置
+PLAN_RETRIES = 2  # 任务收到启动失败(400)或者中间件繁忙(503)响应之后的最大重试次数
+PLAN_RETRY_INTERVAL = 1  # 重新提交任务之前的等待时间，单位为秒
+PLAN_FRAME_TIMEOUT = 60  # 任务超过该时间没有收到任何响应时判定为超时并执行下一个任务，排在前一个任务之后等待拍摄的时间不计入，单位为秒，0表示不限制
+PLAN_SUMMARY_PATH = './logs/plan_summary.csv'  # 每个任务的耗时统计保存路径
 # 中间件配置
 BE_CONFIG_PATH = '../backend/config.properties'
+PIP_WATCH_MODE = 'auto'  # 输出管道锁文件监视方式，auto：Linux下采用inotify，其余平台自适应轮询、polling：始终自适应轮询
+PIP_BATCH_WINDOW = 0.002  # 请求组提交窗口，单位为秒，窗口内到达的请求作为一批写入输入管道，0表示仅合并已经到达的请求
+PIP_BATCH_SIZE = 256  # 单批写入输入管道的最大请求数
+PIP_LOG_MESSAGES = False  # 是否逐条输出后端响应的调试日志，响应较多时会显著降低输出管道的读取吞吐量
+PIP_BUFFER_SIZE = 8192  # 请求管道、管道写线程以及响应管道各自的缓冲容量，单位为消息条数，请求管道已满时向前端回复503，0表示不限制
+LISTEN_MODE = 'thread'  # 服务端模式，thread：每个连接一个代理线程、asyncio：所有连接共用一个事件循环线程
 LISTEN_HOST = '127.0.0.1'
 LISTEN_PORT = 25565
 LISTEN_TIMEOUT = 3
 LISTEN_ENCODING = 'gbk'
+LISTEN_FLUSH_INTERVAL = 0.002  # 响应合并写出窗口，单位为秒，窗口内发往同一前端的响应通过一次系统调用写出，0表示逐条写出
+LISTEN_CODECS = ('text', 'binary')  # 向前端提议的消息编码格式，旧版本前端始终采用文本格式
+LISTEN_QUEUE_SIZE = 4096  # 每个前端连接的待写出队列容量，单位为帧，0表示不限制
+LISTEN_SLOW_POLICY = 'block'  # 待写出队列已满时的处理策略，block：等待该前端接收、drop：丢弃最早的进度消息(200/300)，按帧计数判断任务完成的前端会因此等待超时、disconnect：断开该前端
+LISTEN_AGGREGATE_INTERVAL = 0.5  # 请求要求汇总逐帧响应但未给出有效间隔时采用的汇总间隔，单位为秒
+LISTEN_TRACE = False  # 是否启用逐跳延迟追踪，启用后中间件命令行的stats命令输出各阶段耗时，也可以通过trace命令切换
+LISTEN_TOP_INTERVAL = 1  # 中间件命令行top面板的刷新间隔，单位为秒
+LISTEN_PROFILE_RATE = 100  # 中间件命令行profile命令的线程栈采样频率，单位为次每秒
+LISTEN_PROFILE_DIR = './logs'  # profile命令输出的折叠栈文件目录，可以由flamegraph.pl或speedscope生成火焰图
+
+# 后端模拟器配置
+BE_ACQUIRE_LATENCY = 0.5  # 单次拍摄耗时，单位为秒，与main.s中模拟的doCameraAcquire一致
+BE_DISPATCH_INTERVAL = 1  # 单点连拍子任务派发间隔，单位为秒，main.s中为每秒派发一次
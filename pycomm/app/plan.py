@@ -0,0 +1,306 @@
+"""
+Created on 2024.6.3
+@author: Pineclone
+批量拍摄计划，按照YAML计划无界面地依次执行横移连拍(xy)和单点连拍(sp)任务，
+前一个任务收到启动响应之后立即提交下一个任务，使后端在任务之间不会空闲，执行完成后输出每个任务的耗时统计
+"""
+import csv
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Tuple
+
+import yaml
+from loguru import logger
+
+from . import config
+from .comm import ClientSocketProcessor, Message, AGGREGATE_HEADER, AGGREGATE_CODE, BUSY_CODE
+
+RETRY_CODES = ('400', BUSY_CODE)  # 任务启动失败或者中间件繁忙时重新提交
+FAILURE_CODES = ('401', '404')  # 无法通过重新提交恢复的失败响应
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600}  # 与界面的持续时间单位一致
+EXTENSION_UNITS = {'px': 0, '%': 1}  # 与界面的边缘拓展单位一致
+
+
+class Job:
+    """ 计划中的单个拍摄任务以及它的执行记录 """
+
+    def __init__(self, index: int, spec: Dict):
+        mode = spec.get('mode')
+        if mode not in ('xy', 'sp'):
+            raise ValueError(f'Job {index}: mode must be xy or sp, got {mode}')
+        self.index = index
+        self.name = str(spec.get('name', f'{mode}-{index}'))
+        self.mode = mode
+        self.spec = spec
+        self.total = self.countFrames()  # 任务的总帧数
+        self.callback_id = None
+        self.attempts = 0  # 提交次数
+        self.status = 'pending'  # pending、submitted、running、done、failed、timeout
+        self.message = ''  # 失败原因
+        self.done = 0  # 完成帧数
+        self.ignored = 0  # 忽略帧数
+        self.retry_at = 0  # 重新提交的时间
+        self.submitted = 0  # 最后一次提交的时间
+        self.started = 0  # 收到启动响应的时间
+        self.first_frame = 0  # 收到第一帧的时间
+        self.last_response = 0  # 最后一次收到响应的时间
+        self.completed = 0  # 完成或者失败的时间
+
+    def countFrames(self) -> int:
+        spec = self.spec
+        if self.mode == 'xy':
+            total = math.ceil(spec.get('x_split', config.XY_X_SPLIT)) * math.ceil(spec.get('y_split', config.XY_Y_SPLIT))
+        else:
+            unit = spec.get('duration_unit', 's')
+            if unit not in DURATION_UNITS:
+                raise ValueError(f'Job {self.index}: duration_unit must be one of {list(DURATION_UNITS)}')
+            if spec.get('duration', 0) <= 0:  # 后端不会发出任务完成响应，无法等待永久任务结束
+                raise ValueError(f'Job {self.index}: sp job requires a positive duration')
+            total = spec['duration'] * DURATION_UNITS[unit] * spec.get('framerate', config.SP_FRAMERATE)  # 与界面一致
+        return int(total)
+
+    def toMessage(self) -> Message:
+        spec = self.spec
+        message = Message()
+        message.set('name', 'ContinuousAcquire')
+        message.set('cam_id', spec.get('cam_id', 1))
+        message.set('exposure', spec.get('exposure', config.UI_EXPOSURE))
+        message.set('x_bin', spec.get('x_bin', config.UI_X_BIN))
+        message.set('y_bin', spec.get('y_bin', config.UI_Y_BIN))
+        if self.mode == 'xy':
+            x_off, y_off = spec.get('x_off', 0), spec.get('y_off', 0)
+            message.set('option', 0)
+            message.set('enable_extension', 1 if x_off or y_off else 0)
+            message.set('extension_unit', EXTENSION_UNITS.get(spec.get('extension_unit', 'px'), 0))
+            message.set('x_off', x_off)
+            message.set('y_off', y_off)
+            message.set('x_split', spec.get('x_split', config.XY_X_SPLIT))
+            message.set('y_split', spec.get('y_split', config.XY_Y_SPLIT))
+        else:
+            area = spec.get('area', (config.SP_AREA_T, config.SP_AREA_L, config.SP_AREA_B, config.SP_AREA_R))
+            message.set('option', 1)
+            for key, value in zip(('pos_top', 'pos_left', 'pos_bottom', 'pos_right'), area):
+                message.set(key, value)
+            message.set('duration', spec['duration'] * DURATION_UNITS[spec.get('duration_unit', 's')])
+            message.set('framerate', spec.get('framerate', config.SP_FRAMERATE))
+            message.set('enable_optimize', 1 if spec.get('enable_optimize', config.SP_ENABLE_OPTIMIZE) else 0)
+            if config.SP_AGGREGATE_INTERVAL > 0:  # 由中间件汇总逐帧响应
+                message.setHeader(AGGREGATE_HEADER, config.SP_AGGREGATE_INTERVAL)
+        return message
+
+    def isFinished(self) -> bool:
+        return self.status in ('done', 'failed', 'timeout')
+
+    def getTiming(self) -> Dict:
+        """ 耗时统计，单位为秒，未发生的阶段为空 """
+        def since(begin, end):
+            return round(end - begin, 3) if begin and end else ''
+        return {
+            'index': self.index,
+            'name': self.name,
+            'mode': self.mode,
+            'status': self.status,
+            'attempts': self.attempts,
+            'frames': self.total,
+            'done': self.done,
+            'ignored': self.ignored,
+            'start_latency': since(self.submitted, self.started),
+            'first_frame': since(self.submitted, self.first_frame),
+            'elapsed': since(self.submitted, self.completed),
+            'message': self.message
+        }
+
+
+def loadPlan(path: str) -> Dict:
+    """
+    读取计划文件，返回任务列表以及执行参数，defaults中的参数作用于每个任务，未给出的参数采用config中的界面默认值。
+    计划文件格式:
+
+    retries: 2                      # 可选，单个任务收到400/503之后的最大重试次数
+    defaults: {exposure: 1, x_bin: 1, y_bin: 1}
+    jobs:
+      - name: overview
+        mode: xy
+        x_split: 4
+        y_split: 4
+        x_off: 10                   # 给出x_off或y_off时启用边缘拓展
+        extension_unit: px
+      - name: watch
+        mode: sp
+        area: [0, 0, 512, 512]      # top, left, bottom, right
+        framerate: 2
+        duration: 30
+        duration_unit: s
+        enable_optimize: false
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        plan = yaml.safe_load(file) or {}
+    defaults = plan.get('defaults') or {}
+    jobs = [Job(index, {**defaults, **spec}) for index, spec in enumerate(plan.get('jobs') or [])]
+    if not jobs:
+        raise ValueError(f'No job found in plan {path}')
+    return {
+        'jobs': jobs,
+        'retries': plan.get('retries', config.PLAN_RETRIES),
+        'retry_interval': plan.get('retry_interval', config.PLAN_RETRY_INTERVAL),
+        'frame_timeout': plan.get('frame_timeout', config.PLAN_FRAME_TIMEOUT)
+    }
+
+
+class PlanRunner:
+    """
+    计划执行器，任务按照计划顺序提交，前一个任务收到启动响应(201)之后立即提交下一个任务，
+    后端将其拍摄请求排在前一个任务之后；后端每个连接同一时间只允许一个单点连拍任务，因此单点连拍任务需要等待之前的单点连拍完成。
+    后端不会发出任务完成响应，与界面一致，收到全部帧的响应（包括被忽略的403）之后任务完成；
+    已启动的任务在收到第一帧之前，如果之前提交的任务尚未完成，其拍摄请求仍排在后端任务队列中，此时不计算超时，
+    前一个任务结束之后开始计时
+    """
+
+    def __init__(self, processor: ClientSocketProcessor, jobs: List[Job], retries: int = 2,
+                 retry_interval: float = 1, frame_timeout: float = 60):
+        self.processor = processor
+        self.jobs = jobs
+        self.retries = retries  # 收到400/503之后的最大重试次数
+        self.retry_interval = retry_interval  # 重新提交前的等待时间
+        self.frame_timeout = frame_timeout  # 任务超过该时间没有收到响应时判定为超时，0表示不限制
+        self.condition = threading.Condition()
+        self.pending = deque(jobs)  # 等待提交的任务
+        self.active: List[Job] = []  # 已提交但是没有完成的任务
+
+    def run(self) -> List[Job]:
+        while True:
+            submissions = []  # 在锁外发送的任务，发送可能因为背压阻塞，期间接收线程仍然需要处理响应
+            with self.condition:
+                if not self.pending and not self.active:
+                    break
+                now = time.time()
+                for job in list(self.active):
+                    if job.status == 'pending' and job.retry_at <= now:
+                        submissions.append(self.prepare(job))
+                    elif self.isTiming(job) and now - job.last_response > self.frame_timeout:
+                        self.finish(job, 'timeout', f'No response in {self.frame_timeout} seconds')
+                while self.pending and self.isSubmittable(self.pending[0]):
+                    job = self.pending.popleft()
+                    self.active.append(job)
+                    submissions.append(self.prepare(job))
+                if not submissions:
+                    self.condition.wait(self.nextWakeup(now))
+            for job, attempt, message in submissions:
+                self.submit(job, attempt, message)
+        return self.jobs
+
+    def isSubmittable(self, job: Job) -> bool:
+        """ 之前提交的任务均已启动，并且单点连拍任务之前没有未完成的单点连拍任务 """
+        if any(active.status != 'running' for active in self.active):
+            return False
+        return job.mode != 'sp' or all(active.mode != 'sp' for active in self.active)
+
+    def isTiming(self, job: Job) -> bool:
+        """ 任务是否计算超时：等待重新提交，或者已启动但尚未收到任何帧并且排在未完成的任务之后时不计算 """
+        if not self.frame_timeout or job.status == 'pending':
+            return False
+        return not (job.status == 'running' and not job.done + job.ignored and self.active.index(job) > 0)
+
+    def nextWakeup(self, now: float) -> float:
+        wakeups = [job.retry_at - now for job in self.active if job.status == 'pending']
+        wakeups += [job.last_response + self.frame_timeout - now for job in self.active if self.isTiming(job)]
+        return max(min(wakeups, default=config.CONNECT_TIMEOUT), 0.01)
+
+    def prepare(self, job: Job) -> Tuple[Job, int, Message]:
+        """ 准备提交任务，调用方持有condition """
+        job.attempts += 1
+        job.status = 'submitted'
+        job.submitted = job.last_response = time.time()
+        logger.info(f'Submit job {job.name} ({job.mode}, {job.total} frames), attempt {job.attempts}')
+        return job, job.attempts, job.toMessage()
+
+    def submit(self, job: Job, attempt: int, message: Message) -> None:
+        """ 发送任务，调用方不持有condition，400/503/401/404由关联表直接移除，其余情况在任务结束时显式完成 """
+        self.processor.send(message, lambda response: self.onResponse(job, attempt, response),
+                            RETRY_CODES + FAILURE_CODES)
+        with self.condition:
+            if job.attempts != attempt:
+                return
+            job.callback_id = message.getHeader('callback_id')
+            if job.isFinished():  # 发送期间任务已经结束
+                self.processor.correlations.complete(job.callback_id)
+
+    def finish(self, job: Job, status: str, message: str = '') -> None:
+        """ 结束任务并注销回调，调用方持有condition """
+        job.status = status
+        job.message = message
+        job.completed = time.time()
+        self.active.remove(job)
+        for active in self.active:  # 排队等待拍摄的任务从前一个任务结束时开始计算超时
+            if active.status == 'running' and not active.done + active.ignored:
+                active.last_response = max(active.last_response, job.completed)
+        self.processor.correlations.complete(job.callback_id)
+        logger.info(f'Job {job.name} {status}: {job.done} done, {job.ignored} ignored' + (f', {message}' if message else ''))
+
+    def onResponse(self, job: Job, attempt: int, response: Message) -> None:
+        code = response.get('code')
+        with self.condition:
+            if job.isFinished() or attempt != job.attempts:
+                return  # 已结束的任务或者上一次提交的迟到响应
+            now = job.last_response = time.time()
+            if code == '201':
+                job.status = 'running'
+                job.started = now
+            elif code == '200':
+                job.done += 1
+            elif code == '403':
+                job.ignored += 1
+            elif code == AGGREGATE_CODE:
+                job.done += int(response.get('done'))
+                job.ignored += int(response.get('ignored'))
+            elif code in RETRY_CODES:
+                if job.attempts > self.retries:
+                    self.finish(job, 'failed', response.get('message'))
+                else:
+                    logger.warning(f'Job {job.name} rejected ({code}: {response.get("message")}), '
+                                   f'retry in {self.retry_interval} seconds')
+                    job.status = 'pending'
+                    job.retry_at = now + self.retry_interval
+            elif code in FAILURE_CODES:
+                self.finish(job, 'failed', response.get('message'))
+
+            if code in ('200', AGGREGATE_CODE) and not job.first_frame:
+                job.first_frame = now
+            if not job.isFinished() and job.done + job.ignored >= job.total:
+                self.finish(job, 'done')
+            self.condition.notify()
+
+
+def writeSummary(jobs: List[Job], path: str) -> None:
+    """ 将每个任务的耗时统计写入csv文件 """
+    timings = [job.getTiming() for job in jobs]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(timings[0]))
+        writer.writeheader()
+        writer.writerows(timings)
+
+
+def printSummary(jobs: List[Job]) -> None:
+    print(f'{"job":<20}{"mode":>6}{"status":>9}{"attempts":>10}{"done":>7}{"ignored":>9}'
+          f'{"start (s)":>11}{"first (s)":>11}{"elapsed (s)":>13}')
+    for job in jobs:
+        timing = job.getTiming()
+        print(f'{job.name:<20}{job.mode:>6}{job.status:>9}{job.attempts:>10}{job.done:>7}{job.ignored:>9}'
+              f'{timing["start_latency"]:>11}{timing["first_frame"]:>11}{timing["elapsed"]:>13}')
+
+
+def runPlan(processor: ClientSocketProcessor, path: str, summary_path: str = None) -> List[Job]:
+    """ 读取并执行计划文件，输出耗时统计 """
+    plan = loadPlan(path)
+    begin = time.time()
+    jobs = PlanRunner(processor, plan['jobs'], plan['retries'], plan['retry_interval'], plan['frame_timeout']).run()
+    logger.info(f'Plan {path} finished in {time.time() - begin:.3f} seconds')
+    printSummary(jobs)
+    if summary_path:
+        writeSummary(jobs, summary_path)
+        logger.info(f'Job timing summary saved to {summary_path}')
+    return jobs
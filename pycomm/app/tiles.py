@@ -0,0 +1,120 @@
+"""
+Created on 2024.6.10
+@author: Pineclone
+横移连拍区域追踪，以位图记录每个区域的完成情况，区域总数为x_split * y_split，
+区域序号按照行优先编号，与后端响应中的区域序号(TILE_KEY)一致；
+中断的任务按照任务参数保存已完成的区域，再次执行相同参数的任务时仅续拍未完成的区域
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Tuple
+
+from .comm import Message, AGGREGATE_CODE, TILE_KEY, encodeRanges, decodeRanges
+
+
+def toRanges(bitmap: bytearray) -> str:
+    """ 将位图中为真的序号编码为区间，例如'0-2,5,7-8' """
+    return encodeRanges(index for index, flag in enumerate(bitmap) if flag)
+
+
+class TileTracker:
+    """ 横移连拍任务的区域完成位图，重复的响应不会重复计数 """
+
+    def __init__(self, total: int):
+        self.done = bytearray(total)  # 已完成的区域
+        self.ignored = bytearray(total)  # 被忽略的区域
+
+    @staticmethod
+    def markRanges(bitmap: bytearray, text: str) -> int:
+        """ 标记区间编码中的区域，返回新标记的区域数，超出区域总数的序号被忽略 """
+        marked = 0
+        for begin, end in decodeRanges(text):
+            size = max(min(end + 1, len(bitmap)) - begin, 0)
+            marked += size - bitmap.count(1, begin, begin + size)
+            bitmap[begin:begin + size] = b'\x01' * size
+        return marked
+
+    def update(self, response: Message) -> Tuple[int, int]:
+        """
+        根据逐帧响应(200/403)或者汇总响应(206)更新位图，后端未给出区域序号时按照响应中的帧数计数
+        :return: 新完成以及新忽略的区域数
+        """
+        code = response.get('code')
+        if code in ('200', '403'):
+            tile = response.get(TILE_KEY)
+            if tile is None:
+                return (1, 0) if code == '200' else (0, 1)
+            done, ignored = (tile, None) if code == '200' else (None, tile)
+        elif code == AGGREGATE_CODE:
+            if response.get('tiles') is None and response.get('ignored_tiles') is None:
+                return int(response.get('done')), int(response.get('ignored'))
+            done, ignored = response.get('tiles'), response.get('ignored_tiles')
+        else:
+            return 0, 0
+        return self.markRanges(self.done, done), self.markRanges(self.ignored, ignored)
+
+    def getDoneNum(self) -> int:
+        return self.done.count(1)
+
+    def getIgnoredNum(self) -> int:
+        return self.ignored.count(1)
+
+    def getPendingRanges(self) -> str:
+        """ 既未完成也未被忽略的区域 """
+        return encodeRanges(index for index, (done, ignored) in enumerate(zip(self.done, self.ignored))
+                            if not done and not ignored)
+
+
+class TileProgressStore:
+    """
+    横移连拍进度记录，每个任务一个JSON文件，文件名由任务参数（请求消息体中除option和tiles以外的字段）的摘要决定，
+    内容为任务参数、区域总数以及区间编码的已完成区域；被忽略的区域不会保存，续拍时重新拍摄
+    """
+    excluded = ('option', 'tiles')  # 不影响拍摄内容的字段
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def getParams(self, body: Dict[str, str]) -> Dict[str, str]:
+        return {key: str(value) for key, value in body.items() if key not in self.excluded}
+
+    def getPath(self, params: Dict[str, str]) -> str:
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f'xy_{digest}.json')
+
+    def load(self, body: Dict[str, str], total: int) -> TileTracker or None:
+        """ 读取相同参数的任务进度，不存在或者与当前任务不一致时返回None """
+        params = self.getParams(body)
+        try:
+            with open(self.getPath(params), encoding='utf-8') as file:
+                record = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if record.get('params') != params or record.get('total') != total:
+            return None
+        tracker = TileTracker(total)
+        tracker.markRanges(tracker.done, record.get('done'))
+        return tracker
+
+    def save(self, body: Dict[str, str], tracker: TileTracker) -> None:
+        """ 保存任务进度，全部区域完成或者没有完成任何区域时删除记录 """
+        params = self.getParams(body)
+        done = tracker.getDoneNum()
+        if done == 0 or done == len(tracker.done):
+            self.remove(body)
+            return
+        record = {'params': params, 'total': len(tracker.done), 'done': toRanges(tracker.done),
+                  'updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+        path = self.getPath(params)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:  # 先写临时文件再替换，避免中断时留下不完整的记录
+            json.dump(record, file)
+        os.replace(path + '.tmp', path)
+
+    def remove(self, body: Dict[str, str]) -> None:
+        try:
+            os.remove(self.getPath(self.getParams(body)))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,446 @@
+"""
+Created on 2024.5.27
+@author: Pineclone
+DM进程传输层，中间件与后端进程之间的单向消息通道，每条通道传递以字符串表示的消息记录，
+一个传输由输入通道（中间件写、后端读）和输出通道（后端写、中间件读）组成：
+- file：文件管道 + 锁文件握手，即DM脚本(main.s)所采用的协议
+- fifo：POSIX命名管道
+- unix：Unix域套接字
+- shm：multiprocessing.shared_memory单生产者单消费者环形缓冲区
+除file之外的传输方式仅能用于Python后端模拟器
+"""
+import os
+import select
+import socket
+import struct
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from loguru import logger
+
+
+class LockFileWatcher:
+    """
+    锁文件监视器，等待锁文件被删除。Linux下通过inotify监听锁文件所在目录的删除事件，锁文件被删除后立即返回；
+    inotify不可用时回退为自适应轮询，空闲时轮询间隔从min_interval逐步翻倍至max_interval，锁文件被删除后重置
+    """
+    IN_MOVED_FROM = 0x00000040
+    IN_DELETE = 0x00000200
+
+    def __init__(self, path: str, mode: str = 'auto', min_interval: float = 0.001, max_interval: float = 0.1):
+        """
+        :param mode: auto：优先采用inotify，polling：始终采用自适应轮询
+        """
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval  # 当前轮询间隔
+        self.fd = self.openInotify() if mode == 'auto' else None
+        self.mode = 'inotify' if self.fd is not None else 'polling'
+
+    def openInotify(self) -> int or None:
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if libc.inotify_add_watch(fd, os.fsencode(directory), self.IN_DELETE | self.IN_MOVED_FROM) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError) as e:
+            logger.debug(f'inotify unavailable, fall back to polling: {e}')
+            return None
+
+    def waitForRemoval(self, timeout: float) -> bool:
+        """
+        等待锁文件被删除
+        :return: 锁文件不存在时返回真，超时返回假
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if not os.path.exists(self.path):
+                self.interval = self.min_interval
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            if self.fd is not None:  # 目录中任何文件的删除事件都会唤醒，唤醒后重新检查锁文件
+                readable, _, _ = select.select([self.fd], [], [], remaining)
+                if readable:
+                    try:
+                        os.read(self.fd, 4096)  # 清空事件队列
+                    except BlockingIOError:
+                        pass
+            else:
+                time.sleep(min(self.interval, remaining))
+                self.interval = min(self.interval * 2, self.max_interval)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Channel:
+    """
+    单向消息通道，由写端和读端分别持有，资源（管道文件、命名管道、共享内存）由后端一侧创建和销毁，
+    对端尚未就绪时写端不会阻塞，而是返回实际写出的记录数，由调用方保留剩余记录稍后重试
+    """
+    name = None
+
+    def __init__(self, path: str, encoding: str = 'utf-8', reading: bool = True, owner: bool = False, **options):
+        """
+        :param path: 通道路径，file传输为管道文件路径
+        :param reading: 是否为读端
+        :param owner: 是否负责创建和销毁通道资源
+        """
+        self.path = path
+        self.encoding = encoding
+        self.reading = reading
+        self.owner = owner
+        self.options = options
+
+    def write(self, records: List[str]) -> int:
+        """
+        写出消息记录
+        :return: 实际写出的记录数，对端尚未就绪时返回0
+        """
+        return 0
+
+    def read(self, timeout: float) -> List[str]:
+        """
+        等待并读取消息记录
+        :return: 读取的记录，超时返回空列表
+        """
+        return []
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def splitRecords(data: bytes, encoding: str) -> Tuple[List[str], bytes]:
+        """ 将换行分隔的数据切分为记录，返回完整的记录以及不完整的尾部 """
+        *lines, tail = data.split(b'\n')
+        return [str(line, encoding).strip() for line in lines if line.strip()], tail
+
+
+class FileChannel(Channel):
+    """
+    文件管道，锁文件存在时写端允许写入，写端追加写入记录后删除锁文件通知读端；
+    读端感知到锁文件被删除后读取并清空管道文件，然后重新创建锁文件
+    """
+    name = 'file'
+
+    def __init__(self, path: str, encoding: str = 'utf-8', reading: bool = True, owner: bool = False, **options):
+        super().__init__(path, encoding, reading, owner, **options)
+        self.lock = options['lock']  # 锁文件路径
+        self.watcher = LockFileWatcher(self.lock, options.get('watch_mode', 'auto')) if reading else None
+        if owner:  # 与DM进程一致，启动时重新创建管道文件和锁文件
+            for path in (self.path, self.lock):
+                if os.path.exists(path):
+                    os.remove(path)
+                open(path, 'w').close()
+
+    def write(self, records: List[str]) -> int:
+        if not os.path.exists(self.lock):  # 锁文件不存在，不允许写入
+            return 0
+
+        with open(self.path, 'a', encoding=self.encoding) as pip:  # 锁文件存在，允许写入
+            pip.write(''.join(record + '\n' for record in records))
+
+        try:  # 删除锁文件，触发对端读消息
+            os.remove(self.lock)
+        except OSError as e:
+            logger.error(f'Unable handle deleting lock file at {self.lock}: {e}')
+        return len(records)
+
+    def read(self, timeout: float) -> List[str]:
+        if not self.watcher.waitForRemoval(timeout):  # 锁文件存在时不允许读取
+            return []
+
+        data = ''
+        try:
+            with open(self.path, 'r+', encoding=self.encoding) as pip:  # 一次读取整批记录，并通过同一个文件句柄清空文件内容
+                data = pip.read()
+                pip.seek(0)
+                pip.truncate()
+        except FileNotFoundError:
+            logger.error(f'could not open pip file with given path : {self.path}')
+            open(self.path, 'w').close()
+        open(self.lock, 'w').close()  # 重新创建锁文件
+        return [line for line in data.split('\n') if line and not line.isspace()]
+
+    def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
+        if self.owner:
+            for path in (self.path, self.lock):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class FifoChannel(Channel):
+    """
+    POSIX命名管道，读端同时以写方式打开管道，避免写端全部关闭时读端反复读到EOF，
+    读端尚未打开管道时写端无法打开，此时视为对端尚未就绪
+    """
+    name = 'fifo'
+
+    def __init__(self, path: str, encoding: str = 'utf-8', reading: bool = True, owner: bool = False, **options):
+        super().__init__(path, encoding, reading, owner, **options)
+        if not hasattr(os, 'mkfifo'):
+            raise OSError('fifo transport is not supported on this platform')
+        if owner and not os.path.exists(path):
+            os.mkfifo(path)
+        self.fd = None
+        self.keeper = None  # 读端持有的写描述符
+        self.tail = b''  # 不完整的记录
+
+    def open(self) -> bool:
+        if self.fd is not None:
+            return True
+        try:
+            if self.reading:
+                self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+                self.keeper = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            else:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                os.set_blocking(self.fd, True)  # 管道写满时阻塞，形成背压
+            return True
+        except OSError:  # 管道尚未创建，或者读端尚未打开
+            return False
+
+    def write(self, records: List[str]) -> int:
+        if not self.open():
+            return 0
+        data = memoryview(''.join(record + '\n' for record in records).encode(self.encoding))
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except BrokenPipeError:
+            os.close(self.fd)
+            self.fd = None
+            return 0
+        return len(records)
+
+    def read(self, timeout: float) -> List[str]:
+        if not self.open():
+            time.sleep(timeout)
+            return []
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        chunks = [self.tail]
+        try:
+            while True:
+                chunk = os.read(self.fd, 64 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except BlockingIOError:
+            pass
+        records, self.tail = self.splitRecords(b''.join(chunks), self.encoding)
+        return records
+
+    def close(self) -> None:
+        for fd in (self.fd, self.keeper):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self.keeper = None
+        if self.owner and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UnixSocketChannel(Channel):
+    """
+    Unix域套接字，读端绑定并监听套接字路径，写端在首次写出时连接，连接断开后在下一次写出时重连
+    """
+    name = 'unix'
+
+    def __init__(self, path: str, encoding: str = 'utf-8', reading: bool = True, owner: bool = False, **options):
+        super().__init__(path, encoding, reading, owner, **options)
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('unix transport is not supported on this platform')
+        self.server = None
+        self.connection = None
+        self.tails: Dict[socket.socket, bytes] = {}  # 读端连接 -> 不完整的记录
+        if reading:
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+            self.server.listen()
+
+    def write(self, records: List[str]) -> int:
+        if self.connection is None:
+            try:
+                self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.connection.connect(self.path)
+            except OSError:  # 读端尚未监听
+                self.connection.close()
+                self.connection = None
+                return 0
+        try:
+            self.connection.sendall(''.join(record + '\n' for record in records).encode(self.encoding))
+        except OSError:
+            self.connection.close()
+            self.connection = None
+            return 0
+        return len(records)
+
+    def read(self, timeout: float) -> List[str]:
+        readable, _, _ = select.select([self.server, *self.tails], [], [], timeout)
+        records = []
+        for sock in readable:
+            if sock is self.server:
+                connection, _ = self.server.accept()
+                self.tails[connection] = b''
+                continue
+            data = sock.recv(256 * 1024)
+            if not data:  # 写端关闭连接
+                sock.close()
+                self.tails.pop(sock)
+                continue
+            received, self.tails[sock] = self.splitRecords(self.tails[sock] + data, self.encoding)
+            records += received
+        return records
+
+    def close(self) -> None:
+        for sock in (self.server, self.connection, *self.tails):
+            if sock is not None:
+                sock.close()
+        self.tails.clear()
+        if self.reading and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SharedMemoryChannel(Channel):
+    """
+    共享内存环形缓冲区，单生产者单消费者，头部16字节分别为写位置和读位置（单调递增），其后为数据区，
+    每条记录以4字节长度前缀存储，缓冲区剩余空间不足时写端仅写出能够容纳的记录，读端以自适应轮询等待数据
+    """
+    name = 'shm'
+    positions = struct.Struct('<QQ')
+    length = struct.Struct('<I')
+
+    def __init__(self, path: str, encoding: str = 'utf-8', reading: bool = True, owner: bool = False, **options):
+        super().__init__(path, encoding, reading, owner, **options)
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise OSError('shm transport requires python 3.8 or later')
+        self.shared_memory = shared_memory
+        self.capacity = int(options.get('capacity', 1024 * 1024))  # 数据区大小
+        self.segment = 'pycomm_' + os.path.splitext(os.path.basename(path))[0]  # 共享内存名称
+        self.memory = None
+        self.interval = 0.0005  # 读端轮询间隔
+        if owner:
+            try:  # 清除上一次运行残留的共享内存
+                stale = shared_memory.SharedMemory(self.segment)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            self.memory = shared_memory.SharedMemory(self.segment, create=True, size=self.capacity + 16)
+            self.positions.pack_into(self.memory.buf, 0, 0, 0)
+
+    def open(self) -> bool:
+        if self.memory is None:
+            try:
+                self.memory = self.shared_memory.SharedMemory(self.segment)
+                self.capacity = self.memory.size - 16
+            except FileNotFoundError:  # 后端尚未创建共享内存
+                return False
+        return True
+
+    def copy(self, position: int, data) -> None:
+        """ 将数据写入环形缓冲区，处理跨越缓冲区末尾的情况 """
+        buffer = self.memory.buf
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        buffer[16 + offset:16 + offset + first] = data[:first]
+        buffer[16:16 + len(data) - first] = data[first:]
+
+    def fetch(self, position: int, size: int) -> bytes:
+        buffer = self.memory.buf
+        offset = position % self.capacity
+        first = min(size, self.capacity - offset)
+        return bytes(buffer[16 + offset:16 + offset + first]) + bytes(buffer[16:16 + size - first])
+
+    def isEmpty(self) -> bool:
+        head, tail = self.positions.unpack_from(self.memory.buf, 0)
+        return head == tail
+
+    def write(self, records: List[str]) -> int:
+        if not self.open():
+            return 0
+        head, tail = self.positions.unpack_from(self.memory.buf, 0)
+        free = self.capacity - (head - tail)
+        chunks = []
+        for record in records:
+            data = record.encode(self.encoding)
+            if 4 + len(data) > free:  # 剩余空间不足
+                break
+            chunks += (self.length.pack(len(data)), data)
+            free -= 4 + len(data)
+        data = b''.join(chunks)
+        self.copy(head, data)
+        struct.pack_into('<Q', self.memory.buf, 0, head + len(data))  # 数据写入完成之后再发布写位置
+        return len(chunks) // 2
+
+    def read(self, timeout: float) -> List[str]:
+        deadline = time.monotonic() + timeout
+        while not self.open() or self.isEmpty():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            time.sleep(min(self.interval, remaining))
+            self.interval = min(self.interval * 2, 0.05)
+        self.interval = 0.0005
+
+        head, tail = self.positions.unpack_from(self.memory.buf, 0)
+        data, offset, records = self.fetch(tail, head - tail), 0, []
+        while offset < len(data):
+            size = self.length.unpack_from(data, offset)[0]
+            records.append(str(data[offset + 4:offset + 4 + size], self.encoding))
+            offset += 4 + size
+        struct.pack_into('<Q', self.memory.buf, 8, head)  # 释放已读取的空间
+        return records
+
+    def close(self) -> None:
+        if self.memory is not None:
+            self.memory.close()
+            if self.owner:
+                self.memory.unlink()
+            self.memory = None
+
+
+TRANSPORTS = {channel.name: channel for channel in (FileChannel, FifoChannel, UnixSocketChannel, SharedMemoryChannel)}
+
+
+def createChannels(config: Dict, side: str = 'middleware') -> Tuple[Channel, Channel]:
+    """
+    根据配置创建传输通道
+    :param config: 包含transport、encoding以及input/output_pip_path、input/output_pip_lock等配置
+    :param side: middleware：中间件一侧，写输入通道、读输出通道；backend：后端一侧，负责创建通道资源
+    :return: (输入通道，输出通道)
+    """
+    name = config.get('transport', 'file')
+    if name not in TRANSPORTS:
+        raise ValueError(f'Unsupported transport: {name}, available: {", ".join(TRANSPORTS)}')
+    channel_class = TRANSPORTS[name]
+    backend = side == 'backend'
+    options = {'watch_mode': config.get('watch_mode', 'auto'), 'capacity': config.get('shm_capacity', 1024 * 1024)}
+    input_channel = channel_class(config['input_pip_path'], config['encoding'], reading=backend, owner=backend,
+                                  lock=config.get('input_pip_lock'), **options)
+    output_channel = channel_class(config['output_pip_path'], config['encoding'], reading=not backend, owner=backend,
+                                   lock=config.get('output_pip_lock'), **options)
+    return input_channel, output_channel
@@ -0,0 +1,12 @@
+import argparse
+
+from app.bench import run
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='通讯模块性能基准测试')
+    parser.add_argument('names', nargs='*', help='需要执行的测试名称，为空时执行全部测试')
+    parser.add_argument('--json', dest='output', help='统计结果的JSON输出路径')
+    parser.add_argument('--baseline', help='基线JSON路径，与之比较并报告性能回退')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='允许的p50耗时增长比例，默认0.1')
+    arguments = parser.parse_args()
+    exit(1 if run(arguments.names, arguments.output, arguments.baseline, arguments.tolerance) else 0)
@@ -0,0 +1,4 @@
+from app.CLI import CMD
+
+if __name__ == '__main__':
+    CMD.run()
@@ -0,0 +1,20 @@
+import argparse
+
+from app import config
+from app.comm import ClientSocketProcessor
+from app.plan import runPlan
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='无界面执行YAML批量拍摄计划')
+    parser.add_argument('plan', help='计划文件路径')
+    parser.add_argument('--summary', default=config.PLAN_SUMMARY_PATH, help='每个任务的耗时统计保存路径')
+    arguments = parser.parse_args()
+    processor = ClientSocketProcessor(
+        config.CONNECT_HOST, config.CONNECT_PORT, config.CONNECT_TIMEOUT, codecs=config.CONNECT_CODECS,
+        correlation_ttl=config.CONNECT_CORRELATION_TTL, correlation_capacity=config.CONNECT_CORRELATION_CAPACITY)
+    processor.launch()
+    try:
+        jobs = runPlan(processor, arguments.plan, arguments.summary)
+    finally:
+        processor.terminate()
+    exit(0 if all(job.status == 'done' for job in jobs) else 1)